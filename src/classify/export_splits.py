@@ -0,0 +1,193 @@
+"""
+    Script para exportar los conjuntos de entrenamiento y test de un índice de Elasticsearch
+    ----------------------------------------------------------------------------------------
+    Sustituye a los comandos de `elasticdump` (uno por conjunto) con una única pasada sobre el índice: se lanza un
+    scroll dividido en slices (https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html#slice-scroll)
+    y cada slice se recorre en un hilo distinto. Cada documento se escribe en el conjunto de entrenamiento si su
+    `created_utc` es anterior o igual a la fecha de corte, o en el de test en caso contrario.
+
+    Cada hilo escribe sus propios ficheros comprimidos, que al terminar se concatenan en uno por conjunto: tanto gzip
+    como zstd admiten varios bloques comprimidos seguidos. Los documentos tienen el mismo formato que los de
+    `elasticdump` (`_index`, `_type`, `_id`, `_score` y `_source`).
+    Junto a cada conjunto se escribe un manifiesto `<fichero>.manifest.json` con el número de documentos y el rango de
+    `created_utc`, que `train.py` utiliza para no tener que recorrer el fichero para contarlos.
+
+    Parámetros
+    ----------
+    * index: Índice de Elasticsearch a exportar. Por defecto: phase-b
+    * -e, --elasticsearch: Dirección del servidor Elasticsearch. Por defecto: http://localhost:9200
+    * -c, --cutoff: Timestamp de corte entre entrenamiento y test. Por defecto: 1556220629
+    * -o, --output-dir: Directorio donde se escriben los conjuntos. Por defecto, el directorio actual
+    * -p, --prefix: Prefijo de los ficheros: `<prefijo>-training.ndjson.gz` y `<prefijo>-test.ndjson.gz`. Por defecto,
+    el nombre del índice
+    * -w, --workers: Número de slices del scroll, recorridos cada uno en un hilo. Por defecto: 4
+    * --size: Documentos de cada página del scroll. Por defecto: 1000
+    * --scroll: Tiempo que se mantiene abierto el contexto del scroll entre páginas. Por defecto: 5m
+    * --query: Fichero JSON con una consulta que filtra los documentos a exportar. Opcional
+    * --compress: Compresión de los ficheros, "gzip" o "zstd". Por defecto: gzip
+    * --compress-level: Nivel de compresión. Por defecto, 6 en gzip y 3 en zstd
+"""
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import Elasticsearch, helpers
+
+from src.utils.pipeline import DumpWriter
+
+__author__ = "Samuel Cifuentes García"
+
+SPLITS = ("training", "test")
+
+
+def main(args):
+    global es
+    es = Elasticsearch(args.elasticsearch, timeout=10000)
+
+    query = {"match_all": {}}
+    if args.query:
+        with open(args.query) as f:
+            query = json.load(f)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    prefix = os.path.join(args.output_dir, args.prefix or args.index)
+    paths = {split: "%s-%s.ndjson%s"%(prefix, split, DumpWriter.SUFFIXES[args.compress]) for split in SPLITS}
+
+    print("Exportando %s en %d slices..."%(args.index, args.workers))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        parts = list(executor.map(lambda slice_id: export_slice(args.index, query, args.cutoff, prefix, slice_id, args.workers,
+                                                                args.size, args.scroll, args.compress, args.compress_level),
+                                  range(args.workers)))
+
+    for split in SPLITS:
+        manifest = merge_parts(paths[split], [part[split] for part in parts])
+        print("\t*%s: %d documentos"%(paths[split], manifest["documents"]))
+
+
+def export_slice(index, query, cutoff, prefix, slice_id, slices, size=1000, scroll="5m", compression="gzip", compress_level=None):
+    """
+        Recorre una slice del scroll, escribiendo cada documento en la parte de entrenamiento o test de la slice
+
+        Parámetros
+        ----------
+        index: str
+            \tNombre del índice
+        query: dict
+            \tConsulta que filtra los documentos a exportar
+        cutoff: int
+            \tTimestamp de corte: los documentos con un `created_utc` anterior o igual van a entrenamiento
+        prefix: str
+            \tRuta base de los ficheros de salida
+        slice_id: int
+            \tNúmero de la slice
+        slices: int
+            \tNúmero total de slices
+        size: int
+            \tDocumentos de cada página del scroll
+        scroll: str
+            \tTiempo que se mantiene abierto el contexto del scroll
+        compression: str
+            \t"gzip" o "zstd"
+        compress_level: int
+            \tNivel de compresión
+
+        Salida
+        ------
+        dict
+            \tManifiesto de la parte de cada conjunto: ruta, documentos y rango de `created_utc`
+    """
+    parts = {}
+    writers = {}
+    for split in SPLITS:
+        path = "%s-%s.part%03d.ndjson%s"%(prefix, split, slice_id, DumpWriter.SUFFIXES[compression])
+        # Las partes de una ejecución anterior interrumpida se descartan, el escritor añade al final
+        if os.path.exists(path):
+            os.remove(path)
+        writers[split] = DumpWriter(path, compression=compression, compress_level=compress_level)
+        parts[split] = {"file": path, "documents": 0, "min_created_utc": None, "max_created_utc": None}
+
+    body = {"query": query}
+    if slices > 1:
+        body["slice"] = {"id": slice_id, "max": slices}
+    batches = {split: [] for split in SPLITS}
+    for hit in helpers.scan(es, index=index, query=body, size=size, scroll=scroll):
+        created_utc = hit["_source"]["created_utc"]
+        split = "training" if created_utc <= cutoff else "test"
+        batches[split].append({key: hit[key] for key in ("_index", "_type", "_id", "_score", "_source") if key in hit})
+
+        part = parts[split]
+        part["documents"] += 1
+        part["min_created_utc"] = created_utc if part["min_created_utc"] is None else min(created_utc, part["min_created_utc"])
+        part["max_created_utc"] = created_utc if part["max_created_utc"] is None else max(created_utc, part["max_created_utc"])
+
+        if len(batches[split]) >= size:
+            writers[split].write(batches[split])
+            batches[split] = []
+
+    for split in SPLITS:
+        writers[split].write(batches[split])
+        writers[split].close()
+    return parts
+
+
+def merge_parts(path, parts):
+    """
+        Concatena las partes comprimidas de un conjunto en un único fichero, sin descomprimirlas, y escribe su manifiesto
+
+        Parámetros
+        ----------
+        path: str
+            \tRuta del fichero final
+        parts: list
+            \tManifiestos de las partes, como los devuelve `export_slice`
+
+        Salida
+        ------
+        dict
+            \tManifiesto del conjunto
+    """
+    with open(path, "wb") as f:
+        for part in parts:
+            with open(part["file"], "rb") as part_file:
+                shutil.copyfileobj(part_file, f, 16*1024*1024)
+            os.remove(part["file"])
+
+    dates = [part[key] for part in parts for key in ("min_created_utc", "max_created_utc") if part[key] is not None]
+    manifest = {
+        "file": os.path.basename(path),
+        "documents": sum(part["documents"] for part in parts),
+        "min_created_utc": min(dates) if dates else None,
+        "max_created_utc": max(dates) if dates else None,
+        "compressed_bytes": os.path.getsize(path)
+    }
+    with open(path + ".manifest.json", "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def parse_args():
+    """
+        Procesamiento de los argumentos con los que se ejecutó el script
+    """
+    parser = argparse.ArgumentParser(
+        description="Script para exportar los conjuntos de entrenamiento y test de un índice de Elasticsearch")
+    parser.add_argument("index", nargs="?", default="phase-b", help="Índice de Elasticsearch")
+    parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch")
+    parser.add_argument("-c", "--cutoff", type=int, default=1556220629, help="Timestamp de corte entre entrenamiento y test")
+    parser.add_argument("-o", "--output-dir", default=".", help="Directorio donde se escriben los conjuntos")
+    parser.add_argument("-p", "--prefix", help="Prefijo de los ficheros de salida. Por defecto, el nombre del índice")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Número de slices del scroll, recorridos en paralelo")
+    parser.add_argument("--size", type=int, default=1000, help="Documentos de cada página del scroll")
+    parser.add_argument("--scroll", default="5m", help="Tiempo que se mantiene abierto el contexto del scroll")
+    parser.add_argument("--query", help="Fichero JSON con la consulta que filtra los documentos a exportar")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], default="gzip", help="Compresión de los ficheros")
+    parser.add_argument("--compress-level", type=int, help="Nivel de compresión")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
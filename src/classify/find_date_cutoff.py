@@ -1,145 +1,182 @@
 """
-    Script para obtener la fecha que contiene el 80% de documentos de un índice de Elasticsearch
-    --------------------------------------------------------------------------------------------
+    Script para obtener las fechas que separan los documentos de un índice de Elasticsearch en los cuantiles indicados
+    ------------------------------------------------------------------------------------------------------------------
+    La distribución de `created_utc` se obtiene con una única consulta: un histograma fino cuyos buckets se acumulan
+    localmente, exacto hasta la resolución indicada, o una agregación `percentiles`, aproximada. Por cada cuantil se
+    muestra la fecha de corte y los documentos que quedarían en entrenamiento (hasta la fecha incluida) y en test.
+
     Parámetros
     ----------
-    * index: Índice de Elasticsearch a tratar  
-    * -e, --elasticsearch: Dirección del servidor Elasticsearch. Por defecto: http://localhost:9200  
+    * index: Índice de Elasticsearch a tratar
+    * -e, --elasticsearch: Dirección del servidor Elasticsearch. Por defecto: http://localhost:9200
+    * -q, --quantiles: Cuantiles a calcular, entre 0 y 1. Por defecto: 0.8
+    * --query: Fichero JSON con la consulta que filtra los documentos a tener en cuenta. Por defecto, los documentos
+    con `lonely: True`
+    * -m, --method: "histogram" para un cálculo exacto hasta la resolución indicada o "percentiles" para uno aproximado.
+    Por defecto: histogram
+    * -r, --resolution: Tamaño de los buckets del histograma, en segundos. Por defecto: 3600
 """
 
 import argparse
+import json
 from elasticsearch import Elasticsearch
 from datetime import datetime as dt
 
 __author__ = "Samuel Cifuentes García"
 
-global total_docs
 global es
 
+# Por defecto se calculan las fechas sobre los posts de la muestra lonely
+DEFAULT_QUERY = {
+    "match": {
+        "lonely": True
+    }
+}
+
+
 def main(args):
-    global total_docs, es
-    es = Elasticsearch(timeout=10000)
+    global es
+    es = Elasticsearch(args.elasticsearch, timeout=10000)
 
-    # Número total de documentos en el índice
-    # res = es.count(index=args.index)
-    # Si queremos calcular la fecha para un subconjunto del índice usamos una consulta
-    res = es.count(index=args.index,
-        body={
-            "query":{
-                "match":{
-                    "lonely": True
-                }
-            }
-        }
-    )
+    query = DEFAULT_QUERY
+    if args.query:
+        with open(args.query) as f:
+            query = json.load(f)
+
+    if args.method == "percentiles":
+        total_docs, cutoffs = percentile_cutoffs(args.index, query, args.quantiles)
+    else:
+        total_docs, cutoffs = histogram_cutoffs(args.index, query, args.quantiles, args.resolution)
 
-    total_docs = res["count"]
+    print(f"Documentos: {total_docs}")
+    for quantile, (cutoff_date, train_docs) in zip(args.quantiles, cutoffs):
+        if cutoff_date is None:
+            print(f"Cuantil {quantile}: sin documentos")
+            continue
+        train = f"{train_docs} docs ({train_docs/total_docs:.2%})" if train_docs is not None else "aprox."
+        test = f"{total_docs - train_docs} docs" if train_docs is not None else "aprox."
+        print(f"Fecha con el {quantile:.0%} de los documentos: {dt.utcfromtimestamp(cutoff_date).strftime('%d-%m-%Y %H:%M:%S')}"
+              f" - Timestamp: {cutoff_date} | train (<= corte): {train}, test (> corte): {test}")
 
-    # Extraer el timestamp mínimo y máximo de la colección
-    res = es.search(index=args.index,
-        body = {
-            "size":0,
-            # La query se usa si queremos sacar la fecha del 80% de una de las muestras en vez de la totalidad del índice
-            "query":{
-                "match":{
-                    "lonely": True
-                }
-            },
-            "aggs":{
-                "oldest_date":{
-                    "min":{
-                        "field": "created_utc"
-                    }
-                },
-                "newest_date":{
-                    "max": {
-                        "field": "created_utc"
+
+def histogram_cutoffs(index, query, quantiles, resolution=3600):
+    """
+        Obtiene las fechas de corte a partir de un histograma de `created_utc`, acumulando los buckets localmente.
+        Es exacto hasta la resolución del histograma: la fecha de corte es el último segundo del primer bucket en el que
+        la proporción acumulada de documentos alcanza el cuantil. Sólo se piden los buckets con documentos, para no
+        superar el límite `search.max_buckets` en rangos de varios años, y el total es la suma de sus documentos.
+
+        Parámetros
+        ----------
+        index: str
+            \tNombre del índice sobre el que trabajar
+        query: dict
+            \tConsulta que filtra los documentos a tener en cuenta
+        quantiles: list
+            \tCuantiles a calcular, entre 0 y 1
+        resolution: int
+            \tTamaño de los buckets en segundos
+
+        Salida
+        ------
+        int
+            \tNúmero total de documentos
+        list
+            \tTuplas (timestamp de corte, documentos hasta el corte) de cada cuantil
+    """
+    res = es.search(index=index,
+        body={
+            "size": 0,
+            "query": query,
+            "aggs": {
+                "dates": {
+                    "histogram": {
+                        "field": "created_utc",
+                        "interval": resolution,
+                        "min_doc_count": 1
                     }
                 }
             }
         }
     )
-    oldest_date = int(res["aggregations"]["oldest_date"]["value"])
-    newest_date = int(res["aggregations"]["newest_date"]["value"])
-
-    str_oldest_date = dt.utcfromtimestamp(oldest_date).strftime("%d-%m-%Y %H:%M:%S")
-    str_newest_date = dt.utcfromtimestamp(newest_date).strftime("%d-%m-%Y %H:%M:%S")
-    print("Fecha más antigua: " + str_oldest_date)
-    print("Fecha más reciente: " + str_newest_date)
-
-    # Se obtiene la fecha correspondiente al 80% de documentos
-    cutoff_date = recursive(oldest_date, newest_date, args.index, 0.0001)
-    
-    print(f"Fecha con el 80% de los documentos : {dt.utcfromtimestamp(cutoff_date).strftime('%d-%m-%Y')} - Timestamp: {cutoff_date}")
-
-
-def recursive(old_date, new_date, index, tolerance):
+    buckets = res["aggregations"]["dates"]["buckets"]
+    total_docs = sum(bucket["doc_count"] for bucket in buckets)
+
+    cutoffs = []
+    for quantile in quantiles:
+        cumulative = 0
+        cutoff = (None, None)
+        for bucket in buckets:
+            cumulative += bucket["doc_count"]
+            if cumulative >= quantile*total_docs:
+                cutoff = (int(bucket["key"]) + resolution - 1, cumulative)
+                break
+        cutoffs.append(cutoff)
+    return total_docs, cutoffs
+
+
+def percentile_cutoffs(index, query, quantiles):
     """
-        Busca recursivamente la fecha que contenga el 80% de documentos del índice
+        Obtiene las fechas de corte aproximadas con una agregación `percentiles` sobre `created_utc`. El total es el
+        número de documentos con `created_utc`, los mismos sobre los que se calculan los percentiles
 
         Parámetros
         ----------
-        old_date: int  
-            \tTimestamp de la fecha más antigua del intervalo a tratar
-        new_date: int  
-            \tTimestamp de la fecha más reciente del intervalo a tratar
-        index: str  
+        index: str
             \tNombre del índice sobre el que trabajar
-        tolerance: float  
-            \tTolerancia de la condición de parada. Por ejemplo, para una tolerancia de 0.1 se admitirá cualquier fecha que contenga entre el 79% y el 81% de documentos
+        query: dict
+            \tConsulta que filtra los documentos a tener en cuenta
+        quantiles: list
+            \tCuantiles a calcular, entre 0 y 1
 
         Salida
         ------
-        int  
-            \tTimestamp de la fecha objetivo
+        int
+            \tNúmero total de documentos
+        list
+            \tTuplas (timestamp de corte, None) de cada cuantil: el número de documentos hasta el corte es desconocido
     """
-    # Se toma la fecha intermedia entre las dos dadas como límites del intervalo y se cuentan los documentos que hay en ésta
-    next_date = (old_date + new_date)//2
-    res = es.count(index=index,
+    res = es.search(index=index,
         body={
-            "query": {
-                "bool":{
-                    "must": [
-                        # La cláusula match se usa si queremos restringir la búsqueda a un subset del índice
-                        {"match":{
-                            "lonely": True
-                        }},
-                        {"range":{
-                            "created_utc":{
-                                "lte": next_date
-                            }
-                        }}
-                    ]
+            "size": 0,
+            "query": query,
+            "aggs": {
+                "total": {
+                    "value_count": {
+                        "field": "created_utc"
+                    }
+                },
+                "dates": {
+                    "percentiles": {
+                        "field": "created_utc",
+                        "percents": [quantile*100 for quantile in quantiles],
+                        "keyed": False
+                    }
                 }
             }
         }
     )
-    doc_count = res["count"]
-
-    ratio = abs(doc_count/total_docs)
-    print(f"\t Fecha: {dt.utcfromtimestamp(next_date).strftime('%d-%m-%Y')}, Porcentaje del dataset: {ratio}")
-    
-    # Condición de parada 
-    if abs(ratio - 0.8) <= tolerance:
-        return next_date
-    # Si no se satisface la condición de parada, se busca en un intervalo más cerrado, utilizando la fecha intermedia como nuevo límite    
-    elif ratio < 0.8:
-        return recursive(next_date, new_date, index, tolerance)
-    else:
-        return recursive(old_date, next_date, index, tolerance)
-    
+    total_docs = int(res["aggregations"]["total"]["value"])
+    values = res["aggregations"]["dates"]["values"]
+    return total_docs, [(int(value["value"]) if value["value"] is not None else None, None) for value in values]
+
 
 def parse_args():
     """
         Procesamiento de los argumentos con los que se ejecutó el script
     """
     parser = argparse.ArgumentParser(
-        description="Script para obtener la fecha que contiene el 80% de documentos de un índice de Elasticsearch")
+        description="Script para obtener las fechas que separan los documentos de un índice de Elasticsearch en los cuantiles indicados")
     parser.add_argument("index", help="Índice de Elasticsearch")
     parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch")
+    parser.add_argument("-q", "--quantiles", type=float, nargs="+", default=[0.8], help="Cuantiles a calcular, entre 0 y 1")
+    parser.add_argument("--query", help="Fichero JSON con la consulta que filtra los documentos")
+    parser.add_argument("-m", "--method", choices=["histogram", "percentiles"], default="histogram",
+                        help="Histograma exacto hasta la resolución indicada o percentiles aproximados")
+    parser.add_argument("-r", "--resolution", type=int, default=3600, help="Tamaño de los buckets del histograma, en segundos")
 
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main(parse_args())
\ No newline at end of file
+    main(parse_args())
@@ -4,8 +4,8 @@
 
     Parámetros
     ----------
-    * training: fichero con el dataset de entrenamiento
-    * testing: fichero con el dataset de test
+    * training: fichero con el dataset de entrenamiento. Puede estar comprimido (.gz, .zst, .xz o .bz2)
+    * testing: fichero con el dataset de test. Puede estar comprimido
     * -v, --vocab-size: Número de términos más frecuentes a incluir en el vocabulario. 
     * -s, --seed: semilla a utilizar para la generación de números pseudoaleatorios. Opcional.
     * --stem: aplica estemetización en el preprocesado de texto
@@ -13,6 +13,7 @@
 """
 
 import os
+import io
 import json
 import string
 import numpy as np
@@ -23,6 +24,7 @@ import pickle
 import joblib
 from pprint import pprint
 from datetime import datetime as dt
+from contextlib import contextmanager
 
 from nltk.stem import PorterStemmer
 from collections import Counter
@@ -34,6 +36,8 @@ from sklearn import svm
 from scipy import sparse as sp
 
 from src.classify.model_stats import get_stats
+from src.utils.file_handler import open_compressed
+from src.utils.pipeline import read_manifest
 
 __author__="Samuel Cifuentes García"
 
@@ -210,7 +214,7 @@ def create_vocabulary(path, num_docs, stem):
             \tLista de n términos más frecuentes del dataset
     """
     word_list = []
-    with open(path, encoding="UTF-8") as f:
+    with open_dataset(path) as f:
         # Barra de progreso
         bar = pb.ProgressBar(max_value=num_docs)
         for line in bar(f):
@@ -250,7 +254,7 @@ def get_tags(path, num_docs):
     doc_id = 0
 
     bar = pb.ProgressBar(max_value=num_docs)
-    with open(path, encoding="UTF-8") as f:
+    with open_dataset(path) as f:
         for line in bar(f):
             tag = json.loads(line)["_source"]["lonely"]
             matrix[doc_id] = int(tag)
@@ -301,7 +305,7 @@ def extract_features(path, vocabulary, num_docs, stem):
 
     bar = pb.ProgressBar(max_value=num_docs)
     indptr.append(0)
-    with open(path, encoding="UTF-8") as f:
+    with open_dataset(path) as f:
         for line in bar(f):
             data = json.loads(line)["_source"]
             word_list = preprocess_text(data, stem)
@@ -374,7 +378,8 @@ def preprocess_text(data, stem):
 
 def file_length(path):
     """
-        Cuenta el número de documentos en un fichero
+        Cuenta el número de documentos en un fichero. Si el fichero tiene manifiesto (por ejemplo, los que genera
+        `export_splits.py`), se toma de éste sin recorrer el fichero
 
         Parámetros
         ----------
@@ -386,12 +391,39 @@ def file_length(path):
         int
             \tNúmero de documentos en el fichero
     """
-    with open(path, encoding="UTF-8") as f:
+    manifest = read_manifest(path)
+    if manifest is not None:
+        return manifest["documents"]
+
+    with open_dataset(path) as f:
         for i, _ in enumerate(f):
             pass
         return i+1
 
 
+@contextmanager
+def open_dataset(path):
+    """
+        Abre un dataset en modo texto, descomprimiéndolo en streaming si está comprimido (.gz, .zst, .xz o .bz2)
+
+        Parámetros
+        ----------
+        path: str
+            \tRuta del dataset
+
+        Salida
+        ------
+        file
+            \tFichero de texto
+    """
+    f, raw = open_compressed(path)
+    try:
+        yield io.TextIOWrapper(f, encoding="UTF-8")
+    finally:
+        f.close()
+        raw.close()
+
+
 def parse_args():
     """
         Procesamiento de los argumentos con los que se ejecutó el script
@@ -0,0 +1,257 @@
+"""
+    Envío de peticiones bulk con tamaño adaptativo
+    ----------------------------------------------
+    Los posts de Reddit ocupan desde unos cientos de bytes hasta decenas de KB, por lo que fijar el número de documentos
+    por petición bulk da lugar a peticiones de tamaños muy dispares, que acaban en errores 413/429 o en timeouts.
+    En su lugar, se fija un presupuesto de bytes por petición que se ajusta en función de la latencia observada
+    y de los rechazos del clúster. Los documentos rechazados por saturación (429) se reintentan con espera exponencial
+    en lugar de contarse como errores definitivos.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import methodcaller
+import threading
+import time
+
+from elasticsearch import ConnectionTimeout, TransportError
+from elasticsearch.helpers import expand_action
+
+__author__ = "Samuel Cifuentes García"
+
+
+class BulkAutotuner:
+    """
+        Envía acciones bulk en peticiones de un tamaño en bytes que se adapta a la respuesta del clúster.
+        Un mismo autotuner puede compartirse entre varios indexers e hilos.
+
+        * Si una petición tarda menos de la mitad de la latencia objetivo y no hay rechazos, el presupuesto crece.
+        * Si tarda más de la latencia objetivo, hay rechazos (429) o se agota el tiempo, el presupuesto se reduce.
+        * Si el clúster responde que la petición es demasiado grande (413), se divide en dos y se reduce el presupuesto.
+
+        Atributos
+        ---------
+        target_bytes: int
+            \tPresupuesto actual de bytes por petición
+        min_bytes: int
+            \tPresupuesto mínimo
+        max_bytes: int
+            \tPresupuesto máximo
+        target_latency: float
+            \tLatencia objetivo de cada petición, en segundos
+        max_retries: int
+            \tNúmero máximo de reintentos de un documento rechazado
+        initial_backoff: float
+            \tEspera inicial antes de reintentar, en segundos. Se duplica en cada reintento
+        max_backoff: float
+            \tEspera máxima antes de reintentar
+        stats: dict
+            \tPeticiones enviadas, reintentos, divisiones de peticiones y ajustes del presupuesto
+    """
+
+    def __init__(self, target_bytes=5*1024*1024, min_bytes=256*1024, max_bytes=50*1024*1024, target_latency=5,
+                 max_retries=8, initial_backoff=1, max_backoff=120, request_timeout=200):
+        self.target_bytes = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.stats = {"requests": 0, "retried": 0, "split": 0, "grown": 0, "shrunk": 0}
+        self.lock = threading.Lock()
+
+    def send(self, client, actions):
+        """
+            Indexa una lista o iterable de acciones de forma secuencial
+
+            Parámetros
+            ----------
+            client: Elasticsearch
+                \tConexión con la que enviar las peticiones
+            actions: iterable
+                \tAcciones bulk, en el mismo formato que admiten los helpers de Elasticsearch
+
+            Salida
+            ------
+            int
+                \tNúmero de documentos indexados correctamente
+            list
+                \tErrores definitivos, en el mismo formato que los helpers de Elasticsearch
+        """
+        indexed, errors = 0, []
+        for chunk in self.chunks(client, actions):
+            chunk_indexed, chunk_errors = self.send_chunk(client, chunk)
+            indexed += chunk_indexed
+            errors += chunk_errors
+        return indexed, errors
+
+    def send_parallel(self, client, actions, thread_count=4):
+        """
+            Indexa un iterable de acciones manteniendo hasta `thread_count` peticiones en vuelo.
+            Los resultados se devuelven en el mismo orden que las acciones.
+
+            Parámetros
+            ----------
+            client: Elasticsearch
+                \tConexión con la que enviar las peticiones
+            actions: iterable
+                \tAcciones bulk
+            thread_count: int
+                \tNúmero máximo de peticiones simultáneas
+
+            Salida
+            ------
+            generator
+                \tPara cada petición, una tupla con el número de acciones, los documentos indexados y los errores
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            for chunk in self.chunks(client, actions):
+                pending.append((len(chunk), executor.submit(self.send_chunk, client, chunk)))
+                if len(pending) >= thread_count:
+                    size, future = pending.popleft()
+                    yield (size,) + future.result()
+            while pending:
+                size, future = pending.popleft()
+                yield (size,) + future.result()
+
+    def chunks(self, client, actions):
+        """
+            Generador que serializa las acciones una única vez y las agrupa según el presupuesto de bytes vigente
+
+            Parámetros
+            ----------
+            client: Elasticsearch
+                \tConexión cuyo serializador se utiliza
+            actions: iterable
+                \tAcciones bulk
+
+            Salida
+            ------
+            generator
+                \tListas de acciones serializadas, como tuplas (bytes, líneas, acción original)
+        """
+        serializer = client.transport.serializer
+        chunk, chunk_bytes = [], 0
+        for action in actions:
+            meta, data = expand_action(action)
+            lines = [serializer.dumps(meta)]
+            if data is not None:
+                lines.append(serializer.dumps(data))
+            size = sum(len(line.encode("utf-8")) + 1 for line in lines)
+
+            if chunk and chunk_bytes + size > self.target_bytes:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append((size, lines, action))
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def send_chunk(self, client, chunk):
+        """
+            Envía un bloque de acciones serializadas, reintentando los rechazos y ajustando el presupuesto
+
+            Parámetros
+            ----------
+            client: Elasticsearch
+                \tConexión con la que enviar la petición
+            chunk: list
+                \tAcciones serializadas tal y como las genera `chunks`
+
+            Salida
+            ------
+            int
+                \tNúmero de documentos indexados correctamente
+            list
+                \tErrores definitivos
+        """
+        indexed, errors = 0, []
+        # Cada sub-bloque pendiente lleva sus propios intentos: los reintentos de una mitad no agotan los de la otra
+        pending = [(chunk, 0)]
+        while pending:
+            current, attempt = pending.pop()
+            body = "\n".join(line for _, lines, _ in current for line in lines) + "\n"
+            with self.lock:
+                self.stats["requests"] += 1
+            start = time.perf_counter()
+            try:
+                res = client.bulk(body=body, request_timeout=self.request_timeout)
+            except TransportError as e:
+                timeout = isinstance(e, ConnectionTimeout)
+                # Demasiado trabajo o demasiados bytes para una sola petición: se reduce y se reintenta dividida
+                if (timeout or e.status_code == 413) and len(current) > 1:
+                    self._shrink()
+                    pending.extend((half, attempt) for half in self._split(current))
+                    continue
+                if (timeout or e.status_code == 429) and attempt < self.max_retries:
+                    self._shrink()
+                    self._backoff(attempt)
+                    pending.append((current, attempt + 1))
+                    continue
+                # Error definitivo: todas las acciones del bloque fallan. Se conserva el índice de cada acción para
+                # poder atribuir el error, como en los errores que devuelve Elasticsearch por documento
+                for _, _, action in current:
+                    info = {"status": e.status_code, "error": str(e), "exception": e}
+                    if isinstance(action, dict):
+                        info.update({key: action[key] for key in ("_index", "_type", "_id") if key in action})
+                    errors.append({"index": info})
+                continue
+            latency = time.perf_counter() - start
+
+            rejected = []
+            for entry, item in zip(current, map(methodcaller("popitem"), res["items"])):
+                op_type, info = item
+                status = info.get("status", 500)
+                if 200 <= status < 300:
+                    indexed += 1
+                elif status == 429 and attempt < self.max_retries:
+                    rejected.append(entry)
+                else:
+                    errors.append({op_type: info})
+
+            self._adjust(latency, bool(rejected))
+            if rejected:
+                self._backoff(attempt)
+                with self.lock:
+                    self.stats["retried"] += len(rejected)
+                pending.append((rejected, attempt + 1))
+        return indexed, errors
+
+    def _split(self, chunk):
+        """
+            Divide un bloque de acciones en dos mitades
+        """
+        with self.lock:
+            self.stats["split"] += 1
+        half = max(1, len(chunk)//2)
+        return [chunk[half:], chunk[:half]] if chunk[half:] else [chunk]
+
+    def _adjust(self, latency, rejected):
+        """
+            Ajusta el presupuesto de bytes según la latencia de una petición y si hubo rechazos
+        """
+        if rejected or latency > self.target_latency:
+            self._shrink()
+        elif latency < self.target_latency/2:
+            with self.lock:
+                if self.target_bytes < self.max_bytes:
+                    self.target_bytes = min(self.max_bytes, int(self.target_bytes*1.25))
+                    self.stats["grown"] += 1
+
+    def _shrink(self):
+        """
+            Reduce el presupuesto de bytes a la mitad, sin bajar del mínimo
+        """
+        with self.lock:
+            if self.target_bytes > self.min_bytes:
+                self.target_bytes = max(self.min_bytes, self.target_bytes//2)
+                self.stats["shrunk"] += 1
+
+    def _backoff(self, attempt):
+        """
+            Espera exponencial antes de un reintento
+        """
+        time.sleep(min(self.max_backoff, self.initial_backoff * 2**attempt))
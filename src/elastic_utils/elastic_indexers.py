@@ -1,9 +1,24 @@
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from contextlib import contextmanager
+from collections import Counter
+import json
+import threading
+from src.elastic_utils.filters import DocumentFilter
+from src.utils.instrumentation import InstrumentedClient
 import progressbar as pb
 
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 __author__ = "Samuel Cifuentes García"
 
+# Script de la pipeline de ingesta que proyecta en el servidor los documentos enviados en modo passthrough.
+# Se eliminan las claves que no están en la lista de campos, salvo los metadatos (_index, _id...)
+PROJECTION_SCRIPT = "ctx.keySet().removeIf(key -> !key.startsWith('_') && !params.fields.contains(key))"
+
 
 class Indexer:
     """
@@ -22,6 +37,9 @@ class Indexer:
         serán excluidos
         ```
 
+        El filtro se compila una única vez en un `DocumentFilter`, que admite también reglas de inclusión
+        y rangos numéricos.
+
         Atributos
         ---------
         es: Elasticsearch
@@ -30,13 +48,63 @@ class Indexer:
             \tNombre del índice con el que trabajará el indexer
         filter_criteria: dict  
             \tDiccionario con los filtros a aplicar. Opcional.
+        filter: DocumentFilter  
+            \tFiltro compilado a partir de `filter_criteria`
+        project_mapping: bool  
+            \tSi se activa, sólo se envían los campos presentes en el mapeo del índice (salvo los de `SERVER_FIELDS`)
+            más los de `keep_fields`, en lugar de la lista completa de `FIELDS`. Opcional.
+        keep_fields: list  
+            \tCampos no mapeados que se quieren conservar en el `_source` con `project_mapping`. Opcional.
+        fields: tuple  
+            \tCampos que se envían de cada documento, calculados una única vez al crear el indexer
+        metrics: Metrics  
+            \tMétricas donde se registran la latencia de las peticiones bulk, los documentos indexados y los errores
+            por tipo. Opcional.
+        autotune: BulkAutotuner  
+            \tSi se indica, las peticiones bulk se dimensionan por bytes y se adaptan a la latencia y los rechazos del
+            clúster, en lugar de enviar un número fijo de documentos. Opcional.
+        passthrough: bool  
+            \tSi se activa, `process_raw` envía las líneas de los backups tal cual, sin decodificarlas ni volver a
+            serializarlas, y la proyección se hace en el servidor con una pipeline de ingesta. Opcional.
+        pipeline: str  
+            \tPipeline de ingesta por la que pasan los documentos en modo passthrough. Por defecto,
+            `<index_name>-projection`, creada con `create_pipeline`.
     """
 
-    def __init__(self, connection, index_name, filter_criteria=None):
+    # Lista de campos que queremos conservar
+    FIELDS = ["author", "category", "content_categories", "created_utc", "domain", "downs", "gilded", "likes",
+              "name", "num_comments", "num_reports", "over_18", "permalink", "post_categories", "removal_reason", "report_reasons",
+              "retrieved_on", "score", "selftext", "selftext_html", "subreddit", "subreddit_id", "subreddit_type", "title",
+              "ups", "url", "user_reports", "query", "scale", "lonely"]
+    # Campos que se descargan de la API de Pushshift: los anteriores salvo los que añaden los scripts
+    API_FIELDS = ["id"] + [field for field in FIELDS if field not in ("query", "scale", "lonely")]
+    # Campos del mapeo que sólo se escriben en el servidor (`purge_relabel.py`) y que la proyección no envía
+    SERVER_FIELDS = ["tagged"]
+
+    def __init__(self, connection, index_name, filter_criteria=None, project_mapping=False, keep_fields=None, metrics=None, autotune=None,
+                 passthrough=False, pipeline=None):
         self.es = connection
+        self.metrics = metrics
+        self.autotune = autotune
+        # Las peticiones bulk pasan por un envoltorio que mide su latencia si se instrumenta el indexer
+        self.bulk_client = InstrumentedClient(connection, metrics) if metrics else connection
         self.index_name = index_name
-        self.stats = {"indexed": 0, "errors": 0, "filtered": 0}
-        self.filter = filter_criteria
+        self.stats = {"indexed": 0, "errors": 0, "filtered": 0, "bytes_saved": 0}
+        self.filter = DocumentFilter(filter_criteria) if filter_criteria else None
+
+        # La proyección se construye una sola vez por indexer
+        if project_mapping:
+            mapped = [field for field in self.get_mappings()["properties"] if field not in self.SERVER_FIELDS]
+            self.fields = tuple(mapped + [field for field in keep_fields or [] if field not in mapped])
+        else:
+            self.fields = tuple(self.FIELDS)
+        # Campos de FIELDS que la proyección deja fuera, para estimar los bytes ahorrados
+        self.dropped_fields = tuple(field for field in self.FIELDS if field not in self.fields)
+
+        self.passthrough = passthrough
+        self.pipeline = pipeline or index_name + "-projection"
+        # En modo passthrough sólo se extraen de cada línea el id y los campos del filtro
+        self.raw_fields = ("id",) + tuple(sorted(set(rule[1] for rule in self.filter.rules))) if self.filter else ("id",)
 
     def create_index(self):
         """
@@ -69,7 +137,14 @@ class Indexer:
         self.es.indices.create(index=self.index_name,
                                body=arguments)
 
-        mappings = {
+        self.es.indices.put_mapping(
+            index=self.index_name, doc_type="post", body=self.get_mappings(),  include_type_name=True)
+
+    def get_mappings(self):
+        """
+            Mapeo de los campos del índice. Sólo los campos aquí incluidos se indexan, ya que el mapeo no es dinámico.
+        """
+        return {
             "dynamic": False,
             "properties": {
                 "title": {
@@ -135,60 +210,226 @@ class Indexer:
                 },
                 "lonely": {
                     "type": "keyword"
+                },
+                # Etiqueta que añade src/purge_relabel.py a los posts de los subreddits a etiquetar
+                "tagged": {
+                    "type": "keyword"
                 }
             }
         }
-        self.es.indices.put_mapping(
-            index=self.index_name, doc_type="post", body=mappings,  include_type_name=True)
 
     def index_documents(self, documents):
         """
             Indexa una lista de posts de Reddit. Nos quedamos con los campos que nos interesan.
             Si el indexer se instanción con filtros, excluimos aquellos documentos afectados.
         """
-        toIndex = []
-        # Lista de campos que queremos conservar
-        fields = ["author", "category", "content_categories", "created_utc", "domain", "downs", "gilded", "likes",
-                  "name", "num_comments", "num_reports", "over_18", "permalink", "post_categories", "removal_reason", "report_reasons",
-                  "retrieved_on", "score", "selftext", "selftext_html", "subreddit", "subreddit_id", "subreddit_type", "title",
-                  "ups", "url", "user_reports", "query", "scale", "lonely"]
+        self.index_actions(list(self.process_documents(documents)))
+
+    def index_actions(self, actions):
+        """
+            Envía a Elasticsearch una lista de acciones bulk ya preparadas, por ejemplo, generadas
+            con `process_documents` en otro proceso.
+
+            Parámetros
+            ----------
+            actions: list  
+                \tLista de acciones a indexar
+        """
+        if self.autotune:
+            bulk_stats = self.autotune.send(self.bulk_client, actions)
+        else:
+            bulk_stats = helpers.bulk(self.bulk_client, actions, chunk_size=len(
+                actions), request_timeout=200, raise_on_error=False)
+        self.stats["indexed"] += bulk_stats[0]
+        self.stats["errors"] += len(bulk_stats[1])
+        if self.metrics:
+            self.metrics.count("docs", bulk_stats[0])
+            for error in bulk_stats[1]:
+                self.metrics.record_error(error)
+
+    def index_documents_streaming(self, documents, chunk_size=500, thread_count=4, queue_size=4):
+        """
+            Indexa un iterable de posts de Reddit de forma perezosa. Los documentos se van procesando
+            a medida que se consumen y se envían en peticiones bulk de `chunk_size` documentos desde un
+            pool de hilos, de modo que la lectura de los datos y el trabajo de Elasticsearch se solapan.
+            Se actualizan las mismas estadísticas que en `index_documents`.
+
+            Parámetros
+            ----------
+            documents: iterable  
+                \tIterable (lista, generador...) con los posts a indexar
+            chunk_size: int  
+                \tNúmero de documentos por petición bulk
+            thread_count: int  
+                \tNúmero de hilos que envían peticiones, es decir, peticiones simultáneas en vuelo
+            queue_size: int  
+                \tNúmero de bloques preparados en espera de ser enviados
+        """
+        self.index_actions_streaming(self.process_documents(documents), chunk_size=chunk_size,
+                                     thread_count=thread_count, queue_size=queue_size)
+
+    def index_actions_streaming(self, actions, chunk_size=500, thread_count=4, queue_size=4, progress=None):
+        """
+            Equivalente a `index_documents_streaming` para un iterable de acciones bulk ya preparadas.
+
+            Parámetros
+            ----------
+            actions: iterable  
+                \tIterable con las acciones a indexar
+            chunk_size: int  
+                \tNúmero de documentos por petición bulk
+            thread_count: int  
+                \tNúmero de peticiones simultáneas en vuelo
+            queue_size: int  
+                \tNúmero de bloques preparados en espera de ser enviados
+            progress: function  
+                \tOpcional. Se invoca con el número de acciones procesadas por Elasticsearch hasta el momento.
+                Las respuestas llegan en el mismo orden que las acciones.
+        """
+        if self.autotune:
+            self._index_actions_autotuned(actions, thread_count, progress)
+            return
+
+        processed = 0
+        for ok, info in helpers.parallel_bulk(self.bulk_client, actions, thread_count=thread_count, chunk_size=chunk_size,
+                                              queue_size=queue_size, request_timeout=200, raise_on_error=False):
+            if ok:
+                self.stats["indexed"] += 1
+                if self.metrics:
+                    self.metrics.count("docs")
+            else:
+                self.stats["errors"] += 1
+                if self.metrics:
+                    self.metrics.record_error(info)
+            processed += 1
+            if progress:
+                progress(processed)
 
+    def _index_actions_autotuned(self, actions, thread_count, progress):
+        """
+            Variante de `index_actions_streaming` que envía las peticiones a través del autotuner
+        """
+        processed = 0
+        for size, indexed, errors in self.autotune.send_parallel(self.bulk_client, actions, thread_count=thread_count):
+            self.stats["indexed"] += indexed
+            self.stats["errors"] += len(errors)
+            if self.metrics:
+                self.metrics.count("docs", indexed)
+                for error in errors:
+                    self.metrics.record_error(error)
+            processed += size
+            if progress:
+                progress(processed)
+
+    def process_documents(self, documents):
+        """
+            Generador que transforma posts de Reddit en acciones bulk, quedándonos con los campos que nos interesan.
+            Si el indexer se instanció con filtros, excluimos aquellos documentos afectados.
+            Con `project_mapping`, se acumulan en `stats["bytes_saved"]` los bytes que ocuparían los campos descartados.
+
+            Parámetros
+            ----------
+            documents: iterable  
+                \tIterable con los posts a procesar
+
+            Salida
+            ------
+            generator  
+                \tAcciones listas para ser enviadas con los helpers de bulk
+        """
         for document in documents:
             # Si se instanció el indexer con filtros, los aplicamos aquí
-            filter_flag = False # Indica si el post se debe excluir o no
-            if self.filter:
-                # El filtro es un diccionario con campos, donde para cada campo se incluye
-                # la lista de valores a excluir.
-                '''
-                    Ejemplo de filtro. Aquellos posts donde algún valor de los campos indicados
-                    encaje con los valores de las listas correspondientes serán excluidos.
-                    self.filter = {
-                        "subreddit": ["lonely", "loneliness", "ForeverAlone"],
-                        "author": ["pepito", "manolito"]
+            if self.filter and self.filter.drops(document):
+                self.stats["filtered"] += 1
+                continue
+
+            # Si no se excluye el post lo seguimos procesando
+            processed_post = {
+                "_index": self.index_name,
+                "_type": "post",
+                "_id": document.get("id")
+            }
+
+            for field in self.fields:
+                processed_post[field] = document.get(field)
+
+            if self.dropped_fields:
+                self.stats["bytes_saved"] += self.payload_size(document, self.dropped_fields)
+
+            yield processed_post
+
+    def process_raw(self, lines):
+        """
+            Generador que transforma líneas de un backup en acciones bulk sin decodificarlas por completo.
+            De cada línea sólo se extraen el id y los campos del filtro, y se envía tal cual como `_source`,
+            de modo que no se vuelve a serializar. La proyección de los campos la hace la pipeline de ingesta.
+
+            Parámetros
+            ----------
+            lines: iterable  
+                \tLíneas en bytes, cada una con un post en JSON
+
+            Salida
+            ------
+            generator  
+                \tAcciones listas para ser enviadas con los helpers de bulk
+        """
+        for line in lines:
+            document = extract_fields(line, self.raw_fields)
+            if self.filter and self.filter.drops(document):
+                self.stats["filtered"] += 1
+                continue
+
+            yield {
+                "_index": self.index_name,
+                "_type": "post",
+                "_id": document["id"],
+                "_source": line.decode("utf-8").rstrip(),
+                "pipeline": self.pipeline
+            }
+
+    def create_pipeline(self):
+        """
+            Crea (o actualiza) la pipeline de ingesta que se queda con los campos del indexer en modo passthrough
+        """
+        self.es.ingest.put_pipeline(id=self.pipeline, body={
+            "description": "Proyección de los posts de " + self.index_name,
+            "processors": [
+                {
+                    "script": {
+                        "lang": "painless",
+                        "source": PROJECTION_SCRIPT,
+                        "params": {"fields": list(self.fields)}
                     }
-                '''
-                for field in self.filter:
-                    if not filter_flag and document.get(field) in self.filter[field]:
-                        filter_flag = True
-                        self.stats["filtered"] += 1
-
-            # Si no se excluye el post lo seguimos procesando            
-            if not filter_flag:
-                processed_post = {
-                    "_index": self.index_name,
-                    "_type": "post",
-                    "_id": document.get("id")
                 }
+            ]
+        })
 
-                for field in fields:
-                    processed_post[field] = document.get(field)
+    @staticmethod
+    def payload_size(document, fields):
+        """
+            Estima los bytes que ocupan unos campos de un documento una vez serializados en JSON.
+            Para los textos se toma su longitud, evitando serializarlos de nuevo.
 
-                toIndex.append(processed_post)
+            Parámetros
+            ----------
+            document: dict  
+                \tDocumento
+            fields: iterable  
+                \tCampos a medir
 
-        bulk_stats = helpers.bulk(self.es, toIndex, chunk_size=len(
-            toIndex), request_timeout=200, raise_on_error=False)
-        self.stats["indexed"] += bulk_stats[0]
-        self.stats["errors"] += len(bulk_stats[1])
+            Salida
+            ------
+            int  
+                \tTamaño aproximado en bytes
+        """
+        size = 0
+        for field in fields:
+            value = document.get(field)
+            # "campo": valor, 
+            size += len(field) + 6
+            size += len(value) + 2 if isinstance(value, str) else len(json.dumps(value))
+        return size
 
     def index_exists(self):
         """
@@ -196,6 +437,80 @@ class Indexer:
         """
         return self.es.indices.exists(index=self.index_name)
 
+    @contextmanager
+    def bulk_load(self, force_merge=False, max_num_segments=1):
+        """
+            Contexto para cargas masivas. Mientras dura se desactivan los refrescos y las réplicas del índice,
+            de forma que las peticiones bulk no pagan por ellos. Al salir se restauran los valores originales,
+            se refresca el índice y, opcionalmente, se fusionan sus segmentos.
+
+                with indexer.bulk_load():
+                    indexer.index_documents(posts)
+
+            Parámetros
+            ----------
+            force_merge: bool  
+                \tIndica si se lanza un force-merge al terminar
+            max_num_segments: int  
+                \tNúmero de segmentos por shard tras el force-merge
+        """
+        res = self.es.indices.get_settings(index=self.index_name,
+                                           name=["index.refresh_interval", "index.number_of_replicas"])
+        original = res[self.index_name]["settings"].get("index", {})
+        # Si el índice usa los valores por defecto no aparecen en la respuesta. Con None se restablecen
+        restore = {
+            "refresh_interval": original.get("refresh_interval"),
+            "number_of_replicas": original.get("number_of_replicas")
+        }
+
+        self.es.indices.put_settings(index=self.index_name,
+                                     body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        try:
+            yield self
+        finally:
+            self.es.indices.put_settings(index=self.index_name, body={"index": restore})
+            self.es.indices.refresh(index=self.index_name)
+            if force_merge:
+                self.es.indices.forcemerge(index=self.index_name, max_num_segments=max_num_segments,
+                                           request_timeout=3600)
+
+
+# Un parser de simdjson por hilo: cada parser sólo mantiene vivo el último documento
+_parsers = threading.local()
+
+def extract_fields(line, fields):
+    """
+        Extrae unos pocos campos de una línea JSON. Si está instalado pysimdjson, el documento se analiza de forma
+        perezosa y sólo se materializan los campos pedidos; si no, se decodifica con `json.loads`.
+
+        Parámetros
+        ----------
+        line: bytes  
+            \tDocumento en JSON
+        fields: iterable  
+            \tCampos a extraer
+
+        Salida
+        ------
+        dict  
+            \tDiccionario con los campos pedidos. Los que no existen valen None
+    """
+    if simdjson is None:
+        document = json.loads(line)
+        return {field: document.get(field) for field in fields}
+
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = simdjson.Parser()
+    document = parser.parse(line)
+    extracted = {}
+    for field in fields:
+        value = document.get(field)
+        # Las listas y objetos se devuelven como vistas sobre el documento, que se invalidan con el siguiente
+        extracted[field] = value.as_list() if isinstance(value, simdjson.Array) else \
+            value.as_dict() if isinstance(value, simdjson.Object) else value
+    return extracted
+
 
 class NgramIndexer(Indexer):
     """
@@ -239,7 +554,14 @@ class NgramIndexer(Indexer):
             }
         }
         self.es.indices.create(index=self.index_name, body=arguments)
-        arguments = {
+        self.es.indices.put_mapping(
+            index=self.index_name, doc_type="post", body=self.get_mappings(), include_type_name=True)
+
+    def get_mappings(self):
+        """
+            Mapeo de los campos del índice, con el analizador de bigramas en los campos de texto
+        """
+        return {
             "dynamic": False,
             "properties": {
                 "title": {
@@ -305,11 +627,13 @@ class NgramIndexer(Indexer):
                 },
                 "lonely": {
                     "type": "keyword"
+                },
+                # Etiqueta que añade src/purge_relabel.py a los posts de los subreddits a etiquetar
+                "tagged": {
+                    "type": "keyword"
                 }
             }
         }
-        self.es.indices.put_mapping(
-            index=self.index_name, doc_type="post", body=arguments, include_type_name=True)
 
 class UserIndexer(Indexer):
     """
@@ -321,7 +645,14 @@ class UserIndexer(Indexer):
             Crea un índice de usuarios, incluyendo mapeo de los campos necesarios
         """
         self.es.indices.create(index=self.index_name)
-        mappings = {
+        self.es.indices.put_mapping(
+            index=self.index_name, body=self.get_mappings())
+
+    def get_mappings(self):
+        """
+            Mapeo de los campos del índice de usuarios
+        """
+        return {
             "dynamic": False,
             "properties": {
                 "name": {
@@ -344,8 +675,6 @@ class UserIndexer(Indexer):
                 }
             }
         }
-        self.es.indices.put_mapping(
-            index=self.index_name, body=mappings)
 
     def index_documents(self, documents, fields):
         """
@@ -370,7 +699,125 @@ class UserIndexer(Indexer):
         
             toIndex.append(processed_user)
             
-        bulk_stats = helpers.bulk(self.es, toIndex, chunk_size=len(
-            toIndex), request_timeout=200, raise_on_error=False)
-        self.stats["indexed"] += bulk_stats[0]
-        self.stats["errors"] += len(bulk_stats[1])
+        self.index_actions(toIndex)
+
+
+class MultiIndexer:
+    """
+        Escritor que indexa los mismos documentos en varios índices a la vez, por ejemplo, el de unigramas y el de bigramas.
+        Comprueba o crea cada índice una única vez, construye y serializa el cuerpo de cada documento una sola vez
+        (por cada conjunto de campos distinto) y envía las acciones de todos los índices en el mismo flujo bulk.
+        Cada indexer conserva sus propias estadísticas y filtros.
+
+        Atributos
+        ---------
+        indexers: list
+            \tIndexers destino. Las peticiones se envían con la conexión, métricas y autotuner del primero
+    """
+
+    def __init__(self, indexers):
+        self.indexers = indexers
+        self.sender = indexers[0]
+
+        for indexer in self.indexers:
+            if not indexer.index_exists():
+                print("Creado índice: " + indexer.index_name)
+                indexer.create_index()
+
+    def process_documents(self, documents):
+        """
+            Generador que transforma posts de Reddit en acciones bulk para todos los índices destino.
+            El `_source` de cada acción se serializa a JSON una única vez y se comparte entre los índices que
+            conservan los mismos campos.
+
+            Parámetros
+            ----------
+            documents: iterable  
+                \tIterable con los posts a procesar
+
+            Salida
+            ------
+            generator  
+                \tAcciones listas para ser enviadas con los helpers de bulk
+        """
+        serializer = self.sender.es.transport.serializer
+        for document in documents:
+            bodies = {}
+            for indexer in self.indexers:
+                if indexer.filter and indexer.filter.drops(document):
+                    indexer.stats["filtered"] += 1
+                    continue
+
+                if indexer.fields not in bodies:
+                    bodies[indexer.fields] = serializer.dumps({field: document.get(field) for field in indexer.fields})
+                    if indexer.dropped_fields:
+                        indexer.stats["bytes_saved"] += indexer.payload_size(document, indexer.dropped_fields)
+
+                yield {
+                    "_index": indexer.index_name,
+                    "_type": "post",
+                    "_id": document.get("id"),
+                    "_source": bodies[indexer.fields]
+                }
+
+    def index_documents(self, documents):
+        """
+            Indexa una lista de posts de Reddit en todos los índices destino con un único flujo bulk
+
+            Parámetros
+            ----------
+            documents: list  
+                \tLista de posts a indexar
+        """
+        actions = list(self.process_documents(documents))
+        sent = Counter(action["_index"] for action in actions)
+
+        if self.sender.autotune:
+            _, errors = self.sender.autotune.send(self.sender.bulk_client, actions)
+        else:
+            _, errors = helpers.bulk(self.sender.bulk_client, actions, chunk_size=len(
+                actions), request_timeout=200, raise_on_error=False)
+
+        failed = self._attribute_errors(actions, errors, sent)
+        for indexer in self.indexers:
+            indexer.stats["indexed"] += sent[indexer.index_name] - failed[indexer.index_name]
+            indexer.stats["errors"] += failed[indexer.index_name]
+        if self.sender.metrics:
+            self.sender.metrics.count("docs", len(actions) - len(errors))
+            for error in errors:
+                self.sender.metrics.record_error(error)
+
+    def _attribute_errors(self, actions, errors, sent):
+        """
+            Atribuye cada error a los índices destino a partir de las acciones enviadas. Un error cuyo `_index` no es
+            uno de los destinos (errores de la petición completa, o el nombre real de un índice tras un alias) cuenta
+            en todos los índices a los que se envió su documento, o en todos los destinos si tampoco tiene `_id`:
+            un documento nunca se da por indexado sin confirmación.
+
+            Parámetros
+            ----------
+            actions: list  
+                \tAcciones enviadas
+            errors: list  
+                \tErrores devueltos por el envío bulk
+            sent: Counter  
+                \tNúmero de acciones enviadas a cada índice
+
+            Salida
+            ------
+            Counter  
+                \tNúmero de errores de cada índice, como máximo el número de acciones enviadas a él
+        """
+        targets = {indexer.index_name for indexer in self.indexers}
+        sent_to = {}
+        for action in actions:
+            sent_to.setdefault(action["_id"], set()).add(action["_index"])
+
+        failed = Counter()
+        for error in errors:
+            info = next(iter(error.values()))
+            if info.get("_index") in targets:
+                failed[info["_index"]] += 1
+            else:
+                failed.update(sent_to.get(info.get("_id"), targets))
+        return Counter({index: min(count, sent[index]) for index, count in failed.items()})
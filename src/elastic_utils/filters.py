@@ -0,0 +1,147 @@
+"""
+    Filtros de documentos compilados, utilizados por los indexers para descartar posts antes de indexarlos
+"""
+
+from collections import Counter
+
+__author__ = "Samuel Cifuentes García"
+
+
+# Claves del diccionario que configuran el filtro en lugar de definir reglas
+OPTIONS = ("case_insensitive",)
+
+
+class DocumentFilter:
+    """
+        Filtro de documentos que se compila una única vez a partir de un diccionario. Los valores de cada regla
+        se almacenan en conjuntos, de modo que comprobar un documento tiene un coste constante por regla
+        independientemente del número de valores.
+
+        Admite el formato clásico de los indexers, donde cada campo tiene la lista de valores a excluir:
+        ```json
+        {
+            "subreddit": ["lonely", "loneliness", "ForeverAlone"],
+            "author": ["pepito", "manolito"]
+        }
+        ```
+
+        Y un formato extendido con reglas de exclusión, inclusión y rangos numéricos:
+        ```json
+        {
+            "exclude": {"subreddit": ["lonely", "loneliness"]},
+            "include": {"lang": ["en"]},
+            "range": {"created_utc": {"gte": 1546300800, "lt": 1577836800}},
+            "case_insensitive": true
+        }
+        ```
+
+        Un documento se descarta si algún campo de `exclude` coincide con uno de sus valores, si algún campo de
+        `include` no coincide con ninguno o si algún campo de `range` queda fuera del intervalo (o no existe).
+        Cuando el campo de un documento es una lista, basta con que uno de sus elementos coincida. Los valores no
+        hashables (diccionarios, listas anidadas) se comparan por igualdad en lugar de buscarse en el conjunto.
+
+        Atributos
+        ---------
+        rules: list
+            \tReglas compiladas, en forma de tuplas (nombre, campo, comprobación)
+        case_insensitive: bool
+            \tIndica si las comparaciones de texto ignoran mayúsculas y minúsculas
+        dropped: Counter
+            \tNúmero de documentos descartados por cada regla
+    """
+
+    def __init__(self, criteria):
+        extended = any(key in criteria for key in ("exclude", "include", "range"))
+        self.case_insensitive = bool(criteria.get("case_insensitive", False))
+        self.rules = []
+        self.dropped = Counter()
+
+        exclude = criteria.get("exclude", {}) if extended else {
+            field: values for field, values in criteria.items() if field not in OPTIONS}
+        for field, values in exclude.items():
+            self.rules.append(("exclude:" + field, field, self._compile_exclude(values)))
+        for field, values in criteria.get("include", {}).items() if extended else ():
+            self.rules.append(("include:" + field, field, self._compile_include(values)))
+        for field, bounds in criteria.get("range", {}).items() if extended else ():
+            self.rules.append(("range:" + field, field, self._compile_range(bounds)))
+
+    def drops(self, document):
+        """
+            Indica si un documento debe descartarse, contabilizando la regla responsable
+
+            Parámetros
+            ----------
+            document: dict  
+                \tDocumento a comprobar
+
+            Salida
+            ------
+            str  
+                \tNombre de la primera regla que descarta el documento, o None si se conserva
+        """
+        for name, field, test in self.rules:
+            if test(document.get(field)):
+                self.dropped[name] += 1
+                return name
+        return None
+
+    def _normalize(self, value):
+        """
+            Normaliza un valor para compararlo con los conjuntos del filtro
+        """
+        if self.case_insensitive and isinstance(value, str):
+            return value.casefold()
+        return value
+
+    def _compile_exclude(self, values):
+        """
+            Crea la comprobación de una regla de exclusión: descarta si el valor está en el conjunto
+        """
+        hashable, unhashable = set(), []
+        for value in values:
+            value = self._normalize(value)
+            try:
+                hashable.add(value)
+            except TypeError:
+                unhashable.append(value)
+        hashable = frozenset(hashable)
+        normalize = self._normalize
+
+        def contains(value):
+            try:
+                if value in hashable:
+                    return True
+            except TypeError:
+                pass
+            return any(value == other for other in unhashable)
+
+        def test(value):
+            if isinstance(value, list):
+                return any(contains(normalize(item)) for item in value)
+            return contains(normalize(value))
+        return test
+
+    def _compile_include(self, values):
+        """
+            Crea la comprobación de una regla de inclusión: descarta si el valor no está en el conjunto
+        """
+        matches = self._compile_exclude(values)
+        return lambda value: not matches(value)
+
+    def _compile_range(self, bounds):
+        """
+            Crea la comprobación de un rango numérico con los operadores gt, gte, lt y lte de Elasticsearch:
+            descarta si el valor no existe, no es numérico o queda fuera del rango
+        """
+        gt, gte, lt, lte = bounds.get("gt"), bounds.get("gte"), bounds.get("lt"), bounds.get("lte")
+
+        def test(value):
+            if value is None:
+                return True
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return True
+            return ((gt is not None and value <= gt) or (gte is not None and value < gte)
+                    or (lt is not None and value >= lt) or (lte is not None and value > lte))
+        return test
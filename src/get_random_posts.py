@@ -11,15 +11,45 @@
     * -s, --source: fichero .csv con los intervalos de tiempo y el número de post en cada uno. Por defecto, `hourly_posts.csv`
     * -o, --output: fichero donde se volcarán los post. Por defecto, `randombaselineDump.ndjson`
     * -e, --elasticsearch: dirección del servidor elastic contra el que indexar. Por defecto, http://localhost:9200
+    * -t, --threads: intervalos muestreados a la vez, todos bajo el mismo límite de peticiones. Por defecto, 4.
+    * --top-ups: consultas adicionales a un intervalo cuando la API devuelve menos posts de los pedidos. Por defecto, 2.
+    * --sample-report: fichero .csv donde se vuelcan los posts pedidos y obtenidos en cada intervalo. Opcional.
+    * --autotune: dimensiona las peticiones bulk por bytes, adaptando el tamaño a la latencia y los rechazos del clúster
+    y reintentando los documentos rechazados.
+    * --target-mb: tamaño inicial de las peticiones bulk con --autotune, en MB. Por defecto, 5.
+    * --target-latency: latencia objetivo de las peticiones bulk con --autotune, en segundos. Por defecto, 5.
+    * -q, --queue-size: lotes de documentos que pueden esperar a ser volcados o indexados en segundo plano antes de
+    detener la extracción. Por defecto, 8.
+    * --compress: comprime el volcado en streaming, "gzip" o "zstd". Opcional.
+    * --compress-level: nivel de compresión del volcado. Por defecto, 6 en gzip y 3 en zstd.
+    * --rotate-mb: rota el volcado en segmentos de este tamaño sin comprimir, en MB, cada uno con un manifiesto con el
+    número de documentos y el rango de fechas. Opcional.
+    * --rotate-minutes: rota el volcado en segmentos de esta duración, en minutos. Opcional.
+    * --rate: peticiones por segundo permitidas a la API. Por defecto, 1.
+    * --burst: peticiones seguidas permitidas tras un periodo de inactividad. Por defecto, 5.
+    * --rate-lock: fichero con el que compartir el límite de peticiones con otros scripts que se ejecuten a la vez.
+    Opcional.
+    * --all-fields: descarga todos los campos de cada post en lugar de sólo los que se indexan (`Indexer.API_FIELDS`),
+    para que el volcado sea una copia completa.
+    * --cache-dir: directorio donde se guardan las respuestas de la API, para no repetir las consultas en siguientes
+    ejecuciones. Opcional.
+    * --cache-mb: tamaño máximo de la caché de respuestas, en MB. Por defecto, 2048.
+    * --cache-ttl: segundos de validez de las respuestas de la caché que no son totalmente históricas. Por defecto, 3600.
+    * --stats-interval: segundos entre líneas de resumen de las métricas. 0 para desactivarlas. Por defecto, 60.
+    * --report: fichero JSON donde se vuelca el informe final de métricas. Opcional.
 """
 
 from elasticsearch import Elasticsearch
-from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer
+from src.elastic_utils.autotune import BulkAutotuner
+from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer, MultiIndexer
+from src.utils.instrumentation import Metrics
+from src.utils.pipeline import BackgroundPipeline, DumpWriter
+from src.utils.pushshift import PushshiftClient, crawl_parallel
+from src.utils.rate_limit import TokenBucket
+from src.utils.response_cache import ResponseCache
 import argparse
-import json
 import os
 from datetime import datetime
-from psaw import PushshiftAPI
 import csv
 import progressbar as pb
 
@@ -29,11 +59,42 @@ def main(args):
     global es
     es = Elasticsearch(args.elasticsearch)
 
-    # Crea un directorio para los volcados si no existe
-    global output_file
-    output_file = args.output
+    # Métricas de la extracción: espera a la API, volcado e indexado
+    global metrics
+    metrics = Metrics("get_random_posts")
+    metrics.start_reporting(args.stats_interval)
 
-    query_api(load_csv(args.source))
+    # Limitador de peticiones a la API
+    global limiter
+    limiter = TokenBucket(rate=args.rate, burst=args.burst, lock_file=args.rate_lock)
+    # Caché de respuestas de la API, si se solicita
+    global response_cache
+    response_cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_mb*1024*1024), ttl=args.cache_ttl) if args.cache_dir else None
+
+    # Dimensionado adaptativo de las peticiones bulk, si se solicita. Las acciones de ambos índices se envían juntas
+    autotune = BulkAutotuner(target_bytes=int(args.target_mb*1024*1024), target_latency=args.target_latency) if args.autotune else None
+
+    # Escritor en los índices de unigramas y bigramas, creados una única vez si no existen
+    global writer
+    writer = MultiIndexer([Indexer(es, "subreddit-lonely", metrics=metrics, autotune=autotune),
+                           NgramIndexer(es, "subreddit-lonely-ngram", metrics=metrics, autotune=autotune)])
+
+    # El volcado y el indexado se hacen en segundo plano, mientras se sigue consultando la API
+    global pipeline
+    dump = DumpWriter(args.output, metrics, compression=args.compress, compress_level=args.compress_level,
+                      rotate_bytes=int(args.rotate_mb*1024*1024) if args.rotate_mb else None,
+                      rotate_seconds=args.rotate_minutes*60 if args.rotate_minutes else None)
+    with BackgroundPipeline(dump, elastic_index, queue_size=args.queue_size, metrics=metrics) as pipeline:
+        query_api(load_csv(args.source), fields=None if args.all_fields else Indexer.API_FIELDS, threads=args.threads,
+                  top_ups=args.top_ups, report=args.sample_report)
+
+    metrics.stop_reporting()
+    print(metrics.summary())
+    print(limiter.summary())
+    if response_cache:
+        print(response_cache.summary())
+    if args.report:
+        metrics.write_report(args.report)
 
 
 def load_csv(filename):
@@ -60,7 +121,7 @@ def load_csv(filename):
     return submissions_per_hour
 
 
-def query_api(submissions_per_hour, cache_size=3000):
+def query_api(submissions_per_hour, fields=None, cache_size=3000, threads=4, top_ups=2, report=None):
     """
         Para cada intervalo de tiempo se recuperan tantos post como hayan sido especificados. 
         Los post extraídos se indexan en Elastic y se vuelcan en .json a modo de backup. Estos post,
@@ -69,57 +130,152 @@ def query_api(submissions_per_hour, cache_size=3000):
         * query: ""
         * scale: "random baseline"
         * lonely: False
-        Se utiliza psaw (https://github.com/dmarx/psaw), un wrapper de la API de Pushshift para recuperar los post
+        Se utiliza `PushshiftClient` para recuperar los post de la API de Pushshift. Los intervalos se muestrean de
+        forma concurrente (`sample_interval`) y cada post se vuelca e indexa una única vez, aunque la API lo devuelva
+        en varias consultas.
 
         Parámetros
         ----------
         submissions_per_hour: list of tuple
             Lista de tuplas con intervalos de tiempo y número de post
+        fields: list
+            Opcional. Campos a descargar de cada post. Por defecto, todos
         cache_size: int
-            Opcional. Cada cuantos documentos se va a realizar un volcado e indexado
+            Opcional. Cada cuantos documentos se encola un lote para su volcado e indexado
+        threads: int
+            Opcional. Número de intervalos muestreados a la vez
+        top_ups: int
+            Opcional. Consultas adicionales por intervalo cuando la API devuelve menos post de los pedidos
+        report: str
+            Opcional. Fichero .csv donde se vuelcan los post pedidos y obtenidos en cada intervalo
+
+        Salida
+        ------
+        achieved: dict
+            Número de post obtenidos en cada intervalo
     """
-    api = PushshiftAPI()
+    api = PushshiftClient(limiter, cache=response_cache)
+    # Las consultas de relleno no usan la caché: repetirían la respuesta incompleta
+    fresh_api = PushshiftClient(limiter) if response_cache else api
+
+    achieved = {}
+    search = lambda interval: sample_interval(api, fresh_api, interval, achieved, fields=fields, top_ups=top_ups)
 
+    seen = set()
     cache = []
     # Barra de progreso para dar feedback
-    bar = pb.ProgressBar(max_value=len(submissions_per_hour))
-    for interval in bar(submissions_per_hour):
-        gen = api.search_submissions(after=int(float(interval[0])), before=int(float(interval[1])), limit=int(interval[2]))
-        for c in gen:
-            # Establecemos estos campos para identificar los post como aleatorios
-            c.d_["query"] = ""
-            c.d_["scale"] = "random baseline"
-            c.d_["lonely"] = False
-            cache.append(c.d_)
-
-            if len(cache) >= cache_size:                
-                dump_to_file(cache)
-                elastic_index(cache)
-
-                cache = []
-
-            dump_to_file(cache)
-            elastic_index(cache)
-
-def dump_to_file(results):
+    bar = pb.ProgressBar(max_value=sum(int(interval[2]) for interval in submissions_per_hour))
+    for post in metrics.timed_iter(crawl_parallel(search, submissions_per_hour, threads=threads), "fetch"):
+        # Cada post se vuelca e indexa una única vez
+        if post["id"] in seen:
+            continue
+        seen.add(post["id"])
+
+        # Establecemos estos campos para identificar los post como aleatorios
+        post["query"] = ""
+        post["scale"] = "random baseline"
+        post["lonely"] = False
+        cache.append(post)
+
+        if len(cache) >= cache_size:
+            pipeline.put(cache)
+
+            cache = []
+        bar.update(min(len(seen), bar.max_value))
+
+    pipeline.put(cache)
+    bar.finish()
+
+    print_sampling_report(submissions_per_hour, achieved, report)
+    return achieved
+
+
+def sample_interval(api, fresh_api, interval, achieved, fields=None, top_ups=2):
     """
-        Vuelca una lista de submissions a un fichero .json. Los volcados se deben realizar de forma parcial 
-        debido a limitaciones de memoria.
-        Las escrituras son mucho más rápidas si se tratan como strings en vez de objetos JSON.
+        Generador que obtiene los post pedidos en un intervalo de tiempo. Si la API devuelve menos de los pedidos, se
+        consulta de nuevo desde el post más antiguo obtenido, sin caché, hasta `top_ups` veces: la API devuelve a
+        veces páginas vacías o incompletas aunque queden post. Como la nueva consulta incluye el segundo de ese post, el
+        límite se amplía con los post de ese segundo ya obtenidos, que se vuelven a recibir y se descartan.
+        Al terminar, se anota en `achieved` el número de post obtenidos.
 
         Parámetros
         ----------
-        results: list
-            Lista de documentos a volcar   
+        api: PushshiftClient
+            Cliente de la API
+        fresh_api: PushshiftClient
+            Cliente sin caché para las consultas de relleno
+        interval: tuple
+            Intervalo con el timestamp inicial, el final y el número de post a obtener
+        achieved: dict
+            Diccionario donde se anota el número de post obtenidos en el intervalo
+        fields: list
+            Opcional. Campos a descargar de cada post
+        top_ups: int
+            Opcional. Número máximo de consultas adicionales
+
+        Salida
+        ------
+        generator
+            Post del intervalo, sin repetidos
+    """
+    # El intervalo incluye su timestamp final, como en el recuento de hourly_posts
+    after, before, requested = int(float(interval[0])), int(float(interval[1])) + 1, int(interval[2])
+    seen = set()
+    # Segundo del post más antiguo obtenido y número de post obtenidos en ese segundo
+    oldest, boundary = before - 1, 0
+    client = api
+    for attempt in range(top_ups + 1):
+        gen = client.search_submissions(fields=fields, after=after, before=oldest + 1,
+                                        limit=requested - len(seen) + boundary)
+        for post in gen:
+            if post["id"] in seen:
+                continue
+            seen.add(post["id"])
+            if post["created_utc"] < oldest:
+                oldest, boundary = post["created_utc"], 1
+            elif post["created_utc"] == oldest:
+                boundary += 1
+            yield post
+        if len(seen) >= requested:
+            break
+        client = fresh_api
+    achieved[tuple(interval[:2])] = len(seen)
+
+
+def print_sampling_report(submissions_per_hour, achieved, report=None):
     """
-    with open(output_file, "a") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
+        Muestra el total de post obtenidos frente a los pedidos y los intervalos incompletos. Opcionalmente,
+        vuelca el detalle de cada intervalo a un .csv con el formato:  
+            TimestampInicio;TimestampFinal;NumPostsPedidos;NumPostsObtenidos
+
+        Parámetros
+        ----------
+        submissions_per_hour: list of tuples
+            Intervalos muestreados
+        achieved: dict
+            Número de post obtenidos en cada intervalo
+        report: str
+            Opcional. Fichero .csv donde volcar el detalle
+    """
+    rows = [(interval[0], interval[1], int(interval[2]), achieved.get(tuple(interval[:2]), 0))
+            for interval in submissions_per_hour]
+    incomplete = [row for row in rows if row[3] < row[2]]
+    print("Obtenidos %d de %d posts pedidos; %d de %d intervalos incompletos"%(
+        sum(row[3] for row in rows), sum(row[2] for row in rows), len(incomplete), len(rows)))
+    for row in incomplete[:20]:
+        print("\t%s - %s: %d de %d"%(datetime.fromtimestamp(int(float(row[0]))), datetime.fromtimestamp(int(float(row[1]))),
+                                    row[3], row[2]))
+    if len(incomplete) > 20:
+        print("\t...")
+
+    if report:
+        with open(report, "w") as f:
+            csv.writer(f, delimiter=";").writerows(rows)
 
 def elastic_index(results):
     """
     Indexa la lista de documentos pasados por parámetro. 
-        Se crean dos índices si no existen, uno para unigramas y otro para bigramas. 
+        Se escribe a la vez en dos índices, uno para unigramas y otro para bigramas, con un único flujo bulk. 
         A cada documento se le añadirá tres campos: la consulta y escala utilizadas para obtenerlo y 
         un booleano para marcarlos como positivos en soledad.
 
@@ -128,13 +284,7 @@ def elastic_index(results):
         results: list
             Lista de documentos a indexar
     """
-    indexers = [Indexer(es, "subreddit-lonely"), NgramIndexer(es, "subreddit-lonely-ngram")]
-    for indexer in indexers:
-        if not indexer.index_exists():
-            print("Creado índice: " + indexer.index_name)
-            indexer.create_index()
-        
-        indexer.index_documents(results)
+    writer.index_documents(results)
 
 def parse_args():
     """
@@ -144,6 +294,26 @@ def parse_args():
     parser.add_argument("-s", "--source", default="hourly_posts.csv", help="Fichero con la lista de post por intervarlo de tiempo.")
     parser.add_argument("-o", "--output", default="randombaselineDump.ndjson", help="Fichero donde se volcarán los post")
     parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="dirección del servidor Elasticsearch contra el que se indexará")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Intervalos muestreados a la vez")
+    parser.add_argument("--top-ups", type=int, default=2, help="Consultas adicionales a un intervalo con menos posts de los pedidos")
+    parser.add_argument("--sample-report", help="Fichero .csv con los posts pedidos y obtenidos en cada intervalo")
+    parser.add_argument("--autotune", action="store_true", help="Adapta el tamaño de las peticiones bulk a la latencia y los rechazos del clúster")
+    parser.add_argument("--target-mb", type=float, default=5, help="Tamaño inicial de las peticiones bulk con --autotune, en MB")
+    parser.add_argument("--target-latency", type=float, default=5, help="Latencia objetivo de las peticiones bulk con --autotune, en segundos")
+    parser.add_argument("-q", "--queue-size", type=int, default=8, help="Lotes que pueden esperar a ser volcados o indexados en segundo plano")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], help="Comprime el volcado en streaming")
+    parser.add_argument("--compress-level", type=int, help="Nivel de compresión del volcado")
+    parser.add_argument("--rotate-mb", type=float, help="Rota el volcado en segmentos de este tamaño sin comprimir, en MB")
+    parser.add_argument("--rotate-minutes", type=float, help="Rota el volcado en segmentos de esta duración, en minutos")
+    parser.add_argument("--rate", type=float, default=1, help="Peticiones por segundo permitidas a la API")
+    parser.add_argument("--burst", type=int, default=5, help="Peticiones seguidas permitidas tras un periodo de inactividad")
+    parser.add_argument("--rate-lock", help="Fichero con el que compartir el límite de peticiones con otros scripts")
+    parser.add_argument("--all-fields", action="store_true", help="Descarga todos los campos de cada post, no sólo los que se indexan")
+    parser.add_argument("--cache-dir", help="Directorio de la caché de respuestas de la API")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Tamaño máximo de la caché de respuestas, en MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Segundos de validez de las respuestas no históricas de la caché")
+    parser.add_argument("--stats-interval", type=float, default=60, help="Segundos entre líneas de resumen de las métricas, 0 para desactivarlas")
+    parser.add_argument("--report", help="Fichero JSON donde volcar el informe final de métricas")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -12,10 +12,21 @@
     * -e, --elasticsearch: dirección del servidor Elasticsearch. Por defecto, http://localhost:9200
     * -i, --index: nombre del índice sobre el que realizarán las consultas.
     * -o, --output: fichero donde se serializarán los resultados. Por defecto, "hourly_posts.csv"
+    * -p, --page-size: número de buckets de cada página de la agregación. Por defecto, 5000.
+    * -c, --cache: fichero donde se guardan los recuentos por hora entre ejecuciones. Por defecto, el fichero de salida
+    con la extensión ".cache.json".
+    * --rebuild: recalcula todas las horas, ignorando la caché. Necesario si se modifica el campo lonely de posts ya
+    contados sin cambiar el número de documentos del índice.
+
+    Las siguientes ejecuciones sólo consultan las horas posteriores al post más reciente del cálculo anterior y los días
+    cuyo recuento ha cambiado. Si el número de documentos y el post más reciente del índice no han cambiado, no se
+    recalcula nada.
 """
 
 from elasticsearch import Elasticsearch
 import argparse
+import json
+import os
 from datetime import datetime, timedelta
 import progressbar as pb
 import math
@@ -31,34 +42,29 @@ def main(args):
 
     # Se obtienen las fechas límite
     dates = get_boundary_dates(args.index)
+    oldest, newest = dates[0].timestamp(), dates[1].timestamp()
+    # Los intervalos empiezan en las mismas horas que la fecha más reciente
+    offset = int(newest) % 3600
+    doc_count, max_created_utc = get_index_state(args.index)
+
+    cache_path = args.cache or args.output + ".cache.json"
+    cache = None if args.rebuild else load_bucket_cache(cache_path, args.index, offset)
 
     print("Procesando documentos...")
-    submissions_per_hour = []
-    after_date = dates[1]
+    if cache is None:
+        hours = get_hourly_counts(args.index, oldest, newest, offset, page_size=args.page_size)
+    elif cache["doc_count"] == doc_count and cache["max_created_utc"] == max_created_utc:
+        print("El índice no ha cambiado desde el último cálculo")
+        hours = cache["hours"]
+    else:
+        hours = update_hourly_counts(args.index, cache, oldest, newest, offset, args.page_size)
 
-    # Barra de progreso
-    bar = pb.ProgressBar(max_value=100, widgets=[
-        "- ", pb.Percentage(), " ", pb.Bar(), " ", pb.Timer(), " ", pb.AdaptiveETA()
-    ])
-    while after_date > dates[0]:
-        # Para cada intervalo de una hora se obtiene el número de posts
-        before_date = after_date - timedelta(hours=1)
-
-        # Actualizo la barra de progreso
-        bar.update(math.ceil((dates[1].timestamp() - before_date.timestamp())
-                             / (dates[1].timestamp() - dates[0].timestamp()) * 100))
-
-        lonely_count = get_submission_count(
-            before_date.timestamp(), after_date.timestamp(), args.index, True)
-        random_count = get_submission_count(
-            before_date.timestamp(), after_date.timestamp(), args.index, False)
-        # Si un intervalo no tiene post no se incluye
-        if lonely_count > 0:
-            submissions_per_hour.append(
-                (before_date.timestamp(), after_date.timestamp(), lonely_count, random_count))
-
-        after_date = before_date
-    bar.finish()
+    save_bucket_cache(cache_path, {"index": args.index, "offset": offset, "doc_count": doc_count,
+                                   "max_created_utc": max_created_utc, "hours": hours})
+
+    # Si un intervalo no tiene post lonely no se incluye
+    submissions_per_hour = [(hour, hour + 3600, lonely_count, random_count)
+                            for hour, (lonely_count, random_count) in sorted(hours.items(), reverse=True) if lonely_count > 0]
 
     print("Total documentos: ", sum([x[2] for x in submissions_per_hour]))
 
@@ -69,6 +75,56 @@ def main(args):
     print("Completado")
 
 
+def update_hourly_counts(index, cache, oldest, newest, offset, page_size=5000):
+    """
+        Actualiza los recuentos por hora guardados en la caché de una ejecución anterior.  
+        Se recalculan las horas a partir de la marca de agua (la hora del post más reciente en aquel momento), que
+        pueden haber recibido posts nuevos, y los días anteriores cuyo recuento por día y valor de lonely ya no coincide
+        con el guardado, por ejemplo porque se indexaron posts atrasados o se eliminaron. Comprobar los días cuesta una
+        agregación con un bucket por día, mucho menos que recalcular todas las horas.
+
+        Parámetros
+        ----------
+        index: str
+            nombre del índice
+        cache: dict
+            caché de recuentos por hora, como la devuelve `load_bucket_cache`
+        oldest: float
+            timestamp de la fecha más antigua presente en el índice, redondeada a la hora
+        newest: float
+            timestamp de la fecha más reciente presente en el índice, redondeada a la hora
+        offset: int
+            desplazamiento de los intervalos respecto a las horas UTC, en segundos
+        page_size: int
+            número de buckets de cada página de la agregación
+
+        Salida
+        ------
+        hours: dict
+            recuentos de posts lonely y no lonely por hora
+    """
+    watermark = (cache["max_created_utc"] - 1 - offset) // 3600 * 3600 + offset
+    day = lambda hour: (hour - offset) // 86400 * 86400 + offset
+
+    # Días anteriores a la marca de agua cuyo recuento ha cambiado
+    cached_days = {}
+    for hour, counts in cache["hours"].items():
+        if hour < watermark:
+            day_counts = cached_days.setdefault(day(hour), [0, 0])
+            day_counts[0] += counts[0]
+            day_counts[1] += counts[1]
+    current_days = get_hourly_counts(index, oldest, watermark, offset, interval=86400, page_size=page_size)
+    changed = set(d for d in set(cached_days) | set(current_days) if cached_days.get(d) != current_days.get(d))
+    print("Recalculando %d días modificados y las horas desde %s"%(len(changed), datetime.fromtimestamp(watermark)))
+
+    hours = {hour: counts for hour, counts in cache["hours"].items()
+             if hour < watermark and day(hour) not in changed}
+    for changed_day in sorted(changed):
+        hours.update(get_hourly_counts(index, changed_day, min(changed_day + 86400, watermark), offset, page_size=page_size))
+    hours.update(get_hourly_counts(index, watermark, newest, offset, page_size=page_size))
+    return hours
+
+
 def get_boundary_dates(index):
     """
         Obtiene la fecha más reciente y la más antigua presente en el índice. 
@@ -122,53 +178,169 @@ def get_boundary_dates(index):
     return oldest_date, newest_date
 
 
-def get_submission_count(before_timestamp, after_timestamp, index, is_lonely):
+def get_index_state(index):
     """
-        Recupera el número de documentos en un índice en el intervalo de tiempo especificado.
-        Se utiliza la API Count: https://www.elastic.co/guide/en/elasticsearch/reference/current/search-count.html,
-        ya que es más eficiente que contar el número de hits en una consulta Search
+        Obtiene el número de documentos del índice y el created_utc más reciente, con los que se comprueba si
+        el índice ha cambiado desde el último cálculo
 
         Parámetros
         ----------
-        before_timestamp: int
-            timestamp de la fecha inicial del intervalo
-        after_timestamp: int
-            timestamp de la fecha final del intervalo
         index: str
             nombre del índice
 
         Salida
         ------
-        count: int
-            número de posts en el intervalo temporal
+        doc_count: int
+            número de documentos del índice
+        max_created_utc: int
+            timestamp del post más reciente
     """
+    res = es.search(index=index, body={"size": 0, "track_total_hits": True,
+                                       "aggs": {"newest_date": {"max": {"field": "created_utc"}}}})
+    return res["hits"]["total"]["value"], int(res["aggregations"]["newest_date"]["value"])
+
+
+def get_hourly_counts(index, after, before, offset, interval=3600, page_size=5000):
+    """
+        Recupera el número de posts lonely y no lonely de cada intervalo de una hora entre dos fechas.
+        En lugar de contar cada hora por separado, se utiliza una única agregación compuesta
+        (https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations-bucket-composite-aggregation.html),
+        paginada, que agrupa los documentos por hora con un histograma sobre created_utc y por el campo lonely.
+
+        Cada intervalo incluye su timestamp final pero no el inicial, como en la API Count: el histograma se calcula
+        sobre created_utc - 1, desplazado `offset` segundos respecto a las horas UTC.
+
+        Parámetros
+        ----------
+        index: str
+            nombre del índice
+        after: float
+            timestamp inicial, no incluido
+        before: float
+            timestamp final, incluido
+        offset: int
+            desplazamiento de los intervalos respecto a las horas UTC, en segundos
+        interval: int
+            duración de los intervalos en segundos. Por defecto, una hora
+        page_size: int
+            número de buckets de cada página de la agregación
+
+        Salida
+        ------
+        counts: dict
+            recuentos de cada intervalo con algún post, indexados por el timestamp inicial, en forma de lista
+            [NumPostsLonely, NumPostsNoLonely]
+    """
+    composite = {
+        "size": page_size,
+        "sources": [
+            {
+                "hour": {
+                    "histogram": {
+                        "script": {
+                            "source": "doc['created_utc'].value - 1 - params.offset",
+                            "params": {"offset": offset}
+                        },
+                        "interval": interval
+                    }
+                }
+            },
+            {
+                "lonely": {
+                    "terms": {
+                        "field": "lonely"
+                    }
+                }
+            }
+        ]
+    }
     query = {
+        "size": 0,
         "query": {
-            "bool": {
-                "must": [
-                    {
-                        "range": {
-                            "created_utc": {
-                                "gt": before_timestamp,
-                                "lte": after_timestamp
-                            }
-                        }
-                    },
-                    {
-                        "term": {
-                            "lonely": is_lonely
-                        }
-                    }
-                ]
+            "range": {
+                "created_utc": {
+                    "gt": after,
+                    "lte": before
+                }
+            }
+        },
+        "aggs": {
+            "hours": {
+                "composite": composite
             }
         }
     }
 
-    res = es.count(
-        index=index,
-        body=query
-    )
-    return res["count"]
+    counts = {}
+    # Barra de progreso
+    bar = pb.ProgressBar(max_value=100, widgets=[
+        "- ", pb.Percentage(), " ", pb.Bar(), " ", pb.Timer(), " ", pb.AdaptiveETA()
+    ])
+    while True:
+        res = es.search(index=index, body=query)["aggregations"]["hours"]
+        for bucket in res["buckets"]:
+            hour = int(bucket["key"]["hour"]) + offset
+            lonely = bucket["key"]["lonely"] in (True, "true")
+            counts.setdefault(hour, [0, 0])[0 if lonely else 1] += bucket["doc_count"]
+
+        # El after_key se utiliza para paginar, corresponde con el último resultado de cada página
+        if not res["buckets"] or "after_key" not in res:
+            break
+        composite["after"] = res["after_key"]
+        bar.update(min(100, max(0, math.ceil((res["after_key"]["hour"] + offset - after) / max(1, before - after) * 100))))
+    bar.finish()
+    return counts
+
+
+def load_bucket_cache(path, index, offset):
+    """
+        Carga la caché de recuentos por hora de una ejecución anterior. El fichero tiene la siguiente estructura:
+        ```json
+        {
+            "index": "subreddit-lonely", "offset": 0, "doc_count": 1000, "max_created_utc": 1500003600,
+            "hours": {"1500000000": [NumPostsLonely, NumPostsNoLonely], ...}
+        }
+        ```
+
+        Parámetros
+        ----------
+        path: str
+            ruta del fichero de caché
+        index: str
+            nombre del índice. La caché no se usa si se calculó sobre otro índice
+        offset: int
+            desplazamiento de los intervalos. La caché no se usa si se calculó con otro
+
+        Salida
+        ------
+        cache: dict
+            caché con las horas como enteros, o None si no existe o no es aplicable
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if cache.get("index") != index or cache.get("offset") != offset:
+        return None
+    cache["hours"] = {int(hour): counts for hour, counts in cache["hours"].items()}
+    return cache
+
+
+def save_bucket_cache(path, cache):
+    """
+        Guarda la caché de recuentos por hora de forma atómica
+
+        Parámetros
+        ----------
+        path: str
+            ruta del fichero de caché
+        cache: dict
+            caché a guardar
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(path + ".tmp", path)
 
 
 def write_to_csv(filename, submissions):
@@ -200,6 +372,10 @@ def parse_args():
     parser.add_argument("-i", "--index", help="nombre del índice a procesar", required=True)
     parser.add_argument("-o", "--output", default="hourly_posts.csv",
                         help="Archivo donde se almacenarán los resultados")
+    parser.add_argument("-p", "--page-size", type=int, default=5000,
+                        help="Número de buckets de cada página de la agregación")
+    parser.add_argument("-c", "--cache", help="Fichero donde se guardan los recuentos por hora entre ejecuciones")
+    parser.add_argument("--rebuild", action="store_true", help="Recalcula todas las horas, ignorando la caché")
     return parser.parse_args()
 
 
@@ -2,30 +2,86 @@
 """
     Script para indexar documentos en Elastic a partir de ficheros .json de backup
     ------------------------------------------------------------------------------
-    El script procesa los ficheros .json (incluido comprimidos en .gz) del directorio que se especifique, indexándolos con unigramas y bigramas en los
+    El script procesa los ficheros .json y .ndjson (incluido comprimidos en .gz, .zst, .xz o .bz2, como los volcados
+    mensuales RS_YYYY-MM.zst de Pushshift) del directorio que se especifique, indexándolos con unigramas y bigramas en los
     índices reddit-loneliness y reddit-loneliness-ngram.
 
     Parámetros
     ----------
     * -i, --index: nombre del índice a crear.
     * -d, --data-dir: directorio donde está almacenados los .json a indexar.
-    * -f, --filter: fichero JSON con un filtro de campos y valores a aplicar. Opcional.
+    * -f, --filter: fichero JSON con un filtro de campos y valores a aplicar. Admite reglas de exclusión, inclusión y
+    rangos numéricos (ver `DocumentFilter`). Opcional.
     * -b, --block-size: tamaño de los bloques de líneas a procesar de cada vez, en Mb. Por defecto, 8.
     * -e, --elasticsearch: dirección del servidor Elasticsearch contra el que se indexará.
+    * -s, --streaming: indexa cada fichero como un flujo continuo de documentos, enviando peticiones bulk en paralelo
+    mientras se sigue leyendo. Opcional.
+    * -c, --chunk-size: número de documentos por petición bulk en modo streaming. Por defecto, 500.
+    * -t, --threads: número de peticiones bulk simultáneas en modo streaming. Por defecto, 4.
+    * -w, --workers: número de procesos que decodifican, filtran y proyectan los bloques de líneas. Por defecto, 1
+    (todo se procesa en el proceso principal).
+    * -p, --parallel-files: número de ficheros que se indexan simultáneamente. Por defecto, 1.
+    * -m, --max-requests: número máximo de peticiones bulk en vuelo sumando todos los ficheros. Por defecto, 8.
+
+    * --bulk-load: desactiva refrescos y réplicas del índice mientras dura la carga, restaurándolos al final.
+    * --force-merge: con --bulk-load, fusiona los segmentos del índice al terminar.
+    * --project-mapping: envía sólo los campos mapeados en el índice (más los indicados en --keep-fields), en lugar de
+    todos los campos de `Indexer.FIELDS`.
+    * --keep-fields: lista separada por comas de campos no mapeados a conservar en el `_source` con --project-mapping.
+    * --autotune: dimensiona las peticiones bulk por bytes, adaptando el tamaño a la latencia y los rechazos del clúster
+    y reintentando los documentos rechazados.
+    * --target-mb: tamaño inicial de las peticiones bulk con --autotune, en MB. Por defecto, 5.
+    * --target-latency: latencia objetivo de las peticiones bulk con --autotune, en segundos. Por defecto, 5.
+    * --passthrough: modo para reindexar backups de confianza. De cada línea sólo se extraen el id y los campos del
+    filtro, la línea se envía tal cual como `_source` y la proyección de los campos la hace Elasticsearch con una pipeline
+    de ingesta, que se crea al empezar (`<index>-projection`). Si está instalado pysimdjson, la extracción es perezosa.
+    * --pipeline: con --passthrough, pipeline de ingesta ya existente a utilizar en lugar de crear la de proyección.
+    * --after: fecha (YYYY-mm-dd) a partir de la cual se indexan los volcados. Los segmentos con manifiesto (ver
+    `DumpWriter`) cuyos documentos son todos anteriores se omiten sin abrirlos. Opcional.
+    * --before: fecha (YYYY-mm-dd, no incluida) hasta la que se indexan los volcados. Los segmentos con manifiesto cuyos
+    documentos son todos posteriores se omiten. Opcional.
+    * --stats-interval: segundos entre líneas de resumen de las métricas (etapas, docs/s, MB/s, errores). 0 para
+    desactivarlas. Por defecto, 60.
+    * --report: fichero JSON donde se vuelca el informe final de métricas. Opcional.
+    * -r, --resume: retoma una ejecución interrumpida a partir del checkpoint, sin reenviar los bloques ya confirmados.
+    En los ficheros comprimidos la parte ya indexada se descomprime de nuevo para llegar a la posición guardada, aunque
+    no se procesa ni se envía.
+    * -k, --checkpoint: fichero de checkpoint. Por defecto, `<data-dir>/<index>.checkpoint`.
+
+    Los ficheros se procesan de mayor a menor tamaño para que los últimos en terminar sean los más pequeños.
+    Al acabar se muestra el rendimiento de cada fichero y el total.
 """
 
 from elasticsearch import Elasticsearch
 from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer
-import json, gzip
+from src.elastic_utils.autotune import BulkAutotuner
+from src.utils.checkpoint import Checkpoint
+from src.utils.instrumentation import Metrics
+from src.utils.file_handler import open_compressed, skip_to, COMPRESSED_EXTENSIONS
+from src.utils.pipeline import read_manifest
+from datetime import datetime, timezone
+import json
 import os
 import argparse
+import multiprocessing
+import collections
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 import progressbar as pb
 
 __author__="Samuel Cifuentes García"
 
 def main(args):
     # Carga los .json desde el directorio especificado
-    json_files = [file for file in os.listdir(args.data_dir) if file.endswith(".json") or file.endswith(".json.gz") or file.endswith(".ndjson")]
+    json_files = [file for file in os.listdir(args.data_dir) if is_backup_file(file)]
+    # Los segmentos de volcado con manifiesto se descartan enteros si quedan fuera del rango de fechas
+    if args.after or args.before:
+        in_range = [file for file in json_files if in_date_range(args.data_dir + "/" + file, args.after, args.before)]
+        print("Omitidos %d ficheros fuera del rango de fechas"%(len(json_files) - len(in_range)))
+        json_files = in_range
+    # Primero los más grandes, así la cola de ejecución termina de forma más uniforme
+    json_files.sort(key=lambda file: os.path.getsize(args.data_dir + "/" + file), reverse=True)
 
     # Establecer conexión a Elastic
     es = Elasticsearch(args.elasticsearch)
@@ -40,67 +96,521 @@ def main(args):
                 print("Error loading filter .json")
                 exit(1)
     
-    indexer = Indexer(es, args.index, filter_criteria=indexer_filter)
+    # Opciones comunes a todos los indexers, incluidos los de los procesos del pool
+    indexer_options = {
+        "filter_criteria": indexer_filter,
+        "project_mapping": args.project_mapping,
+        "keep_fields": args.keep_fields.split(",") if args.keep_fields else None,
+        "passthrough": args.passthrough,
+        "pipeline": args.pipeline
+    }
+    indexer = Indexer(es, args.index, **indexer_options)
        
     if not indexer.index_exists():
         print("Creado índice: " + indexer.index_name)
         indexer.create_index()
 
-    for filename in json_files:
-        path = args.data_dir + "/" + filename
-        # Se distingue entre .json y comprimidos en .gz
-        if filename.endswith(".gz"):
-            f = gzip.open(path)
-        else:
-            f = open(path)
+    # En modo passthrough la proyección se hace en el servidor
+    if args.passthrough and not args.pipeline:
+        print("Creada pipeline de ingesta: " + indexer.pipeline)
+        indexer.create_pipeline()
+
+    # Pool de procesos para el decodificado de los bloques, si se solicita
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.index, indexer_options))
+
+    # Repartimos el máximo de peticiones en vuelo entre los ficheros simultáneos. Sin streaming cada fichero
+    # mantiene una única petición en vuelo, por lo que no se indexan más ficheros a la vez que peticiones permitidas
+    parallel_files = max(1, min(args.parallel_files, args.max_requests))
+    threads = max(1, min(args.threads, args.max_requests // parallel_files))
+
+    # Checkpoint con el avance de cada fichero
+    checkpoint_path = args.checkpoint or args.data_dir + "/" + args.index + ".checkpoint"
+    checkpoint = Checkpoint(checkpoint_path, resume=args.resume)
+
+    # Modo de carga masiva, si se solicita
+    load_context = indexer.bulk_load(force_merge=args.force_merge) if args.bulk_load else contextlib.nullcontext()
+
+    # Métricas de la ejecución, compartidas por todos los ficheros
+    metrics = Metrics("index_from_backup")
+    metrics.start_reporting(args.stats_interval)
+
+    # Un indexer por fichero, con sus propias estadísticas
+    autotune = BulkAutotuner(target_bytes=int(args.target_mb*1024*1024), target_latency=args.target_latency) if args.autotune else None
+    file_indexers = [Indexer(es, args.index, metrics=metrics, autotune=autotune, **indexer_options) for _ in json_files]
+
+    start = time.time()
+    with load_context, ThreadPoolExecutor(max_workers=parallel_files) as executor:
+        futures = [executor.submit(index_file, args.data_dir + "/" + filename, file_indexer,
+                                   args, pool, threads, parallel_files == 1, checkpoint) for filename, file_indexer in zip(json_files, file_indexers)]
+        results = [future.result() for future in futures]
+    elapsed = time.time() - start
+    metrics.stop_reporting()
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    # Rendimiento por fichero y total
+    print("Resumen:")
+    total_docs, total_size = 0, 0
+    # Las estadísticas incluyen lo indexado en ejecuciones anteriores; el rendimiento se calcula sólo con esta
+    for filename, stats, run_docs, run_size, file_elapsed in results:
+        if not file_elapsed:
+            print("\t*%s - Indexed: %d, Errors:%d, Filtered:%d - completado en una ejecución anterior"%(filename, stats["indexed"], stats["errors"], stats["filtered"]))
+            continue
+        print("\t*%s - Indexed: %d, Errors:%d, Filtered:%d - %.1f docs/s, %.2f MB/s"%(filename, stats["indexed"], stats["errors"], stats["filtered"],
+            run_docs/file_elapsed, run_size/1024/1024/file_elapsed))
+        total_docs += run_docs
+        total_size += run_size
+    if indexer.filter:
+        dropped = collections.Counter()
+        for file_indexer in file_indexers:
+            dropped.update(file_indexer.filter.dropped)
+        print("\t*Descartados por regla: " + ", ".join("%s=%d"%(rule, count) for rule, count in dropped.most_common()))
+    if args.project_mapping and not args.passthrough:
+        print("\t*Bytes ahorrados por la proyección: %.2f MB"%(sum(stats["bytes_saved"] for _, stats, _, _, _ in results)/1024/1024))
+    print("\t*Total - Indexed: %d en %.1f s - %.1f docs/s, %.2f MB/s"%(total_docs, elapsed,
+        total_docs/max(elapsed, 1e-6), total_size/1024/1024/max(elapsed, 1e-6)))
+    print(metrics.summary())
+    if args.report:
+        metrics.write_report(args.report)
+
+
+def is_backup_file(filename):
+    """
+        Indica si un fichero del directorio de datos es un backup a indexar: .json o .ndjson, comprimidos o no,
+        o un volcado mensual de Pushshift (RS_YYYY-MM.zst, RC_YYYY-MM.xz...)
+
+        Parámetros
+        ----------
+        filename: str  
+            \tNombre del fichero
+
+        Salida
+        ------
+        bool  
+            \tTrue si debe indexarse
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+            return filename.endswith((".json", ".ndjson")) or "." not in filename
+    return filename.endswith((".json", ".ndjson")) and not filename.endswith(".manifest.json")
+
+
+def in_date_range(path, after, before):
+    """
+        Indica si un fichero puede contener documentos del rango de fechas, según su manifiesto.
+        Los ficheros sin manifiesto se indexan siempre.
+
+        Parámetros
+        ----------
+        path: str  
+            \tRuta del fichero
+        after: int  
+            \tTimestamp a partir del cual se indexa. Opcional
+        before: int  
+            \tTimestamp, no incluido, hasta el que se indexa. Opcional
+
+        Salida
+        ------
+        bool  
+            \tFalse si el manifiesto garantiza que todos los documentos quedan fuera del rango
+    """
+    manifest = read_manifest(path)
+    if not manifest or manifest["min_created_utc"] is None:
+        return True
+    if after is not None and manifest["max_created_utc"] < after:
+        return False
+    if before is not None and manifest["min_created_utc"] >= before:
+        return False
+    return True
 
+
+def index_file(path, indexer, args, pool, threads, show_progress, checkpoint):
+    """
+        Indexa un fichero de backup completo. Puede ejecutarse en varios hilos a la vez, uno por fichero.
+
+        Parámetros
+        ----------
+        path: str  
+            \tRuta del fichero a indexar
+        indexer: Indexer  
+            \tIndexer propio del fichero, en el que se acumulan sus estadísticas
+        args: Namespace  
+            \tArgumentos con los que se ejecutó el script
+        pool: multiprocessing.Pool  
+            \tPool de procesos para el decodificado de los bloques. Opcional.
+        threads: int  
+            \tNúmero de peticiones bulk simultáneas de este fichero en modo streaming
+        show_progress: bool  
+            \tIndica si se muestra una barra de progreso. Con varios ficheros simultáneos las barras se solaparían
+        checkpoint: Checkpoint  
+            \tCheckpoint donde se registra el avance del fichero
+
+        Salida
+        ------
+        str  
+            \tNombre del fichero
+        dict  
+            \tEstadísticas del indexado del fichero, incluidas las de ejecuciones anteriores si se retoma
+        int  
+            \tDocumentos indexados en esta ejecución
+        int  
+            \tBytes del fichero en disco procesados en esta ejecución
+        float  
+            \tSegundos empleados
+    """
+    filename = os.path.basename(path)
+    start = time.time()
+    # Los comprimidos se descomprimen en streaming. Se leen en binario para conocer la posición en bytes.
+    # El avance se mide sobre el fichero en disco (raw), comprimido o no
+    f, raw = open_compressed(path)
+
+    # Si se retoma una ejecución anterior, se continúa desde el último bloque confirmado
+    state = checkpoint.get(filename)
+    # Los descartes por regla se restauran también, para que su desglose siga sumando los filtrados
+    if indexer.filter:
+        indexer.filter.dropped.update(state.get("dropped", {}))
+    if state.get("completed"):
+        print(filename + " ya indexado, se omite")
+        f.close()
+        raw.close()
+        return filename, state["stats"], 0, 0, 0
+    offset = start_offset = state.get("offset", 0)
+    if offset:
+        print("Retomando " + filename + " desde el byte " + str(offset) + "...")
+        indexer.stats.update(state["stats"])
+        skip_to(f, offset)
+    else:
         print("Procesando " + filename + "...")
 
-        block_size = args.block_size*1024*1024 # Se procesará el fichero en bloques
-        block = f.readlines(block_size)
+    resumed_docs, resumed_size = indexer.stats["indexed"], raw.tell()
+    block_size = args.block_size*1024*1024 # Se procesará el fichero en bloques
 
-        # Barra de progreso
-        file_size = os.path.getsize(path)
-        indexed_size = 0
+    # Barra de progreso
+    file_size = os.path.getsize(path)
+    if show_progress:
         bar = pb.ProgressBar(max_value = file_size, widgets = [
             "- ", pb.Percentage(), " ", pb.Bar(), " ", pb.Timer(), " ", pb.AdaptiveETA()
         ])
+    else:
+        bar = pb.NullBar(max_value = file_size)
+
+    if pool:
+        # Limitamos los bloques en vuelo de cada fichero para no cargarlo entero en memoria
+        blocks = read_blocks(f, raw, block_size, bar, indexer.metrics)
+        prepared = prepare_blocks(pool, blocks, indexer, 2*args.workers)
+    else:
+        prepared = process_blocks(read_blocks(f, raw, block_size, bar, indexer.metrics), indexer)
+
+    if args.streaming:
+        tracker = BlockTracker(filename, indexer, checkpoint)
+        indexer.index_actions_streaming(tracker.track(prepared), chunk_size=args.chunk_size,
+                                        thread_count=threads, progress=tracker.acknowledge)
+    else:
+        for actions, offset in prepared:
+            indexer.index_actions(actions)
+            checkpoint.update(filename, offset, indexer.stats, dropped=indexer.filter.dropped if indexer.filter else None)
+
+    bar.finish()
+    
+    end_offset = f.tell()
+    checkpoint.update(filename, end_offset, indexer.stats, completed=True,
+                      dropped=indexer.filter.dropped if indexer.filter else None)
+    f.close()
+    raw.close()
+    elapsed = time.time() - start
+
+    # Se imprimen las estadísticas del indexado
+    print("%s completado - Indexed: %d, Errors:%d, Filtered:%d"%(filename, indexer.stats["indexed"], indexer.stats["errors"], indexer.stats["filtered"]))
+    if args.project_mapping and not args.passthrough:
+        # readlines(block_size) lee bloques de algo más de block_size bytes
+        num_blocks = max(1, (end_offset - start_offset) // block_size)
+        print("\t*Bytes ahorrados por la proyección: %.2f MB, %.1f KB por bloque"%(indexer.stats["bytes_saved"]/1024/1024,
+            indexer.stats["bytes_saved"]/1024/num_blocks))
+
+    return filename, indexer.stats, indexer.stats["indexed"] - resumed_docs, file_size - resumed_size, elapsed
+
+
+class BlockTracker:
+    """
+        Lleva la cuenta de las acciones enviadas de cada bloque en modo streaming. Como las respuestas de
+        Elasticsearch llegan en orden, un bloque está confirmado cuando se ha procesado su última acción, momento
+        en el que se actualiza el checkpoint.
+
+        Atributos
+        ---------
+        filename: str
+            \tNombre del fichero al que pertenecen los bloques
+        indexer: Indexer
+            \tIndexer del fichero
+        checkpoint: Checkpoint
+            \tCheckpoint donde se registra el avance
+    """
+
+    def __init__(self, filename, indexer, checkpoint):
+        self.filename = filename
+        self.indexer = indexer
+        self.checkpoint = checkpoint
+        self.sent = 0
+        # Marcas (acciones enviadas, offset, filtrados, bytes ahorrados, descartes por regla) al final de cada bloque
+        self.marks = collections.deque()
+
+    def track(self, prepared):
+        """
+            Generador que aplana los bloques de acciones registrando dónde termina cada uno
+
+            Parámetros
+            ----------
+            prepared: iterable  
+                \tTuplas (acciones, offset) de cada bloque
+
+            Salida
+            ------
+            generator  
+                \tAcciones a indexar
+        """
+        for actions, offset in prepared:
+            for action in actions:
+                self.sent += 1
+                yield action
+            dropped = dict(self.indexer.filter.dropped) if self.indexer.filter else None
+            self.marks.append((self.sent, offset, self.indexer.stats["filtered"], self.indexer.stats["bytes_saved"], dropped))
+
+    def acknowledge(self, processed):
+        """
+            Actualiza el checkpoint con los bloques cuyas acciones ya han sido procesadas
+
+            Parámetros
+            ----------
+            processed: int  
+                \tNúmero de acciones procesadas por Elasticsearch
+        """
+        offset = None
+        while self.marks and self.marks[0][0] <= processed:
+            _, offset, filtered, bytes_saved, dropped = self.marks.popleft()
+        if offset is not None:
+            stats = dict(self.indexer.stats, filtered=filtered, bytes_saved=bytes_saved)
+            self.checkpoint.update(self.filename, offset, stats, dropped=dropped)
+
 
-        while block:
-            index_block(block, indexer)
+def read_blocks(f, raw, block_size, bar, metrics=None):
+    """
+        Generador que recorre un fichero por bloques de líneas, actualizando la barra de progreso con los bytes
+        realmente leídos del disco.
+
+        Parámetros
+        ----------
+        f: file  
+            \tFichero abierto del que leer, ya descomprimido
+        raw: file  
+            \tFichero en disco sobre el que se abrió `f`. En los no comprimidos, el mismo objeto
+        block_size: int  
+            \tTamaño de los bloques en bytes
+        bar: ProgressBar  
+            \tBarra de progreso a actualizar, con el tamaño del fichero en disco como máximo
+        metrics: Metrics  
+            \tOpcional. Métricas donde se registran el tiempo de lectura y los bytes leídos
+
+        Salida
+        ------
+        generator  
+            \tTuplas con cada bloque de líneas del fichero y la posición en la que termina
+    """
+    offset, raw_offset = f.tell(), raw.tell()
+    while True:
+        if metrics:
+            with metrics.stage("read"):
+                block = f.readlines(block_size)
+        else:
             block = f.readlines(block_size)
+        if not block:
+            break
+
+        # Bytes descomprimidos y bytes leídos del disco
+        new_offset, new_raw_offset = f.tell(), raw.tell()
+        if metrics:
+            metrics.count("bytes", new_offset - offset)
+            metrics.count("input_bytes", new_raw_offset - raw_offset)
+        offset, raw_offset = new_offset, new_raw_offset
+        bar.update(min(raw_offset, bar.max_value))
+
+        yield block, offset
+
+
+def process_blocks(blocks, indexer):
+    """
+        Generador que decodifica, filtra y proyecta los bloques de líneas en el proceso principal.
+
+        Parámetros
+        ----------
+        blocks: iterable  
+            \tBloques de líneas, tal y como los devuelve `read_blocks`
+        indexer: Indexer  
+            \tIndexer que procesará los documentos
+
+        Salida
+        ------
+        generator  
+            \tTuplas con las acciones bulk de cada bloque y la posición en la que termina
+    """
+    for block, offset in blocks:
+        actions, timings = decode_and_project(block, indexer)
+        if indexer.metrics:
+            for stage in timings:
+                indexer.metrics.add_time(stage, timings[stage])
+        yield actions, offset
 
-            indexed_size += block_size
-            bar.update(min(indexed_size, file_size))
 
-        bar.finish()
-        
-        f.close()        
-        print("- Stats:")
-        
-        # Se imprimen las estadísticas del indexado
-        print("\t*%s - Indexed: %d, Errors:%d, Filtered:%d"%(indexer.index_name, indexer.stats["indexed"], indexer.stats["errors"], indexer.stats["filtered"]))
+def decode_and_project(block, indexer):
+    """
+        Decodifica un bloque de líneas y lo transforma en acciones bulk, midiendo el tiempo de cada etapa.
+        En modo passthrough las líneas no se decodifican: sólo se extraen el id y los campos del filtro, y todo
+        el tiempo se contabiliza como "decode".
+
+        Parámetros
+        ----------
+        block: list of bytes  
+            \tLista de documentos json, cargados desde fichero
+        indexer: Indexer  
+            \tIndexer que filtra y proyecta los documentos
 
-        print(filename + " completado")
+        Salida
+        ------
+        list  
+            \tAcciones bulk del bloque
+        dict  
+            \tSegundos empleados en cada etapa, "decode" y "project"
+    """
+    start = time.perf_counter()
+    if indexer.passthrough:
+        actions = list(indexer.process_raw(block))
+        return actions, {"decode": time.perf_counter() - start}
+    documents = [json.loads(line) for line in block]
+    decoded = time.perf_counter()
+    actions = list(indexer.process_documents(documents))
+    return actions, {"decode": decoded - start, "project": time.perf_counter() - decoded}
 
 
-def index_block(block, indexer):
+def prepare_blocks(pool, blocks, indexer, window):
     """
-        Procesa un bloque de líneas de texto y delega en los indexers el indexado de los documentos.
+        Reparte el decodificado, filtrado y proyección de los bloques entre los procesos del pool.
+        Los resultados se devuelven en el mismo orden que en el fichero, de forma que las estadísticas son reproducibles.
+
+        Cada bloque se envía al pool con `apply_async` en cuanto se lee, con como mucho `window` bloques en vuelo.
+        Con `imap`, el único hilo del pool que reparte las tareas se quedaría consumiendo el generador de un fichero
+        hasta agotarlo, y el resto de ficheros simultáneos no recibirían bloques procesados hasta entonces.
 
         Parámetros
         ----------
-        block: list of str  
-            \tLista de documentos json, cargados como string desde fichero
+        pool: multiprocessing.Pool  
+            \tPool de procesos inicializado con `init_worker`
+        blocks: iterable  
+            \tBloques de líneas a procesar
         indexer: Indexer  
-            \tIndexador que procesará los documentos
+            \tIndexer en el que se acumulan los documentos filtrados
+        window: int  
+            \tNúmero máximo de bloques del fichero enviados al pool y pendientes de recoger
+
+        Salida
+        ------
+        generator  
+            \tTuplas con las acciones bulk de cada bloque y la posición en la que termina
     """
-    data = []
-    for line in block:
-        post = json.loads(line)
-        data.append(post)
-    
-    indexer.index_documents(data)
+    pending = collections.deque()
+    for item in blocks:
+        pending.append(pool.apply_async(prepare_block, (item,)))
+        if len(pending) >= window:
+            yield collect_block(pending.popleft().get(), indexer)
+    while pending:
+        yield collect_block(pending.popleft().get(), indexer)
+
+
+def collect_block(result, indexer):
+    """
+        Acumula en el indexer del fichero las estadísticas de un bloque procesado en el pool
+
+        Parámetros
+        ----------
+        result: tuple  
+            \tResultado de `prepare_block`: acciones, estadísticas y posición en la que termina el bloque
+        indexer: Indexer  
+            \tIndexer en el que se acumulan los documentos filtrados
+
+        Salida
+        ------
+        tuple  
+            \tAcciones bulk del bloque y posición en la que termina
+    """
+    actions, stats, offset = result
+    rules = stats.pop("rules")
+    if rules:
+        indexer.filter.dropped.update(rules)
+    timings = stats.pop("timings")
+    if indexer.metrics:
+        for stage in timings:
+            indexer.metrics.add_time(stage, timings[stage])
+    for key in stats:
+        indexer.stats[key] += stats[key]
+    return actions, offset
+
+
+def init_worker(index_name, indexer_options):
+    """
+        Inicializa cada proceso del pool con su propio indexer, sin conexión, utilizado únicamente
+        para filtrar y proyectar los documentos.
+
+        Parámetros
+        ----------
+        index_name: str  
+            \tNombre del índice destino
+        indexer_options: dict  
+            \tArgumentos con los que se construye el indexer: filtro y proyección
+    """
+    global worker_indexer
+    worker_indexer = Indexer(None, index_name, **indexer_options)
+
+
+def prepare_block(item):
+    """
+        Decodifica, filtra y proyecta un bloque de líneas dentro de un proceso del pool.
+
+        Parámetros
+        ----------
+        item: tuple  
+            \tLista de documentos json, cargados desde fichero, y posición en la que termina el bloque
+
+        Salida
+        ------
+        list  
+            \tAcciones bulk del bloque
+        dict  
+            \tDocumentos filtrados, descartes por regla del filtro, bytes ahorrados por la proyección y tiempo
+            de cada etapa en el bloque
+        int  
+            \tPosición en la que termina el bloque
+    """
+    block, offset = item
+    before = dict(worker_indexer.stats)
+    actions, timings = decode_and_project(block, worker_indexer)
+    stats = {key: worker_indexer.stats[key] - before[key] for key in ("filtered", "bytes_saved")}
+    stats["timings"] = timings
+    # Los descartes por regla se devuelven y se reinician para no contarlos dos veces
+    stats["rules"] = None
+    if worker_indexer.filter:
+        stats["rules"] = dict(worker_indexer.filter.dropped)
+        worker_indexer.filter.dropped.clear()
+    return actions, stats, offset
+
+
+def parse_date(date):
+    """
+        Convierte una fecha YYYY-mm-dd en el timestamp UTC de su comienzo, como el campo created_utc
+    """
+    return int(datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
 
 
 def parse_args():
@@ -113,6 +623,27 @@ def parse_args():
     parser.add_argument("-f", "--filter", help="Opcionalmente, se puede proporcionar un filtro a los indexadores. Será un .json con los campos y valores a filtrar.")
     parser.add_argument("-b", "--block-size", type=int, default=8, help="Tamaño de los bloques de líneas a indexar en Mb")
     parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch contra el que indexar")
+    parser.add_argument("-s", "--streaming", action="store_true", help="Indexa en modo streaming, solapando lectura y peticiones bulk")
+    parser.add_argument("-c", "--chunk-size", type=int, default=500, help="Número de documentos por petición bulk en modo streaming")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Número de peticiones bulk simultáneas en modo streaming")
+    parser.add_argument("-p", "--parallel-files", type=int, default=1, help="Número de ficheros a indexar simultáneamente")
+    parser.add_argument("-m", "--max-requests", type=int, default=8, help="Máximo de peticiones bulk en vuelo entre todos los ficheros")
+    parser.add_argument("--bulk-load", action="store_true", help="Desactiva refrescos y réplicas del índice durante la carga")
+    parser.add_argument("--force-merge", action="store_true", help="Con --bulk-load, fusiona los segmentos del índice al terminar")
+    parser.add_argument("--project-mapping", action="store_true", help="Envía sólo los campos mapeados en el índice")
+    parser.add_argument("--keep-fields", help="Campos no mapeados a conservar con --project-mapping, separados por comas")
+    parser.add_argument("--autotune", action="store_true", help="Adapta el tamaño de las peticiones bulk a la latencia y los rechazos del clúster")
+    parser.add_argument("--target-mb", type=float, default=5, help="Tamaño inicial de las peticiones bulk con --autotune, en MB")
+    parser.add_argument("--target-latency", type=float, default=5, help="Latencia objetivo de las peticiones bulk con --autotune, en segundos")
+    parser.add_argument("--passthrough", action="store_true", help="Envía las líneas tal cual y proyecta los campos en el servidor con una pipeline de ingesta")
+    parser.add_argument("--pipeline", help="Con --passthrough, pipeline de ingesta existente a utilizar")
+    parser.add_argument("--after", type=parse_date, help="Omite los volcados con manifiesto anteriores a esta fecha (YYYY-mm-dd)")
+    parser.add_argument("--before", type=parse_date, help="Omite los volcados con manifiesto posteriores a esta fecha (YYYY-mm-dd, no incluida)")
+    parser.add_argument("--stats-interval", type=float, default=60, help="Segundos entre líneas de resumen de las métricas, 0 para desactivarlas")
+    parser.add_argument("--report", help="Fichero JSON donde volcar el informe final de métricas")
+    parser.add_argument("-r", "--resume", action="store_true", help="Retoma el indexado desde el último checkpoint")
+    parser.add_argument("-k", "--checkpoint", help="Fichero de checkpoint. Por defecto, <data-dir>/<index>.checkpoint")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Número de procesos para decodificar, filtrar y proyectar los bloques")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -6,6 +6,9 @@
     Script encargado de emplear la API de Pushshift para extraer todos los post de un subreddit
     Se vuelcan los documentos obtenidos en ficheros .json y se indexan en Elasticsearch.
 
+    El historial del subreddit, desde su primer post hasta la fecha indicada, se divide en ventanas de tiempo que se
+    consultan de forma concurrente, compartiendo un límite de peticiones por segundo.
+
     Para ejecutar el script se necesita un fichero de texto con frases y escalas separadas por líneas siguiendo el siguiente formato:
 
         Frase 1;Escala 1  
@@ -19,19 +22,49 @@
     * -d, --dump-dir: directorio donde se volcarán los ficheros .json. Por defecto /dumps
     * -e, --elasticsearch: dirección del servidor Elasticsearch contra el que se indexará. Por defecto http://localhost:9200
     * -b, --before: fecha donde se comenzará a extraer posts hacia atrás en el tiempo. Por defecto, la fecha actual.
+    * -a, --after: fecha hasta la que se extraerán posts. Por defecto, la del primer post del subreddit.
+    * -w, --windows: número de ventanas de tiempo en las que se divide el historial. Por defecto, 32.
+    * -t, --threads: número de ventanas que se consultan a la vez. Por defecto, 4.
+    * --rate: peticiones por segundo permitidas a la API entre todos los hilos. Por defecto, 1.
+    * --burst: peticiones seguidas permitidas tras un periodo de inactividad. Por defecto, 5.
+    * --rate-lock: fichero con el que compartir el límite de peticiones con otros scripts que se ejecuten a la vez.
+    Opcional.
+    * --all-fields: descarga todos los campos de cada post en lugar de sólo los que se indexan (`Indexer.API_FIELDS`),
+    para que el volcado sea una copia completa.
+    * --cache-dir: directorio donde se guardan las respuestas de la API, para no repetir las consultas en siguientes
+    ejecuciones. Opcional.
+    * --cache-mb: tamaño máximo de la caché de respuestas, en MB. Por defecto, 2048.
+    * --cache-ttl: segundos de validez de las respuestas de la caché que no son totalmente históricas. Por defecto, 3600.
+    * --autotune: dimensiona las peticiones bulk por bytes, adaptando el tamaño a la latencia y los rechazos del clúster
+    y reintentando los documentos rechazados.
+    * --target-mb: tamaño inicial de las peticiones bulk con --autotune, en MB. Por defecto, 5.
+    * --target-latency: latencia objetivo de las peticiones bulk con --autotune, en segundos. Por defecto, 5.
+    * -q, --queue-size: lotes de documentos que pueden esperar a ser volcados o indexados en segundo plano antes de
+    detener la extracción. Por defecto, 8.
+    * --compress: comprime el volcado en streaming, "gzip" o "zstd". Opcional.
+    * --compress-level: nivel de compresión del volcado. Por defecto, 6 en gzip y 3 en zstd.
+    * --rotate-mb: rota el volcado en segmentos de este tamaño sin comprimir, en MB, cada uno con un manifiesto con el
+    número de documentos y el rango de fechas. Opcional.
+    * --rotate-minutes: rota el volcado en segmentos de esta duración, en minutos. Opcional.
+    * --stats-interval: segundos entre líneas de resumen de las métricas. 0 para desactivarlas. Por defecto, 60.
+    * --report: fichero JSON donde se vuelca el informe final de métricas. Opcional.
 
     Ejemplo de línea de ejecución.
 
         $ python main.py -s lonely -d dumps -e http://localhost:9200 -b 2019-12-31
 """
 
-from psaw import PushshiftAPI
 import argparse
 import datetime
-import json
 import os
 from elasticsearch import Elasticsearch
-from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer
+from src.elastic_utils.autotune import BulkAutotuner
+from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer, MultiIndexer
+from src.utils.instrumentation import Metrics
+from src.utils.pipeline import BackgroundPipeline, DumpWriter
+from src.utils.pushshift import PushshiftClient, split_windows, crawl_windows
+from src.utils.rate_limit import TokenBucket
+from src.utils.response_cache import ResponseCache
 import progressbar as pb
 
 __author__ = "Samuel Cifuentes García"
@@ -41,19 +74,52 @@ def main(args):
     global es
     es = Elasticsearch(args.elasticsearch)
 
-    # Inicializamos el cliente de la API
+    # Limitador de peticiones a la API compartido por todas las ventanas
+    global limiter
+    limiter = TokenBucket(rate=args.rate, burst=args.burst, lock_file=args.rate_lock)
+    # Caché de respuestas de la API, si se solicita
+    global response_cache
+    response_cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_mb*1024*1024), ttl=args.cache_ttl) if args.cache_dir else None
+    # Cliente de la API compartido por todas las ventanas
     global api
-    api = PushshiftAPI()
+    api = PushshiftClient(limiter, cache=response_cache)
 
     # Crea un directorio para los volcados si no existe
     if not os.path.exists(args.dump_dir):
         os.makedirs(args.dump_dir)
 
     # Crea el .json de backup donde se volcarán los post
-    global dump_filename
     dump_filename = args.dump_dir + "/" + args.subreddit.replace(" " ,"") + "-Dump.json"
 
-    query_API(args.subreddit, args.before)
+    # Métricas de la extracción: espera a la API, volcado e indexado
+    global metrics
+    metrics = Metrics("posts_from_subreddit")
+    metrics.start_reporting(args.stats_interval)
+
+    # Dimensionado adaptativo de las peticiones bulk, si se solicita. Las acciones de ambos índices se envían juntas
+    autotune = BulkAutotuner(target_bytes=int(args.target_mb*1024*1024), target_latency=args.target_latency) if args.autotune else None
+
+    # Escritor en los índices de unigramas y bigramas, creados una única vez si no existen
+    global writer
+    writer = MultiIndexer([Indexer(es, "subreddit-lonely", metrics=metrics, autotune=autotune),
+                           NgramIndexer(es, "subreddit-lonely-ngram", metrics=metrics, autotune=autotune)])
+
+    # El volcado y el indexado se hacen en segundo plano, mientras se sigue consultando la API
+    global pipeline
+    dump = DumpWriter(dump_filename, metrics, compression=args.compress, compress_level=args.compress_level,
+                      rotate_bytes=int(args.rotate_mb*1024*1024) if args.rotate_mb else None,
+                      rotate_seconds=args.rotate_minutes*60 if args.rotate_minutes else None)
+    with BackgroundPipeline(dump, elastic_index, queue_size=args.queue_size, metrics=metrics) as pipeline:
+        query_API(args.subreddit, args.before, args.after, windows=args.windows, threads=args.threads,
+                  fields=None if args.all_fields else Indexer.API_FIELDS)
+
+    metrics.stop_reporting()
+    print(metrics.summary())
+    print(limiter.summary())
+    if response_cache:
+        print(response_cache.summary())
+    if args.report:
+        metrics.write_report(args.report)
 
 def load_queries(filename):
     """
@@ -74,9 +140,10 @@ def load_queries(filename):
     
     return queries
 
-def query_API(subreddit, before_timestamp, cache_size = 3000):
+def query_API(subreddit, before_date, after_date=None, windows=32, threads=4, fields=None, cache_size = 3000):
     """
-        Se utiliza psaw (https://github.com/dmarx/psaw) para consumir la API de Pushshift y extraer submissions. 
+        Se consume la API de Pushshift con `PushshiftClient` para extraer submissions. 
+        El intervalo de fechas se divide en ventanas que se consultan de forma concurrente.
         A cada submission se le añaden tres campos: 
         * query: ""
         * scale: "r/loneliness"
@@ -84,16 +151,35 @@ def query_API(subreddit, before_timestamp, cache_size = 3000):
 
         Parámetros
         ----------
-        query: str
-            Frase a consultar contra la API
-        scale: str
-            Escala a la que pertenece la frase
+        subreddit: str
+            Subreddit del que se extraen los posts
+        before_date: date
+            Fecha hasta la que se extraen posts
+        after_date: date
+            Opcional. Fecha desde la que se extraen posts. Por defecto, la del primer post del subreddit
+        windows: int
+            Número de ventanas de tiempo en las que se divide el intervalo
+        threads: int
+            Número de ventanas que se consultan a la vez
+        fields: list
+            Opcional. Campos a descargar de cada post. Por defecto, todos
         cache_size: int
-            Opcional. Cada cuantos documentos se realiza un volcado e indexado
-        start_date: Date
-
+            Opcional. Cada cuantos documentos se encola un lote para su volcado e indexado
     """
-    gen = api.search_submissions(subreddit=subreddit, before=before_timestamp) # Todos los post antes de la fecha indicada
+    end = to_timestamp(before_date)
+    if after_date:
+        start = to_timestamp(after_date)
+    else:
+        # El primer post del subreddit marca el comienzo de su historial
+        first = next(api.search_submissions(fields=["created_utc"], subreddit=subreddit, sort="asc", limit=1), None)
+        if first is None:
+            return
+        start = first["created_utc"]
+
+    def search(after, before):
+        return api.search_submissions(fields=fields, subreddit=subreddit, after=after, before=before)
+
+    gen = crawl_windows(search, split_windows(start, end, windows), threads=threads)
     cache = []
     
     # Barra de progreso
@@ -101,15 +187,14 @@ def query_API(subreddit, before_timestamp, cache_size = 3000):
     bar = pb.ProgressBar(max_value=pb.UnknownLength, widgets=[
         "- ", pb.AnimatedMarker(), " ", pb.Counter(), " ", pb.Timer()
     ])
-    for c in bar(gen):
-        c.d_["query"] = ""
-        c.d_["scale"] = "r/"+subreddit 
-        c.d_["lonely"] = True        
-        cache.append(c.d_)
+    for post in bar(metrics.timed_iter(gen, "fetch")):
+        post["query"] = ""
+        post["scale"] = "r/"+subreddit 
+        post["lonely"] = True        
+        cache.append(post)
 
         if len(cache) == cache_size:      
-            dump_to_file(cache)
-            elastic_index(cache)
+            pipeline.put(cache)
             
             cache = []
 
@@ -118,42 +203,25 @@ def query_API(subreddit, before_timestamp, cache_size = 3000):
     bar.finish()
 
         
-    dump_to_file(cache)
-    elastic_index(cache)
+    pipeline.put(cache)
 
-def dump_to_file(results):
+def to_timestamp(date):
     """
-        Vuelca una lista de submissions a un fichero .json. Los volcados se deben realizar de forma parcial 
-        debido a limitaciones de memoria.
-        Las escrituras son mucho más rápidas si se tratan como strings en vez de objetos JSON.
-
-        Parámetros
-        ----------
-        results: list
-            lista de documentos a volcar   
+        Convierte una fecha en el timestamp de su comienzo, en hora local
     """
-    with open(dump_filename, "a") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
+    return int(datetime.datetime.combine(date, datetime.time()).timestamp())
 
 def elastic_index(results):
     """
         Indexa la lista de documentos pasados por parámetro. 
-        Se crean dos índices si no existen, uno para unigramas y otro para bigramas. 
+        Se escribe a la vez en dos índices, uno para unigramas y otro para bigramas, con un único flujo bulk. 
 
         Parámetros
         ----------
         results: list
             lista de documentos a indexar
     """
-    indexers = [Indexer(es, "subreddit-lonely"), NgramIndexer(es, "subreddit-lonely-ngram")]
-    for indexer in indexers:
-        if not indexer.index_exists():
-            indexer.create_index()
-            print("Creado índice: " + indexer.index_name)
-
-        
-        indexer.index_documents(results)
+    writer.index_documents(results)
 
 def parse_args():
     """
@@ -166,6 +234,27 @@ def parse_args():
     parser.add_argument("-b", "--before", default=datetime.date.today(), 
     type= lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date(), 
     help="timestamp desde el que se empezará a recuperar documentos hacia atrás en formato YYYY-mm-dd")
+    parser.add_argument("-a", "--after", type= lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date(),
+    help="fecha hasta la que se recuperarán documentos en formato YYYY-mm-dd. Por defecto, la del primer post del subreddit")
+    parser.add_argument("-w", "--windows", type=int, default=32, help="Número de ventanas de tiempo en las que se divide el historial")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Número de ventanas que se consultan a la vez")
+    parser.add_argument("--rate", type=float, default=1, help="Peticiones por segundo permitidas a la API entre todos los hilos")
+    parser.add_argument("--burst", type=int, default=5, help="Peticiones seguidas permitidas tras un periodo de inactividad")
+    parser.add_argument("--rate-lock", help="Fichero con el que compartir el límite de peticiones con otros scripts")
+    parser.add_argument("--all-fields", action="store_true", help="Descarga todos los campos de cada post, no sólo los que se indexan")
+    parser.add_argument("--cache-dir", help="Directorio de la caché de respuestas de la API")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Tamaño máximo de la caché de respuestas, en MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Segundos de validez de las respuestas no históricas de la caché")
+    parser.add_argument("--autotune", action="store_true", help="Adapta el tamaño de las peticiones bulk a la latencia y los rechazos del clúster")
+    parser.add_argument("--target-mb", type=float, default=5, help="Tamaño inicial de las peticiones bulk con --autotune, en MB")
+    parser.add_argument("--target-latency", type=float, default=5, help="Latencia objetivo de las peticiones bulk con --autotune, en segundos")
+    parser.add_argument("-q", "--queue-size", type=int, default=8, help="Lotes que pueden esperar a ser volcados o indexados en segundo plano")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], help="Comprime el volcado en streaming")
+    parser.add_argument("--compress-level", type=int, help="Nivel de compresión del volcado")
+    parser.add_argument("--rotate-mb", type=float, help="Rota el volcado en segmentos de este tamaño sin comprimir, en MB")
+    parser.add_argument("--rotate-minutes", type=float, help="Rota el volcado en segmentos de esta duración, en minutos")
+    parser.add_argument("--stats-interval", type=float, default=60, help="Segundos entre líneas de resumen de las métricas, 0 para desactivarlas")
+    parser.add_argument("--report", help="Fichero JSON donde volcar el informe final de métricas")
     return parser.parse_args()
 
 if __name__ == "__main__":
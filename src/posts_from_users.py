@@ -18,16 +18,47 @@
     * -s, --subreddits: Fichero con los subreddit a excluir
     * -e, --elasticsearch: dirección del servidor Elasticsearch contra el que se indexará. Por defecto http://localhost:9200
     * -b, --before: fecha donde se comenzará a extraer posts hacia atrás en el tiempo. Por defecto, la fecha actual.
+    * -t, --threads: bloques de usuarios consultados a la vez a la API, todos bajo el mismo límite de peticiones.
+    Por defecto, 4.
+    * --max-url-bytes: longitud máxima de la URL de cada petición. Los usuarios se agrupan en bloques tan grandes como
+    permita esta longitud, en lugar de en bloques de 100. Por defecto, 4096.
+    * --autotune: dimensiona las peticiones bulk por bytes, adaptando el tamaño a la latencia y los rechazos del clúster
+    y reintentando los documentos rechazados.
+    * --target-mb: tamaño inicial de las peticiones bulk con --autotune, en MB. Por defecto, 5.
+    * --target-latency: latencia objetivo de las peticiones bulk con --autotune, en segundos. Por defecto, 5.
+    * -q, --queue-size: lotes de documentos que pueden esperar a ser volcados o indexados en segundo plano antes de
+    detener la extracción. Por defecto, 8.
+    * --compress: comprime el volcado en streaming, "gzip" o "zstd". Opcional.
+    * --compress-level: nivel de compresión del volcado. Por defecto, 6 en gzip y 3 en zstd.
+    * --rotate-mb: rota el volcado en segmentos de este tamaño sin comprimir, en MB, cada uno con un manifiesto con el
+    número de documentos y el rango de fechas. Opcional.
+    * --rotate-minutes: rota el volcado en segmentos de esta duración, en minutos. Opcional.
+    * --rate: peticiones por segundo permitidas a la API. Por defecto, 1.
+    * --burst: peticiones seguidas permitidas tras un periodo de inactividad. Por defecto, 5.
+    * --rate-lock: fichero con el que compartir el límite de peticiones con otros scripts que se ejecuten a la vez.
+    Opcional.
+    * --all-fields: descarga todos los campos de cada post en lugar de sólo los que se indexan (`Indexer.API_FIELDS`),
+    para que el volcado sea una copia completa.
+    * --cache-dir: directorio donde se guardan las respuestas de la API, para no repetir las consultas en siguientes
+    ejecuciones. Opcional.
+    * --cache-mb: tamaño máximo de la caché de respuestas, en MB. Por defecto, 2048.
+    * --cache-ttl: segundos de validez de las respuestas de la caché que no son totalmente históricas. Por defecto, 3600.
+    * --stats-interval: segundos entre líneas de resumen de las métricas. 0 para desactivarlas. Por defecto, 60.
+    * --report: fichero JSON donde se vuelca el informe final de métricas. Opcional.
 
 """
-from psaw import PushshiftAPI
 import argparse
 from datetime import datetime as dt
 from datetime import date
-import json
 import os
 from elasticsearch import Elasticsearch
 from src.elastic_utils.elastic_indexers import Indexer, NgramIndexer
+from src.elastic_utils.autotune import BulkAutotuner
+from src.utils.instrumentation import Metrics
+from src.utils.pipeline import BackgroundPipeline, DumpWriter
+from src.utils.pushshift import PushshiftClient, crawl_parallel, pack_by_length
+from src.utils.rate_limit import TokenBucket
+from src.utils.response_cache import ResponseCache
 import progressbar as pb
 
 __author__ = "Samuel Cifuentes García"
@@ -38,9 +69,11 @@ def main(args):
     global es
     es = Elasticsearch(args.elasticsearch)
 
-    # Inicializamos el cliente de la API
-    global api
-    api = PushshiftAPI()
+    # Inicializamos el cliente de la API, con un limitador de peticiones
+    global api, limiter
+    limiter = TokenBucket(rate=args.rate, burst=args.burst, lock_file=args.rate_lock)
+    response_cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_mb*1024*1024), ttl=args.cache_ttl) if args.cache_dir else None
+    api = PushshiftClient(limiter, cache=response_cache)
 
     print("Cargando usuarios...")
     users = load_users(args.users)
@@ -55,8 +88,27 @@ def main(args):
         os.makedirs(args.dump_dir)
     dump_filename = args.dump_dir + "/user_posts-Dump.ndjson"
 
+    # Métricas de la extracción: espera a la API, volcado e indexado
+    global metrics
+    metrics = Metrics("posts_from_users")
+    metrics.start_reporting(args.stats_interval)
+
     print("Obteniendo e indexando posts...")
-    query_api(users, args.before, subreddits, filename = dump_filename)
+    autotune = BulkAutotuner(target_bytes=int(args.target_mb*1024*1024), target_latency=args.target_latency) if args.autotune else None
+    dump = DumpWriter(dump_filename, metrics, compression=args.compress, compress_level=args.compress_level,
+                      rotate_bytes=int(args.rotate_mb*1024*1024) if args.rotate_mb else None,
+                      rotate_seconds=args.rotate_minutes*60 if args.rotate_minutes else None)
+    query_api(users, args.before, subreddits, dump, autotune=autotune, queue_size=args.queue_size,
+              fields=None if args.all_fields else Indexer.API_FIELDS, threads=args.threads,
+              max_url_bytes=args.max_url_bytes)
+
+    metrics.stop_reporting()
+    print(metrics.summary())
+    print(limiter.summary())
+    if response_cache:
+        print(response_cache.summary())
+    if args.report:
+        metrics.write_report(args.report)
 
 
 def load_users(path):
@@ -85,7 +137,8 @@ def load_users(path):
           users[data[index_name]] = data[index_group]
     return users  
 
-def query_api(users, before_date, subreddits, filename="dumps/user_posts-Dump.ndjson", cache_size=10000):
+def query_api(users, before_date, subreddits, dump, cache_size=10000, autotune=None, queue_size=8, fields=None,
+              threads=4, max_url_bytes=4096):
     """
         Recupera los post de una lista de usuarios, los indexa en Elastic y vuelca a un fichero a modo
         de backup.  
@@ -99,18 +152,28 @@ def query_api(users, before_date, subreddits, filename="dumps/user_posts-Dump.nd
             \tFecha límite tras la cuál no se extraerán más documentos  
         subreddit: str
             \tNombre del subreddit a excluir  
-        filename: str  
-            \tNombre del fichero donde se volcarán los documentos  
+        dump: DumpWriter  
+            \tEscritor del volcado donde se guardarán los documentos  
         cache_size: int  
             \tTamaño de los bloques de documentos que se indexarán de cada vez. Regular en función
             de la memoria disponible
+        autotune: BulkAutotuner  
+            \tOpcional. Autotuner con el que dimensionar las peticiones bulk por bytes
+        queue_size: int  
+            \tLotes que pueden esperar a ser volcados o indexados en segundo plano
+        fields: list  
+            \tOpcional. Campos a descargar de cada post. Por defecto, todos
+        threads: int  
+            \tBloques de autores consultados a la vez
+        max_url_bytes: int  
+            \tLongitud máxima de la URL de cada petición, con la que se decide cuántos autores caben en un bloque
     """
     # Inicializar el indexer
     subreddit_filter = {
         "subreddit": subreddits
     }
 
-    indexer = Indexer(es, "phase-b", filter_criteria=subreddit_filter)
+    indexer = Indexer(es, "phase-b", filter_criteria=subreddit_filter, metrics=metrics, autotune=autotune)
     if not indexer.index_exists():
         print("Creado índice: " + indexer.index_name)
         indexer.create_index()
@@ -120,38 +183,36 @@ def query_api(users, before_date, subreddits, filename="dumps/user_posts-Dump.nd
         "- ", pb.AnimatedMarker(), " Docs processed: ", pb.Counter(), " ", pb.Timer()
     ])
     num_iter = 0
-    # Ahorramos tiempo de máquina consultando a la API de 100 en 100 usuarios
-    # Más no es viable porque superamos los límites de caracteres de la petición GET
-    user_block = []
-    for user in users:
-        user_block.append(user)
-
-        if len(user_block) == 100:
-            # Se extraen todos los posts del usuario
-            gen = api.search_submissions(author=user_block, before=int(before_date.timestamp()))
-
-            # El tamaño de la caché dependerá de la memoria que tengamos
-            cache = []
-            for c in gen:
-                # Usamos el campo muestra del .csv para marcar los posts como lonely o no
-                c.d_["lonely"] = users[c.d_["author"]] == "lonely"        
-                cache.append(c.d_)
-
-                if len(cache) == cache_size:      
-                    dump_to_file(cache, filename)
-                    indexer.index_documents(cache)
-                    
-                    cache = []
-                
-                # Actualizar barra
-                num_iter += 1
-                bar.update(num_iter)                
-
-            # Los restantes al salir del bucle
-            dump_to_file(cache, filename)
-            indexer.index_documents(cache)
-
-            user_block = []
+    # Se consulta a la API por bloques de autores tan grandes como permita la longitud máxima de la URL,
+    # contando con el resto de parámetros de la búsqueda
+    before = int(before_date.timestamp())
+    overhead = api.url_length("submission", fields=fields, author="", before=before)
+    blocks = list(pack_by_length(users, max_url_bytes - overhead))
+    print("Consultando %d usuarios en %d bloques"%(len(users), len(blocks)))
+
+    # Los bloques se consultan de forma concurrente, todos a través del mismo limitador
+    search = lambda block: api.search_submissions(fields=fields, author=",".join(block), before=before)
+
+    # El volcado y el indexado se hacen en segundo plano, mientras se sigue consultando la API
+    with BackgroundPipeline(dump, indexer.index_documents, queue_size=queue_size, metrics=metrics) as pipeline:
+        # El tamaño de la caché dependerá de la memoria que tengamos
+        cache = []
+        for post in metrics.timed_iter(crawl_parallel(search, blocks, threads=threads), "fetch"):
+            # Usamos el campo muestra del .csv para marcar los posts como lonely o no
+            post["lonely"] = users[post["author"]] == "lonely"
+            cache.append(post)
+
+            if len(cache) == cache_size:
+                pipeline.put(cache)
+
+                cache = []
+
+            # Actualizar barra
+            num_iter += 1
+            bar.update(num_iter)
+
+        # Los restantes al salir del bucle
+        pipeline.put(cache)
             
     print("\t*%s - Indexed: %d, Errors:%d, Filtered:%d"%(indexer.index_name, indexer.stats["indexed"], indexer.stats["errors"], indexer.stats["filtered"]))
 
@@ -177,21 +238,6 @@ def load_subreddits(path):
     return subreddits
 
 
-def dump_to_file(results, path):
-    """
-        Vuelca una lista de submissions a un fichero .ndjson. Los volcados se deben realizar de forma parcial 
-        debido a limitaciones de memoria.
-        Las escrituras son mucho más rápidas si se tratan como strings en vez de objetos JSON.
-
-        Parámetros
-        ----------
-        results: list
-            lista de documentos a volcar   
-    """
-    with open(path, "a") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
-
 def parse_args():
     """
         Procesamiento de los argumentos con los que se ejecutó el script
@@ -203,6 +249,25 @@ def parse_args():
     parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch contra el que se indexará")
     parser.add_argument("-b", "--before", default=dt.now(), type= lambda d: dt.strptime(d + " 23:59:59", '%Y-%m-%d %H:%M:%S'),
         help="Fecha desde la que se empezará a recuperar documentos hacia atrás en formato YYYY-mm-dd")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Bloques de usuarios consultados a la vez a la API")
+    parser.add_argument("--max-url-bytes", type=int, default=4096, help="Longitud máxima de la URL de cada petición a la API")
+    parser.add_argument("--autotune", action="store_true", help="Adapta el tamaño de las peticiones bulk a la latencia y los rechazos del clúster")
+    parser.add_argument("--target-mb", type=float, default=5, help="Tamaño inicial de las peticiones bulk con --autotune, en MB")
+    parser.add_argument("--target-latency", type=float, default=5, help="Latencia objetivo de las peticiones bulk con --autotune, en segundos")
+    parser.add_argument("-q", "--queue-size", type=int, default=8, help="Lotes que pueden esperar a ser volcados o indexados en segundo plano")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], help="Comprime el volcado en streaming")
+    parser.add_argument("--compress-level", type=int, help="Nivel de compresión del volcado")
+    parser.add_argument("--rotate-mb", type=float, help="Rota el volcado en segmentos de este tamaño sin comprimir, en MB")
+    parser.add_argument("--rotate-minutes", type=float, help="Rota el volcado en segmentos de esta duración, en minutos")
+    parser.add_argument("--rate", type=float, default=1, help="Peticiones por segundo permitidas a la API")
+    parser.add_argument("--burst", type=int, default=5, help="Peticiones seguidas permitidas tras un periodo de inactividad")
+    parser.add_argument("--rate-lock", help="Fichero con el que compartir el límite de peticiones con otros scripts")
+    parser.add_argument("--all-fields", action="store_true", help="Descarga todos los campos de cada post, no sólo los que se indexan")
+    parser.add_argument("--cache-dir", help="Directorio de la caché de respuestas de la API")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Tamaño máximo de la caché de respuestas, en MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Segundos de validez de las respuestas no históricas de la caché")
+    parser.add_argument("--stats-interval", type=float, default=60, help="Segundos entre líneas de resumen de las métricas, 0 para desactivarlas")
+    parser.add_argument("--report", help="Fichero JSON donde volcar el informe final de métricas")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+    Script para purgar y etiquetar posts de índices existentes a partir de listas de subreddits
+    -------------------------------------------------------------------------------------------
+    Elimina de los índices los posts de los subreddits de `subreddits_purgar.txt` y marca los de los subreddits de
+    `subreddits_etiquetar.txt`, sin tener que reindexar desde los volcados. Todo el trabajo se hace en el servidor con
+    las APIs Delete By Query y Update By Query
+    (https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-delete-by-query.html):
+
+    * Las listas se dividen en lotes de subreddits, y cada lote es una consulta `terms` sobre el campo subreddit.
+    * Cada consulta se lanza como una tarea en segundo plano (`wait_for_completion=False`) dividida automáticamente
+    en slices que se ejecutan en paralelo, uno por shard, y opcionalmente limitada a un número de documentos por segundo.
+    * Las tareas se consultan periódicamente con la API Tasks para mostrar su progreso y detectar errores.
+    * El etiquetado sólo actualiza los posts que no tienen ya la etiqueta, de modo que repetirlo no vuelve a
+    escribir los mismos documentos. Si el campo de la etiqueta no está en el mapeo del índice (que no es dinámico),
+    se añade antes de lanzar las tareas.
+
+    Parámetros
+    ----------
+    * indices: índices sobre los que actuar. Por defecto, phase-b y subreddit-lonely
+    * -e, --elasticsearch: dirección del servidor Elasticsearch. Por defecto, http://localhost:9200
+    * -p, --purge: fichero con los subreddits cuyos posts se eliminan. Por defecto, subreddits_purgar.txt
+    * -t, --tag: fichero con los subreddits cuyos posts se etiquetan. Por defecto, subreddits_etiquetar.txt
+    * -k, --keep: subreddits que nunca se purgan aunque estén en la lista. Por defecto, lonely, para conservar la
+    muestra positiva de subreddit-lonely
+    * --skip-purge: no elimina posts
+    * --skip-tag: no etiqueta posts
+    * --tag-field: campo en el que se escribe la etiqueta. Se añade como keyword al mapeo de los índices que no lo
+    tengan. Por defecto, "tagged"
+    * --tag-value: valor de la etiqueta, en JSON (por ejemplo, true o "relaciones"). Por defecto, true
+    * -b, --batch-size: subreddits de cada consulta `terms`. Por defecto, 250
+    * --slices: número de slices de cada tarea, o "auto" para uno por shard. Por defecto, auto
+    * --rps: documentos por segundo permitidos a cada tarea. Por defecto, sin límite
+    * --max-tasks: tareas que se ejecutan a la vez. Por defecto, 2
+    * --poll-interval: segundos entre consultas del estado de las tareas. Por defecto, 10
+    * --dry-run: sólo cuenta los posts que se eliminarían o etiquetarían
+"""
+
+from elasticsearch import Elasticsearch
+import argparse
+import json
+import time
+
+from src.utils.file_handler import list_from_file
+
+__author__ = "Samuel Cifuentes García"
+
+
+def main(args):
+    # Conexión a Elastic
+    global es
+    es = Elasticsearch(args.elasticsearch, timeout=600)
+
+    jobs = []
+    if not args.skip_purge:
+        # La lista de purga incluye el propio r/lonely: en subreddit-lonely se eliminaría la muestra positiva
+        subreddits = [subreddit for subreddit in load_subreddits(args.purge) if subreddit not in args.keep]
+        print("Cargados %d subreddits a purgar"%len(subreddits))
+        jobs += [("delete", index, batch, purge_query(batch))
+                 for index in args.indices for batch in batches(subreddits, args.batch_size)]
+    if not args.skip_tag:
+        subreddits = load_subreddits(args.tag)
+        print("Cargados %d subreddits a etiquetar"%len(subreddits))
+        if not args.dry_run:
+            for index in args.indices:
+                ensure_tag_mapping(index, args.tag_field)
+        jobs += [("update", index, batch, tag_query(batch, args.tag_field, args.tag_value))
+                 for index in args.indices for batch in batches(subreddits, args.batch_size)]
+
+    if args.dry_run:
+        for operation, index, batch, body in jobs:
+            count = es.count(index=index, body={"query": body["query"]})["count"]
+            print("\t*%s - %s: %d posts de %d subreddits"%(index, operation, count, len(batch)))
+        return
+
+    run_tasks(jobs, slices=args.slices, rps=args.rps, max_tasks=args.max_tasks, poll_interval=args.poll_interval)
+
+
+def load_subreddits(path):
+    """
+        Carga una lista de subreddits, uno por línea, descartando las líneas vacías y los repetidos
+
+        Parámetros
+        ----------
+        path: str
+            \tRuta del fichero
+
+        Salida
+        ------
+        list
+            \tLista de subreddits
+    """
+    return list(dict.fromkeys(subreddit for subreddit in list_from_file(path) if subreddit))
+
+
+def batches(values, size):
+    """
+        Divide una lista en lotes de un tamaño máximo
+
+        Parámetros
+        ----------
+        values: list
+            \tLista a dividir
+        size: int
+            \tTamaño máximo de cada lote
+
+        Salida
+        ------
+        generator
+            \tLotes de la lista
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def purge_query(subreddits):
+    """
+        Cuerpo de la petición Delete By Query que elimina los posts de un lote de subreddits
+
+        Parámetros
+        ----------
+        subreddits: list
+            \tLote de subreddits
+
+        Salida
+        ------
+        dict
+            \tCuerpo de la petición
+    """
+    return {
+        "query": {
+            "terms": {
+                "subreddit": subreddits
+            }
+        }
+    }
+
+
+def tag_query(subreddits, field, value):
+    """
+        Cuerpo de la petición Update By Query que etiqueta los posts de un lote de subreddits. Se excluyen los posts
+        que ya tienen la etiqueta
+
+        Parámetros
+        ----------
+        subreddits: list
+            \tLote de subreddits
+        field: str
+            \tCampo de la etiqueta
+        value: object
+            \tValor de la etiqueta
+
+        Salida
+        ------
+        dict
+            \tCuerpo de la petición
+    """
+    return {
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {"subreddit": subreddits}}
+                ],
+                "must_not": [
+                    {"term": {field: value}}
+                ]
+            }
+        },
+        "script": {
+            "source": "ctx._source[params.field] = params.value",
+            "lang": "painless",
+            "params": {"field": field, "value": value}
+        }
+    }
+
+
+def ensure_tag_mapping(index, field):
+    """
+        Añade el campo de la etiqueta al mapeo del índice si no existe. Los índices tienen mapeo no dinámico, por lo que
+        sin este paso la etiqueta sólo se guardaría en `_source`: no se podría buscar y el filtro que excluye los posts
+        ya etiquetados no tendría efecto. El campo es de tipo keyword, que admite tanto booleanos como textos
+
+        Parámetros
+        ----------
+        index: str
+            \tNombre del índice
+        field: str
+            \tCampo de la etiqueta
+    """
+    mappings = es.indices.get_field_mapping(fields=field, index=index, include_type_name=True)
+    # Respuesta con tipos: {índice: {"mappings": {"post": {campo: {...}}}}}
+    for data in mappings.values():
+        for fields in data.get("mappings", {}).values():
+            if field in fields:
+                return
+    print("Añadiendo el campo %s al mapeo de %s"%(field, index))
+    es.indices.put_mapping(index=index, doc_type="post", body={"properties": {field: {"type": "keyword"}}},
+                           include_type_name=True)
+
+
+def start_task(operation, index, body, slices="auto", rps=None):
+    """
+        Lanza una petición Delete By Query o Update By Query como tarea en segundo plano
+
+        Parámetros
+        ----------
+        operation: str
+            \t"delete" o "update"
+        index: str
+            \tNombre del índice
+        body: dict
+            \tCuerpo de la petición
+        slices: str
+            \tNúmero de slices, o "auto"
+        rps: float
+            \tDocumentos por segundo permitidos. None para no limitarlos
+
+        Salida
+        ------
+        str
+            \tIdentificador de la tarea
+    """
+    method = es.delete_by_query if operation == "delete" else es.update_by_query
+    res = method(index=index, body=body, slices=slices, conflicts="proceed", wait_for_completion=False,
+                 requests_per_second=rps if rps else -1, refresh=True)
+    return res["task"]
+
+
+def run_tasks(jobs, slices="auto", rps=None, max_tasks=2, poll_interval=10):
+    """
+        Ejecuta una lista de operaciones como tareas en segundo plano, con un máximo de tareas a la vez, consultando
+        su estado periódicamente hasta que terminan todas
+
+        Parámetros
+        ----------
+        jobs: list
+            \tOperaciones, en forma de tupla (operación, índice, lote de subreddits, cuerpo de la petición)
+        slices: str
+            \tNúmero de slices de cada tarea, o "auto"
+        rps: float
+            \tDocumentos por segundo permitidos a cada tarea
+        max_tasks: int
+            \tTareas que se ejecutan a la vez
+        poll_interval: float
+            \tSegundos entre consultas del estado de las tareas
+    """
+    pending = list(jobs)
+    running = {}
+    totals = {"deleted": 0, "updated": 0, "version_conflicts": 0, "failures": 0}
+    start = time.time()
+    while pending or running:
+        while pending and len(running) < max_tasks:
+            operation, index, batch, body = pending.pop(0)
+            task = start_task(operation, index, body, slices, rps)
+            running[task] = (operation, index, batch)
+            print("Lanzada tarea %s: %s en %s, %d subreddits"%(task, operation, index, len(batch)))
+
+        time.sleep(poll_interval)
+        for task in list(running):
+            res = es.tasks.get(task_id=task)
+            status = res["task"]["status"]
+            operation, index, batch = running[task]
+            if not res.get("completed"):
+                done = status["deleted"] + status["updated"] + status["version_conflicts"]
+                print("\t%s - %s en %s: %d/%d documentos"%(task, operation, index, done, status["total"]))
+                continue
+
+            del running[task]
+            response = res.get("response", {})
+            if "error" in res:
+                raise RuntimeError("La tarea %s ha fallado: %s"%(task, json.dumps(res["error"])))
+            for key in ("deleted", "updated", "version_conflicts"):
+                totals[key] += response.get(key, status[key])
+            totals["failures"] += len(response.get("failures", []))
+            print("\t*%s - %s: %d eliminados, %d actualizados, %d conflictos, %d fallos"%(
+                index, operation, response.get("deleted", status["deleted"]), response.get("updated", status["updated"]),
+                response.get("version_conflicts", status["version_conflicts"]), len(response.get("failures", []))))
+
+    print("Completado en %.0fs: %d eliminados, %d actualizados, %d conflictos, %d fallos"%(
+        time.time() - start, totals["deleted"], totals["updated"], totals["version_conflicts"], totals["failures"]))
+
+
+def parse_args():
+    """
+        Procesamiento de los argumentos con los que se ejecutó el script
+    """
+    parser = argparse.ArgumentParser(
+        description="Script para purgar y etiquetar posts de índices existentes a partir de listas de subreddits")
+    parser.add_argument("indices", nargs="*", default=["phase-b", "subreddit-lonely"], help="Índices sobre los que actuar")
+    parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch")
+    parser.add_argument("-p", "--purge", default="subreddits_purgar.txt", help="Fichero con los subreddits cuyos posts se eliminan")
+    parser.add_argument("-t", "--tag", default="subreddits_etiquetar.txt", help="Fichero con los subreddits cuyos posts se etiquetan")
+    parser.add_argument("-k", "--keep", nargs="*", default=["lonely"], help="Subreddits que nunca se purgan")
+    parser.add_argument("--skip-purge", action="store_true", help="No elimina posts")
+    parser.add_argument("--skip-tag", action="store_true", help="No etiqueta posts")
+    parser.add_argument("--tag-field", default="tagged", help="Campo en el que se escribe la etiqueta")
+    parser.add_argument("--tag-value", type=json.loads, default=True, help="Valor de la etiqueta, en JSON")
+    parser.add_argument("-b", "--batch-size", type=int, default=250, help="Subreddits de cada consulta terms")
+    parser.add_argument("--slices", default="auto", help="Número de slices de cada tarea, o auto para uno por shard")
+    parser.add_argument("--rps", type=float, help="Documentos por segundo permitidos a cada tarea")
+    parser.add_argument("--max-tasks", type=int, default=2, help="Tareas que se ejecutan a la vez")
+    parser.add_argument("--poll-interval", type=float, default=10, help="Segundos entre consultas del estado de las tareas")
+    parser.add_argument("--dry-run", action="store_true", help="Sólo cuenta los posts que se eliminarían o etiquetarían")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
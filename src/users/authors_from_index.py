@@ -9,27 +9,37 @@
     * -e, --elasticsearch: Dirección del servidor elastic contra el que indexar. Por defecto, http://localhost:9200
     * -b, --before: Fecha límite utilizada para obtener el número de posts de cada usuario. No se contarán posts creados
     posteriormente a dicha fecha.
+    * --rate: peticiones por segundo permitidas a la API. Por defecto, 1.
+    * --burst: peticiones seguidas permitidas tras un periodo de inactividad. Por defecto, 5.
+    * --rate-lock: fichero con el que compartir el límite de peticiones con otros scripts que se ejecuten a la vez.
+    Opcional.
+    * --cache-dir: directorio donde se guardan las respuestas de la API, para no repetir las consultas en siguientes
+    ejecuciones. Opcional.
+    * --cache-mb: tamaño máximo de la caché de respuestas, en MB. Por defecto, 2048.
+    * --cache-ttl: segundos de validez de las respuestas de la caché que no son totalmente históricas. Por defecto, 3600.
 
 """
 
 from elasticsearch import Elasticsearch
 import pickle
-from psaw import PushshiftAPI
-import requests
 import datetime
 import progressbar as pb
-import time
 import argparse
 from src.elastic_utils.elastic_indexers import UserIndexer
+from src.utils.pushshift import PushshiftClient
+from src.utils.rate_limit import TokenBucket
+from src.utils.response_cache import ResponseCache
 
 
 __author__= "Samuel Cifuentes García"
 
 
 def main(args):
-    global es, api
+    global es, api, limiter, response_cache
     es = Elasticsearch(args.elasticsearch)
-    api = PushshiftAPI()
+    limiter = TokenBucket(rate=args.rate, burst=args.burst, lock_file=args.rate_lock)
+    response_cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_mb*1024*1024), ttl=args.cache_ttl) if args.cache_dir else None
+    api = PushshiftClient(limiter, cache=response_cache)
 
     # Extraer lista de autores en el índice
     print("Obteniendo lista de autores...")
@@ -37,7 +47,12 @@ def main(args):
     
     # Obtener datos de los autores
     print("Obteniendo datos de los autores...")
-    to_index = get_user_data(authors, args.before)
+    # La API espera un timestamp: así las respuestas anteriores a la fecha se guardan en la caché como históricas
+    before_date = int(datetime.datetime.combine(args.before, datetime.time(hour=23, minute=59, second=59)).timestamp())
+    to_index = get_user_data(authors, before_date)
+    print(limiter.summary())
+    if response_cache:
+        print(response_cache.summary())
 
     # Indexar
     print("Indexando documentos...")
@@ -137,14 +152,10 @@ def get_user_data(authors, before_date):
         j = min(i+step, len(authors))
 
         # Llamada a la API para obtener todos los datos necesarios excepto el número de posts
-        r = requests.get("http://api.pushshift.io/reddit/author/lookup?author="+ ",".join(authors[i:j]))
-        if r.status_code != 200:
-            print("Error", r.status_code)
-        authors_data = r.json()["data"]
+        authors_data = api.get("http://api.pushshift.io/reddit/author/lookup", {"author": ",".join(authors[i:j])})["data"]
 
         # Se obtiene el número de posts de cada autor
-        gen = api.search_submissions(author=authors[i:j], aggs="author", size=0, before=before_date)
-        authors_posts = next(gen)["author"]
+        authors_posts = api.aggregate("submission", "author", author=authors[i:j], before=before_date)
 
         for user in authors_data:
             # Busca el número de posts en la salida de la segunda consulta
@@ -155,8 +166,6 @@ def get_user_data(authors, before_date):
                 user["comment_karma"], user["link_karma"], user["posts"])
             )
             id +=1
-        
-        time.sleep(0.5)
     return users
 
 def parse_args():
@@ -170,6 +179,12 @@ def parse_args():
     parser.add_argument("-b", "--before", default=datetime.date.today(), 
         type= lambda d: datetime.datetime.strptime(d, '%Y-%m-%d').date(), 
         help="Fecha límite para obtener el número de posts de los usuarios")
+    parser.add_argument("--rate", type=float, default=1, help="Peticiones por segundo permitidas a la API")
+    parser.add_argument("--burst", type=int, default=5, help="Peticiones seguidas permitidas tras un periodo de inactividad")
+    parser.add_argument("--rate-lock", help="Fichero con el que compartir el límite de peticiones con otros scripts")
+    parser.add_argument("--cache-dir", help="Directorio de la caché de respuestas de la API")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Tamaño máximo de la caché de respuestas, en MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Segundos de validez de las respuestas no históricas de la caché")
     return parser.parse_args()
 
 if __name__== "__main__":
@@ -6,14 +6,22 @@
     * -i, --index: Nombre del índice de usuarios a crear.
     * -d, --data: Ruta del archivo con el dataset de usuarios.
     * -e, --elasticsearch: Dirección del servidor elastic contra el que indexar. Por defecto, http://localhost:9200
+    * --autotune: dimensiona las peticiones bulk por bytes, adaptando el tamaño a la latencia y los rechazos del clúster
+    y reintentando los documentos rechazados.
+    * --target-mb: tamaño inicial de las peticiones bulk con --autotune, en MB. Por defecto, 5.
+    * --target-latency: latencia objetivo de las peticiones bulk con --autotune, en segundos. Por defecto, 5.
+    * --bulk-load: desactiva refrescos y réplicas del índice mientras dura la carga, restaurándolos al final.
+    * --force-merge: con --bulk-load, fusiona los segmentos del índice al terminar.
 """
 
 import csv
 import gzip
 from elasticsearch import Elasticsearch
 from src.elastic_utils.elastic_indexers import UserIndexer
+from src.elastic_utils.autotune import BulkAutotuner
 import progressbar as pb
 import argparse
+import contextlib
 
 __author__ = "Samuel Cifuentes García"
 
@@ -22,7 +30,8 @@ CHUNK_SIZE = 500000
 def main(args):
     es = Elasticsearch(args.elasticsearch)
     # Se crea el índice si no existe
-    indexer = UserIndexer(es, args.index)
+    autotune = BulkAutotuner(target_bytes=int(args.target_mb*1024*1024), target_latency=args.target_latency) if args.autotune else None
+    indexer = UserIndexer(es, args.index, autotune=autotune)
     if not indexer.index_exists():
         print("Creando índice " + indexer.index_name)
         indexer.create_index()
@@ -34,15 +43,18 @@ def main(args):
     headers = next(data)
 
     print("Indexando...")
-    bar = pb.ProgressBar()
-    cache = []
-    for line in bar(data):
-        cache.append(line)
+    # Modo de carga masiva, si se solicita
+    load_context = indexer.bulk_load(force_merge=args.force_merge) if args.bulk_load else contextlib.nullcontext()
+    with load_context:
+        bar = pb.ProgressBar()
+        cache = []
+        for line in bar(data):
+            cache.append(line)
 
-        # Por limitaciones de memoria se indexa en trozos
-        if len(cache) >= CHUNK_SIZE:
-            indexer.index_documents(cache, headers)
-            cache = []
+            # Por limitaciones de memoria se indexa en trozos
+            if len(cache) >= CHUNK_SIZE:
+                indexer.index_documents(cache, headers)
+                cache = []
 
 def parse_args():
     """
@@ -52,6 +64,11 @@ def parse_args():
     parser.add_argument("-i", "--index", default="users-reddit", help="Nombre del índice de Elasticsearch en el que se indexaran los usuarios")
     parser.add_argument("-d", "--data", default="dataset-users/data.csv.gz", help="Ruta del archivo con el dataset de usuarios")
     parser.add_argument("-e", "--elasticsearch", default="http://localhost:9200", help="Dirección del servidor Elasticsearch")
+    parser.add_argument("--autotune", action="store_true", help="Adapta el tamaño de las peticiones bulk a la latencia y los rechazos del clúster")
+    parser.add_argument("--target-mb", type=float, default=5, help="Tamaño inicial de las peticiones bulk con --autotune, en MB")
+    parser.add_argument("--target-latency", type=float, default=5, help="Latencia objetivo de las peticiones bulk con --autotune, en segundos")
+    parser.add_argument("--bulk-load", action="store_true", help="Desactiva refrescos y réplicas del índice durante la carga")
+    parser.add_argument("--force-merge", action="store_true", help="Con --bulk-load, fusiona los segmentos del índice al terminar")
     return parser.parse_args()
 
 if __name__=="__main__":
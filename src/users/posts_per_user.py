@@ -10,9 +10,19 @@
     * -s, --source: Ruta del archivo con el diccionario resultante de la ejecución de `find_possible_twins`
     * -o, --output: Fichero dónde se volcarán los resultados
     * -b, --before: Fecha límite antes de la cúal se obtendrá el número de posts de los usuarios
+    * --rate: peticiones por segundo permitidas a la API. Por defecto, 1.
+    * --burst: peticiones seguidas permitidas tras un periodo de inactividad. Por defecto, 5.
+    * --rate-lock: fichero con el que compartir el límite de peticiones con otros scripts que se ejecuten a la vez.
+    Opcional.
+    * --cache-dir: directorio donde se guardan las respuestas de la API, para no repetir las consultas en siguientes
+    ejecuciones. Opcional.
+    * --cache-mb: tamaño máximo de la caché de respuestas, en MB. Por defecto, 2048.
+    * --cache-ttl: segundos de validez de las respuestas de la caché que no son totalmente históricas. Por defecto, 3600.
 """
 import argparse
-from psaw import PushshiftAPI
+from src.utils.pushshift import PushshiftClient
+from src.utils.rate_limit import TokenBucket
+from src.utils.response_cache import ResponseCache
 import pickle
 import progressbar as pb
 from datetime import datetime as dt
@@ -27,7 +37,9 @@ def main(args):
     # en cuanto a tiempo de máquina. Es importante escoger un valor adecuado
     # de MAX_USERS en el script find_possible_twins para que no se vuelva inviable
     # la ejecución de este script
-    api = PushshiftAPI()
+    limiter = TokenBucket(rate=args.rate, burst=args.burst, lock_file=args.rate_lock)
+    response_cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_mb*1024*1024), ttl=args.cache_ttl) if args.cache_dir else None
+    api = PushshiftClient(limiter, cache=response_cache)
     before_date = int(dt.combine(args.before, time(hour=23, minute=59, second=59)).timestamp())
 
     print("Cargando datos...")
@@ -50,17 +62,17 @@ def main(args):
             block.append(user)
             # Debemos consultarlos de 100 en 100
             if len(block) >= 100:
-                gen = api.search_submissions(author=block, aggs="author", size=0, before=before_date)
-                res = next(gen)
-                for author in res["author"]:
+                for author in api.aggregate("submission", "author", author=block, before=before_date):
                     f.write(";".join((author["key"], str(author["doc_count"]))) + "\n")
                 block = []
 
-        gen = api.search_submissions(author=block, aggs="author", size=0)
-        res = next(gen)
-        for author in res["author"]: 
+        for author in api.aggregate("submission", "author", author=block): 
             f.writelines(";".join((author["key"], str(author["doc_count"]))) + "\n")
 
+    print(limiter.summary())
+    if response_cache:
+        print(response_cache.summary())
+
 
 def parse_args():
     """
@@ -73,6 +85,12 @@ def parse_args():
     parser.add_argument("-b", "--before", default=date.today(), 
         type= lambda d: dt.strptime(d, '%Y-%m-%d').date(), 
         help="Fecha límite para obtener el número de posts de los usuarios")
+    parser.add_argument("--rate", type=float, default=1, help="Peticiones por segundo permitidas a la API")
+    parser.add_argument("--burst", type=int, default=5, help="Peticiones seguidas permitidas tras un periodo de inactividad")
+    parser.add_argument("--rate-lock", help="Fichero con el que compartir el límite de peticiones con otros scripts")
+    parser.add_argument("--cache-dir", help="Directorio de la caché de respuestas de la API")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Tamaño máximo de la caché de respuestas, en MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Segundos de validez de las respuestas no históricas de la caché")
     return parser.parse_args()
 
 if __name__ == "__main__":
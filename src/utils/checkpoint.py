@@ -0,0 +1,89 @@
+"""
+    Checkpoints de indexado en disco
+    --------------------------------
+    Fichero auxiliar en formato JSON donde se registra, para cada fichero de entrada, el último byte cuyo contenido ha sido
+    confirmado por Elasticsearch junto con las estadísticas del indexer en ese momento. Permite retomar un indexado
+    interrumpido sin reenviar los documentos ya indexados.
+"""
+
+import json
+import os
+import threading
+
+__author__ = "Samuel Cifuentes García"
+
+
+class Checkpoint:
+    """
+        Checkpoint de un indexado, compartido entre todos los ficheros que se procesan.
+        Es seguro utilizarlo desde varios hilos a la vez.
+
+        El fichero tiene la siguiente estructura:
+        ```json
+        {
+            "fichero1.json": {"offset": 1048576, "completed": false, "stats": {"indexed": 1000, "errors": 0, "filtered": 3},
+                              "dropped": {"exclude:subreddit": 3}},
+            ...
+        }
+        ```
+
+        Atributos
+        ---------
+        path: str
+            \tRuta del fichero de checkpoint
+        files: dict
+            \tEstado de cada fichero de entrada
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.files = {}
+        self.lock = threading.Lock()
+        # Si no se retoma una ejecución anterior, se empieza con un checkpoint vacío
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)
+
+    def get(self, filename):
+        """
+            Devuelve el estado registrado de un fichero
+
+            Parámetros
+            ----------
+            filename: str  
+                \tNombre del fichero de entrada
+
+            Salida
+            ------
+            dict  
+                \tEstado del fichero: offset, estadísticas y si se completó. Vacío si no hay registro.
+        """
+        with self.lock:
+            return dict(self.files.get(filename, {}))
+
+    def update(self, filename, offset, stats, completed=False, dropped=None):
+        """
+            Registra el avance de un fichero y persiste el checkpoint en disco.
+
+            Parámetros
+            ----------
+            filename: str  
+                \tNombre del fichero de entrada
+            offset: int  
+                \tPosición del último byte confirmado por Elasticsearch. En los .gz, posición en el contenido descomprimido
+            stats: dict  
+                \tEstadísticas del indexer
+            completed: bool  
+                \tIndica si el fichero se ha indexado completamente
+            dropped: dict  
+                \tOpcional. Documentos descartados por cada regla del filtro del indexer
+        """
+        with self.lock:
+            self.files[filename] = {"offset": offset, "completed": completed, "stats": dict(stats)}
+            if dropped is not None:
+                self.files[filename]["dropped"] = dict(dropped)
+            # Escritura atómica para no corromper el checkpoint si el proceso muere a mitad
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.files, f)
+            os.replace(tmp_path, self.path)
@@ -2,8 +2,23 @@
     Funciones básicas de manejo de ficheros que son utilizadas por otros scrips
 """
 
+import bz2
+import gzip
+import io
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 __author__: "Samuel Cifuentes García"
 
+# Extensiones de los ficheros comprimidos que se pueden leer en streaming
+COMPRESSED_EXTENSIONS = (".gz", ".zst", ".xz", ".bz2")
+# Ventana máxima de los .zst de Pushshift, comprimidos con --long=31
+ZSTD_MAX_WINDOW = 2**31
+
 def write_to_csv(filename, data, header=None):
     """
         Serializa una lista de tuplas en formato .csv
@@ -41,4 +56,68 @@ def list_from_file(filename):
     with open(filename) as f:
         for line in f:
             data.append(line.strip())
-    return data
\ No newline at end of file
+    return data
+
+def open_compressed(path, read_size=1024*1024):
+    """
+        Abre un fichero en binario, descomprimiéndolo en streaming según su extensión (.gz, .zst, .xz o .bz2).
+        La descompresión se hace por trozos, sin volcar el fichero descomprimido a disco ni cargarlo en memoria.
+
+        Parámetros
+        ----------
+        path: str
+            Ruta del fichero
+        read_size: int
+            Bytes comprimidos que se leen del disco de cada vez en los .zst
+
+        Salida
+        ------
+        file
+            Fichero descomprimido, con `readlines` y `tell` sobre los bytes descomprimidos
+        file
+            Fichero en disco sobre el que se abrió el anterior, para medir el avance sobre los bytes comprimidos.
+            En los no comprimidos, el mismo objeto
+    """
+    raw = open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.GzipFile(fileobj=raw), raw
+    if path.endswith(".xz"):
+        return lzma.LZMAFile(raw), raw
+    if path.endswith(".bz2"):
+        return bz2.BZ2File(raw), raw
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raw.close()
+            raise ImportError("Se necesita el paquete zstandard para leer ficheros .zst")
+        # Los volcados a los que se ha añadido contenido tienen varios frames seguidos
+        decompressor = zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW)
+        reader = decompressor.stream_reader(raw, read_size=read_size, read_across_frames=True, closefd=False)
+        # El lector de zstandard no implementa readline, el buffer sí
+        return io.BufferedReader(reader, buffer_size=read_size), raw
+    return raw, raw
+
+def skip_to(f, offset, chunk_size=16*1024*1024):
+    """
+        Avanza un fichero abierto con `open_compressed` hasta una posición de los datos descomprimidos.
+        Los .zst no admiten `seek`, por lo que se lee y descarta hasta llegar a la posición. En los .gz, .xz y .bz2
+        `seek` sí existe, pero también descomprime desde el principio: sólo en los no comprimidos el coste no depende
+        de la posición.
+
+        Parámetros
+        ----------
+        f: file
+            Fichero descomprimido, en su posición inicial
+        offset: int
+            Posición en bytes descomprimidos
+        chunk_size: int
+            Bytes que se descartan de cada vez
+    """
+    if f.seekable():
+        f.seek(offset)
+        return
+    remaining = offset - f.tell()
+    while remaining > 0:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
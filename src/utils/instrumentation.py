@@ -0,0 +1,273 @@
+"""
+    Instrumentación de los scripts de extracción e indexado
+    -------------------------------------------------------
+    Métricas comunes para saber si una ejecución lenta está limitada por el disco, la CPU o el clúster:
+
+    * Temporizadores por etapa (lectura, decodificado, proyección/filtrado, bulk...).
+    * Documentos y bytes procesados, de los que se obtienen docs/s y MB/s.
+    * Histograma de la latencia de las peticiones bulk.
+    * Errores de Elasticsearch agrupados por tipo.
+
+    Se puede imprimir una línea de resumen periódica y volcar un informe final en JSON.
+"""
+
+from contextlib import contextmanager
+from collections import Counter
+import bisect
+import json
+import threading
+import time
+
+__author__ = "Samuel Cifuentes García"
+
+# Límites superiores, en segundos, de los intervalos del histograma de latencias
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Metrics:
+    """
+        Métricas de una ejecución. Es seguro actualizarlas desde varios hilos.
+
+        Atributos
+        ---------
+        name: str
+            \tNombre de la ejecución, se muestra en las líneas de resumen
+        stages: Counter
+            \tSegundos acumulados en cada etapa
+        counters: Counter
+            \tContadores: documentos, bytes leídos, bytes decodificados...
+        latencies: list
+            \tNúmero de peticiones bulk en cada intervalo de `LATENCY_BUCKETS`. La última posición cuenta las que lo superan
+        errors: Counter
+            \tErrores de Elasticsearch por tipo
+    """
+
+    def __init__(self, name=""):
+        self.name = name
+        self.start = time.time()
+        self.stages = Counter()
+        self.counters = Counter()
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.errors = Counter()
+        self.lock = threading.Lock()
+        self._stop = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+            Contexto que acumula el tiempo empleado en una etapa
+
+                with metrics.stage("read"):
+                    block = f.readlines(block_size)
+
+            Parámetros
+            ----------
+            name: str  
+                \tNombre de la etapa
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """
+            Suma tiempo a una etapa, por ejemplo, medido en otro proceso
+
+            Parámetros
+            ----------
+            name: str  
+                \tNombre de la etapa
+            seconds: float  
+                \tSegundos a añadir
+        """
+        with self.lock:
+            self.stages[name] += seconds
+
+    def count(self, name, value=1):
+        """
+            Incrementa un contador
+
+            Parámetros
+            ----------
+            name: str  
+                \tNombre del contador, por ejemplo "docs" o "bytes"
+            value: int  
+                \tIncremento
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def timed_iter(self, iterable, name):
+        """
+            Generador que recorre un iterable acumulando en una etapa el tiempo que se tarda en obtener cada
+            elemento. Útil para medir lo que se espera a la API de Pushshift.
+
+            Parámetros
+            ----------
+            iterable: iterable  
+                \tIterable a recorrer
+            name: str  
+                \tNombre de la etapa
+
+            Salida
+            ------
+            generator  
+                \tLos mismos elementos del iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def record_bulk(self, seconds):
+        """
+            Registra la latencia de una petición bulk, tanto en el histograma como en la etapa "bulk"
+
+            Parámetros
+            ----------
+            seconds: float  
+                \tDuración de la petición
+        """
+        with self.lock:
+            self.latencies[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.stages["bulk"] += seconds
+            self.counters["requests"] += 1
+
+    def record_error(self, item):
+        """
+            Registra un error devuelto por los helpers de bulk, clasificándolo por su tipo
+
+            Parámetros
+            ----------
+            item: dict  
+                \tError tal y como lo devuelven los helpers: {"index": {"status": ..., "error": ...}}
+        """
+        info = next(iter(item.values()), {}) if isinstance(item, dict) else {}
+        error = info.get("error")
+        if isinstance(error, dict):
+            error_type = error.get("type", "unknown")
+        elif "exception" in info:
+            error_type = type(info["exception"]).__name__
+        else:
+            error_type = "status_" + str(info.get("status", "unknown"))
+        with self.lock:
+            self.errors[error_type] += 1
+
+    def summary(self):
+        """
+            Línea de resumen con el estado actual de las métricas
+
+            Salida
+            ------
+            str  
+                \tResumen de documentos, rendimiento, etapas y errores
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-6)
+            docs = self.counters["docs"]
+            line = "[%s %.0fs] %d docs, %.1f docs/s, %.2f MB/s" % (self.name, elapsed, docs, docs/elapsed,
+                                                                    self.counters["bytes"]/1024/1024/elapsed)
+            if self.stages:
+                line += " | " + ", ".join("%s %.1fs" % stage for stage in sorted(self.stages.items()))
+            if self.errors:
+                line += " | errores: " + ", ".join("%s=%d" % error for error in self.errors.most_common())
+        return line
+
+    def report(self):
+        """
+            Informe completo de la ejecución
+
+            Salida
+            ------
+            dict  
+                \tMétricas en un diccionario serializable en JSON
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-6)
+            histogram = {}
+            for i, count in enumerate(self.latencies):
+                label = "<=%gs" % LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else ">%gs" % LATENCY_BUCKETS[-1]
+                histogram[label] = count
+            return {
+                "name": self.name,
+                "elapsed": elapsed,
+                "counters": dict(self.counters),
+                "docs_per_second": self.counters["docs"]/elapsed,
+                "mb_per_second": self.counters["bytes"]/1024/1024/elapsed,
+                "stages": dict(self.stages),
+                "bulk_latency": histogram,
+                "errors": dict(self.errors)
+            }
+
+    def write_report(self, path):
+        """
+            Vuelca el informe final a un fichero JSON
+
+            Parámetros
+            ----------
+            path: str  
+                \tRuta del fichero
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+    def start_reporting(self, interval):
+        """
+            Lanza un hilo que imprime una línea de resumen cada `interval` segundos, hasta llamar a `stop_reporting`
+
+            Parámetros
+            ----------
+            interval: float  
+                \tSegundos entre resúmenes. Si es 0 no se imprime nada
+        """
+        if not interval:
+            return
+        self._stop = threading.Event()
+
+        def run():
+            while not self._stop.wait(interval):
+                print(self.summary(), flush=True)
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_reporting(self):
+        """
+            Detiene el hilo de resúmenes periódicos
+        """
+        if self._stop:
+            self._stop.set()
+
+
+class InstrumentedClient:
+    """
+        Envoltorio de una conexión de Elasticsearch que mide la latencia de cada petición bulk.
+        El resto de atributos se delegan en la conexión original, por lo que puede pasarse a los helpers de bulk.
+
+        Atributos
+        ---------
+        client: Elasticsearch
+            \tConexión original
+        metrics: Metrics
+            \tMétricas donde se registran las latencias
+    """
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def bulk(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.client.bulk(*args, **kwargs)
+        finally:
+            self.metrics.record_bulk(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,291 @@
+"""
+    Volcado e indexado en segundo plano
+    -----------------------------------
+    Los scripts de extracción consumen la API de Pushshift y, por cada lote de documentos, los vuelcan a disco y los
+    indexan en Elasticsearch. Si estas dos etapas se ejecutan en el mismo hilo, la API espera al disco y al clúster.
+    `BackgroundPipeline` reparte cada lote entre dos consumidores en segundo plano, uno que escribe el volcado y otro que
+    indexa, con colas acotadas: la extracción sólo se bloquea si alguna de las colas está llena.
+"""
+
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = "Samuel Cifuentes García"
+
+
+class DumpWriter:
+    """
+        Escritor de volcados .ndjson. El fichero se abre una única vez, con un buffer grande, y se puede comprimir en
+        streaming con gzip o zstd.
+
+        Opcionalmente, el volcado se rota por tamaño o por tiempo en segmentos numerados (`<nombre>-00001.ndjson.gz`...).
+        Junto a cada segmento se escribe un manifiesto `<segmento>.manifest.json` con el número de documentos, el rango
+        de `created_utc` y las posiciones en bytes (sin comprimir) en las que empieza y termina el segmento dentro del
+        volcado de la ejecución, de modo que los lectores pueden descartar segmentos enteros por fecha.
+
+        Atributos
+        ---------
+        path: str
+            \tRuta del fichero de volcado. Sin rotación, si ya existe se añaden los documentos al final, y si se
+            comprime y no tiene la extensión correspondiente, se le añade. Con rotación, se usa como base del nombre
+            de los segmentos
+        metrics: Metrics
+            \tOpcional. Métricas donde se registran los bytes escritos
+        compression: str
+            \t"gzip", "zstd" o None. Por defecto, se deduce de la extensión de `path` (.gz o .zst)
+        compress_level: int
+            \tNivel de compresión. Por defecto, 6 en gzip y 3 en zstd
+        rotate_bytes: int
+            \tOpcional. Se empieza un segmento nuevo al superar este número de bytes sin comprimir
+        rotate_seconds: float
+            \tOpcional. Se empieza un segmento nuevo cuando el actual supera esta antigüedad
+        manifests: list
+            \tManifiestos de los segmentos cerrados
+    """
+
+    SUFFIXES = {"gzip": ".gz", "zstd": ".zst", None: ""}
+
+    def __init__(self, path, metrics=None, buffer_size=1024*1024, compression=None, compress_level=None,
+                 rotate_bytes=None, rotate_seconds=None):
+        if compression is None:
+            compression = "gzip" if path.endswith(".gz") else "zstd" if path.endswith(".zst") else None
+        if compression not in self.SUFFIXES:
+            raise ValueError("Compresión no soportada: " + str(compression))
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("Se necesita el paquete zstandard para comprimir en zstd")
+
+        self.path = path
+        self.metrics = metrics
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self.compress_level = compress_level
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.rotating = bool(rotate_bytes or rotate_seconds)
+        self.manifests = []
+        self.offset = 0
+        self.segment = 0
+        self.file = None
+        self._open()
+
+    def write(self, documents):
+        """
+            Vuelca una lista de documentos, uno por línea, rotando el segmento si corresponde.
+            Las escrituras son mucho más rápidas si se tratan como strings en vez de objetos JSON.
+
+            Parámetros
+            ----------
+            documents: list
+                \tDocumentos a volcar
+        """
+        if not documents:
+            return
+        if self.rotating and self._should_rotate():
+            self._close_segment()
+            self._open()
+
+        data = "".join(json.dumps(document) + "\n" for document in documents).encode("utf-8")
+        self.file.write(data)
+        self.offset += len(data)
+
+        manifest = self.current
+        manifest["documents"] += len(documents)
+        dates = [document["created_utc"] for document in documents if document.get("created_utc") is not None]
+        if dates:
+            low, high = min(dates), max(dates)
+            manifest["min_created_utc"] = low if manifest["min_created_utc"] is None else min(low, manifest["min_created_utc"])
+            manifest["max_created_utc"] = high if manifest["max_created_utc"] is None else max(high, manifest["max_created_utc"])
+        if self.metrics:
+            self.metrics.count("bytes", len(data))
+
+    def close(self):
+        """
+            Cierra el fichero, escribiendo lo que quede en el buffer y, con rotación, el manifiesto del último segmento
+        """
+        self._close_segment()
+
+    def _should_rotate(self):
+        """
+            Indica si el segmento actual ha alcanzado el tamaño o la antigüedad máximos
+        """
+        written = self.offset - self.current["start_offset"]
+        if self.rotate_bytes and written >= self.rotate_bytes:
+            return True
+        return bool(self.rotate_seconds and written and time.time() - self.opened >= self.rotate_seconds)
+
+    def _open(self):
+        """
+            Abre el fichero de volcado o, con rotación, el siguiente segmento libre
+        """
+        if self.rotating:
+            base = self.path
+            if self.compression and base.endswith(self.SUFFIXES[self.compression]):
+                base = base[:-len(self.SUFFIXES[self.compression])]
+            stem, extension = os.path.splitext(base)
+            while True:
+                self.segment += 1
+                path = "%s-%05d%s%s"%(stem, self.segment, extension or ".ndjson", self.SUFFIXES[self.compression])
+                if not os.path.exists(path):
+                    break
+        elif self.compression and not self.path.endswith(self.SUFFIXES[self.compression]):
+            path = self.path + self.SUFFIXES[self.compression]
+        else:
+            path = self.path
+
+        self.raw = open(path, "ab", buffering=self.buffer_size)
+        if self.compression == "gzip":
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="ab", compresslevel=self.compress_level or 6)
+        elif self.compression == "zstd":
+            self.file = zstandard.ZstdCompressor(level=self.compress_level or 3).stream_writer(self.raw, closefd=False)
+        else:
+            self.file = self.raw
+        self.opened = time.time()
+        self.current = {"file": os.path.basename(path), "documents": 0, "min_created_utc": None,
+                        "max_created_utc": None, "start_offset": self.offset, "end_offset": None}
+
+    def _close_segment(self):
+        """
+            Cierra el segmento actual y, con rotación, escribe su manifiesto
+        """
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+        self.current["end_offset"] = self.offset
+        self.current["compressed_bytes"] = os.path.getsize(self.raw.name)
+        if self.rotating:
+            with open(self.raw.name + ".manifest.json", "w") as f:
+                json.dump(self.current, f)
+        self.manifests.append(self.current)
+
+
+def read_manifest(path):
+    """
+        Carga el manifiesto de un segmento de volcado, si existe
+
+        Parámetros
+        ----------
+        path: str
+            \tRuta del segmento
+
+        Salida
+        ------
+        dict
+            \tManifiesto del segmento, o None si no tiene
+    """
+    try:
+        with open(path + ".manifest.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class BackgroundPipeline:
+    """
+        Reparte lotes de documentos entre un hilo que los vuelca y otro que los indexa.
+        Cada consumidor tiene su propia cola acotada, de modo que un disco lento no frena el indexado ni al revés.
+        Si algún consumidor falla, el error se relanza en el hilo que extrae en la siguiente llamada a `put`
+        o al cerrar. Si el bloque `with` termina con una excepción, la pipeline se cierra sin relanzar el error del
+        consumidor, que queda en `error`, para no ocultar la excepción original.
+
+            with BackgroundPipeline(DumpWriter(path), writer.index_documents) as pipeline:
+                for batch in batches:
+                    pipeline.put(batch)
+
+        Atributos
+        ---------
+        dump: DumpWriter
+            \tEscritor del volcado. Se cierra al cerrar la pipeline
+        index: function
+            \tFunción que indexa una lista de documentos, por ejemplo `MultiIndexer.index_documents`
+        queue_size: int
+            \tNúmero de lotes que pueden esperar en cada cola antes de bloquear la extracción
+        metrics: Metrics
+            \tOpcional. Métricas donde se registran los tiempos de volcado, indexado y espera por colas llenas
+        error: Exception
+            \tPrimer error de algún consumidor, o None
+    """
+
+    def __init__(self, dump, index, queue_size=8, metrics=None):
+        self.dump = dump
+        self.index = index
+        self.metrics = metrics
+        self.error = None
+        self.queues = []
+        self.threads = []
+        for name, consumer in (("dump", dump.write), ("index", index)):
+            tasks = queue.Queue(maxsize=queue_size)
+            thread = threading.Thread(target=self._consume, args=(name, consumer, tasks), name=name, daemon=True)
+            thread.start()
+            self.queues.append(tasks)
+            self.threads.append(thread)
+
+    def put(self, documents):
+        """
+            Encola un lote de documentos para su volcado e indexado. Sólo se bloquea si alguna cola está llena.
+
+            Parámetros
+            ----------
+            documents: list
+                \tLote de documentos. No debe modificarse después de encolarlo
+        """
+        if self.error:
+            raise self.error
+        if not documents:
+            return
+        for tasks in self.queues:
+            if tasks.full() and self.metrics:
+                with self.metrics.stage("queue_wait"):
+                    tasks.put(documents)
+            else:
+                tasks.put(documents)
+
+    def close(self, raise_error=True):
+        """
+            Espera a que se vuelquen e indexen todos los lotes pendientes y cierra el volcado
+
+            Parámetros
+            ----------
+            raise_error: bool
+                \tIndica si se relanza el error de algún consumidor
+        """
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.dump.close()
+        if self.error and raise_error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(raise_error=exc[0] is None)
+
+    def _consume(self, name, consumer, tasks):
+        """
+            Bucle de cada hilo consumidor. Tras un error se siguen vaciando la cola para no bloquear la extracción
+        """
+        while True:
+            documents = tasks.get()
+            if documents is None:
+                return
+            if self.error:
+                continue
+            try:
+                if self.metrics:
+                    with self.metrics.stage(name):
+                        consumer(documents)
+                else:
+                    consumer(documents)
+            except Exception as e:
+                self.error = e
@@ -0,0 +1,439 @@
+"""
+    Utilidades para consultar la API de Pushshift
+    ---------------------------------------------
+    * `limited_get`: petición GET a la API que respeta un limitador compartido y reacciona a las respuestas 429.
+    Opcionalmente, las respuestas se guardan en una caché en disco (`ResponseCache`).
+    * `PushshiftClient`: cliente mínimo de la API que devuelve diccionarios, con sesión persistente, paginación,
+    selección de campos y agregaciones.
+    * `split_windows` y `crawl_windows`: recorren un intervalo de tiempo dividido en ventanas que se consultan de forma
+    concurrente, de modo que el tiempo total depende del ritmo de peticiones permitido y no de la latencia de cada página.
+    * `crawl_parallel`: consulta cualquier lista de tareas de forma concurrente, por ejemplo bloques de autores.
+    * `pack_by_length`: agrupa valores de un parámetro por longitud de la URL en lugar de por número.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+
+__author__ = "Samuel Cifuentes García"
+
+
+class PushshiftClient:
+    """
+        Cliente mínimo de la API de Pushshift. Devuelve los documentos como diccionarios tal cual llegan en el JSON
+        de cada página, sin construir objetos por documento como psaw, y reutiliza una única sesión HTTP con
+        conexiones persistentes. Todas las peticiones pasan por `limited_get`.
+        No guarda estado entre consultas, por lo que un mismo cliente puede utilizarse desde varios hilos.
+
+        Atributos
+        ---------
+        limiter: TokenBucket
+            \tLimitador compartido
+        cache: ResponseCache
+            \tOpcional. Caché de respuestas
+        page_size: int
+            \tDocumentos por página
+        session: requests.Session
+            \tSesión HTTP compartida por todas las peticiones
+        timeout: float
+            \tSegundos de espera máximos de cada petición
+    """
+
+    BASE_URL = "https://api.pushshift.io/reddit/{kind}/search"
+
+    def __init__(self, limiter, cache=None, page_size=1000, pool_size=32, max_retries=20, backoff=2, max_sleep=3600,
+                 timeout=60):
+        self.limiter = limiter
+        self.cache = cache
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_sleep = max_sleep
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, params=None):
+        """
+            Petición GET a la API con el limitador, la caché y la sesión del cliente
+
+            Parámetros
+            ----------
+            url: str
+                \tDirección del endpoint
+            params: dict
+                \tParámetros de la consulta
+
+            Salida
+            ------
+            dict
+                \tRespuesta de la API decodificada
+        """
+        return limited_get(self.limiter, url, params, session=self.session, cache=self.cache,
+                           max_retries=self.max_retries, backoff=self.backoff, max_sleep=self.max_sleep,
+                           timeout=self.timeout)
+
+    def search_submissions(self, fields=None, **params):
+        """
+            Generador que pagina una búsqueda de submissions. Equivale a `search(kind="submission", ...)`
+        """
+        return self.search("submission", fields=fields, **params)
+
+    def search(self, kind, fields=None, limit=None, sort="desc", **params):
+        """
+            Generador que pagina una búsqueda por `created_utc`, devolviendo cada documento como un diccionario.
+            Cada página empieza en el segundo en que terminó la anterior, incluido, de modo que no se pierden los
+            documentos de ese segundo que no cupieron en la página; los ya devueltos se descartan por id.
+
+            Parámetros
+            ----------
+            kind: str
+                \tTipo de documento: "submission" o "comment"
+            fields: list
+                \tOpcional. Campos a descargar de cada documento. Se añaden `id` y `created_utc`, necesarios para paginar
+            limit: int
+                \tOpcional. Número máximo de documentos
+            sort: str
+                \t"desc" para recorrer de los más recientes a los más antiguos, "asc" al revés
+            params: dict
+                \tParámetros de la búsqueda: subreddit, author, after, before...
+
+            Salida
+            ------
+            generator
+                \tDocumentos encontrados
+        """
+        url = self.BASE_URL.format(kind=kind)
+        params = self._search_params(fields, sort, params)
+
+        returned = 0
+        boundary, boundary_ids = None, set()
+        while limit is None or returned < limit:
+            # Se piden además los documentos del último segundo ya devueltos, que se descartarán: si no, un segundo con
+            # tantos documentos como la página la llenaría sólo con repetidos y la búsqueda se detendría
+            wanted = self.page_size if limit is None else min(self.page_size, limit - returned)
+            params["size"] = wanted + len(boundary_ids)
+            data = self.get(url, params)["data"]
+
+            new = 0
+            for document in data:
+                if document["created_utc"] == boundary and document["id"] in boundary_ids:
+                    continue
+                new += 1
+                returned += 1
+                yield document
+                if limit is not None and returned >= limit:
+                    return
+            # La API puede devolver páginas incompletas aunque queden documentos: se termina con una página sin nuevos
+            if not new:
+                return
+
+            # La siguiente página incluye el último segundo de esta
+            last = data[-1]["created_utc"]
+            if last != boundary:
+                boundary, boundary_ids = last, set()
+            boundary_ids.update(document["id"] for document in data if document["created_utc"] == last)
+            if sort == "desc":
+                params["before"] = last + 1
+            else:
+                params["after"] = last - 1
+
+    def url_length(self, kind, fields=None, sort="desc", **params):
+        """
+            Longitud en bytes de la URL de una búsqueda, con todos los parámetros que añade `search`. Sirve para
+            calcular cuánto espacio queda para un parámetro con muchos valores, como `author`
+
+            Parámetros
+            ----------
+            kind: str
+                \tTipo de documento: "submission" o "comment"
+            fields: list
+                \tOpcional. Campos a descargar de cada documento
+            sort: str
+                \tOrden de la búsqueda
+            params: dict
+                \tParámetros de la búsqueda
+
+            Salida
+            ------
+            int
+                \tBytes de la URL
+        """
+        params = dict(self._search_params(fields, sort, params), size=self.page_size)
+        return len(requests.Request("GET", self.BASE_URL.format(kind=kind), params=params).prepare().url)
+
+    def _search_params(self, fields, sort, params):
+        """
+            Parámetros comunes a todas las páginas de una búsqueda
+        """
+        params = dict(params, sort=sort, sort_type="created_utc")
+        if fields:
+            params["fields"] = ",".join(sorted(set(fields) | {"id", "created_utc"}))
+        return params
+
+    def aggregate(self, kind, aggs, **params):
+        """
+            Consulta una agregación de la API, sin descargar documentos
+
+            Parámetros
+            ----------
+            kind: str
+                \tTipo de documento: "submission" o "comment"
+            aggs: str
+                \tCampo por el que agregar, por ejemplo "author"
+            params: dict
+                \tParámetros de la búsqueda
+
+            Salida
+            ------
+            list
+                \tBuckets de la agregación, con los campos `key` y `doc_count`
+        """
+        response = self.get(self.BASE_URL.format(kind=kind), dict(params, aggs=aggs, size=0))
+        return response["aggs"][aggs]
+
+
+def limited_get(limiter, url, params=None, session=None, cache=None, max_retries=20, backoff=2, max_sleep=3600,
+                timeout=60):
+    """
+        Petición GET a la API de Pushshift a través de un limitador. Las respuestas 429 frenan el limitador durante el
+        tiempo que indique `Retry-After`; el resto de errores (de conexión, timeouts, respuestas cortadas o con un JSON
+        inválido y otros códigos de estado) se reintentan con una espera creciente, como en psaw.
+        Las respuestas que están en la caché no consumen tokens del limitador.
+
+        Parámetros
+        ----------
+        limiter: TokenBucket
+            \tLimitador compartido
+        url: str
+            \tDirección del endpoint
+        params: dict
+            \tParámetros de la consulta
+        session: requests.Session
+            \tOpcional. Sesión con la que reutilizar las conexiones
+        cache: ResponseCache
+            \tOpcional. Caché de respuestas
+        max_retries: int
+            \tNúmero máximo de intentos
+        backoff: float
+            \tSegundos de espera por cada intento fallido
+        max_sleep: float
+            \tEspera máxima entre intentos
+        timeout: float
+            \tSegundos de espera máximos de cada petición, para que una conexión bloqueada no detenga al hilo
+
+        Salida
+        ------
+        dict
+            \tRespuesta de la API decodificada
+    """
+    if cache:
+        cached = cache.get(url, params)
+        if cached is not None:
+            return cached
+
+    for attempt in range(max_retries):
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = (session or requests).get(url, params=params, timeout=timeout)
+            # El cuerpo se descarga y decodifica dentro del try: una respuesta cortada también se reintenta
+            data = response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            limiter.add_fetch_time(time.perf_counter() - start)
+            time.sleep(min(backoff*(attempt + 1), max_sleep))
+            continue
+        limiter.add_fetch_time(time.perf_counter() - start)
+
+        if response.status_code == 200:
+            limiter.success()
+            if cache:
+                cache.put(url, params, data)
+            return data
+        if response.status_code == 429:
+            limiter.throttle(retry_after(response))
+        else:
+            time.sleep(min(backoff*(attempt + 1), max_sleep))
+    raise RuntimeError("No se pudo conectar con pushshift.io tras %d intentos"%max_retries)
+
+
+def retry_after(response):
+    """
+        Segundos de espera indicados en la cabecera `Retry-After` de una respuesta, o None si no la incluye
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def split_windows(start, end, count):
+    """
+        Divide el intervalo [start, end] en ventanas de la misma duración, de la más reciente a la más antigua.
+        Ventanas consecutivas comparten el segundo frontera, que se incluye en ambas.
+
+        Parámetros
+        ----------
+        start: int
+            \tTimestamp inicial
+        end: int
+            \tTimestamp final
+        count: int
+            \tNúmero de ventanas
+
+        Salida
+        ------
+        list
+            \tTuplas (inicio, fin) con los límites incluidos de cada ventana
+    """
+    step = max(1, -(-(end - start) // count))
+    edges = list(range(start, end, step)) + [end]
+    return [(edges[i], edges[i + 1]) for i in reversed(range(len(edges) - 1))]
+
+
+def crawl_windows(search, windows, threads=4, batch_size=500, queue_size=16):
+    """
+        Generador que consulta varias ventanas de tiempo de forma concurrente y devuelve sus documentos a medida que
+        llegan. Como las ventanas consecutivas comparten el segundo frontera, los documentos de esos segundos se
+        deduplican por id.
+
+        Parámetros
+        ----------
+        search: function
+            \tFunción que recibe los parámetros `after` y `before` de Pushshift (no incluidos) y devuelve un iterable
+            de documentos
+        windows: list
+            \tVentanas a consultar, como las devuelve `split_windows`
+        threads: int
+            \tNúmero de ventanas consultadas a la vez
+        batch_size: int
+            \tDocumentos que cada hilo agrupa antes de entregarlos
+        queue_size: int
+            \tLotes en espera de ser consumidos antes de detener a los hilos
+
+        Salida
+        ------
+        generator
+            \tDocumentos de todas las ventanas, sin repetir los de las fronteras
+    """
+    boundaries = set(edge for window in windows for edge in window)
+    seen = set()
+    documents = crawl_parallel(lambda window: search(window[0] - 1, window[1] + 1), windows, threads=threads,
+                               batch_size=batch_size, queue_size=queue_size)
+    try:
+        for document in documents:
+            if document.get("created_utc") in boundaries:
+                if document["id"] in seen:
+                    continue
+                seen.add(document["id"])
+            yield document
+    finally:
+        documents.close()
+
+
+def crawl_parallel(search, tasks, threads=4, batch_size=500, queue_size=16):
+    """
+        Generador que lanza varias consultas de forma concurrente y devuelve sus documentos a medida que llegan, en
+        lotes acotados por una cola. Las peticiones de todos los hilos pasan por el mismo limitador del cliente.
+
+        Parámetros
+        ----------
+        search: function
+            \tFunción que recibe una tarea y devuelve un iterable de documentos
+        tasks: list
+            \tTareas a consultar: ventanas de tiempo, bloques de autores...
+        threads: int
+            \tNúmero de tareas consultadas a la vez
+        batch_size: int
+            \tDocumentos que cada hilo agrupa antes de entregarlos
+        queue_size: int
+            \tLotes en espera de ser consumidos antes de detener a los hilos
+
+        Salida
+        ------
+        generator
+            \tDocumentos de todas las tareas
+    """
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        # Si el consumidor abandona el generador, los hilos dejan de esperar
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(task):
+        if stop.is_set():
+            return
+        try:
+            batch = []
+            for document in search(task):
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            put(batch)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    pending = len(tasks)
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for task in tasks:
+            executor.submit(fetch, task)
+        while pending:
+            batch = results.get()
+            if batch is None:
+                pending -= 1
+                continue
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def pack_by_length(values, max_bytes):
+    """
+        Agrupa valores en bloques para un parámetro separado por comas (por ejemplo, `author`), de forma que cada
+        bloque codificado en la URL no supere un número de bytes. Así se llenan las peticiones GET al máximo sin
+        superar los límites de longitud de la URL, sea cual sea la longitud de cada valor.
+        El último bloque se devuelve aunque no esté lleno.
+
+        Parámetros
+        ----------
+        values: iterable
+            \tValores a agrupar
+        max_bytes: int
+            \tBytes máximos de cada bloque una vez codificado
+
+        Salida
+        ------
+        generator
+            \tListas de valores
+    """
+    separator = len(quote(",", safe=""))
+    block, size = [], 0
+    for value in values:
+        length = len(quote(str(value), safe=""))
+        if block and size + separator + length > max_bytes:
+            yield block
+            block, size = [], 0
+        size += length + (separator if block else 0)
+        block.append(value)
+    if block:
+        yield block
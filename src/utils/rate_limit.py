@@ -0,0 +1,158 @@
+"""
+    Limitación del ritmo de peticiones a la API de Pushshift
+    --------------------------------------------------------
+    Limitador de tipo token bucket compartido por todos los hilos que consultan la API: se permiten `rate` peticiones
+    por segundo de media, con ráfagas de hasta `burst` peticiones seguidas.
+
+    * Cuando la API responde 429, se detienen todas las peticiones durante el tiempo indicado en `Retry-After` y se reduce
+    el ritmo a la mitad, recuperándolo poco a poco con cada respuesta correcta.
+    * Si se indica un fichero de bloqueo, el estado del limitador se guarda en él, de modo que varios scripts ejecutados a
+    la vez (por ejemplo, `posts_per_user` y `posts_from_users`) reparten el mismo ritmo de peticiones.
+    * Se contabiliza el tiempo esperando al limitador frente al tiempo esperando las respuestas de la API.
+"""
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__author__ = "Samuel Cifuentes García"
+
+
+class TokenBucket:
+    """
+        Limitador token bucket seguro entre hilos y, opcionalmente, entre procesos. Cada petición consume un token y los
+        tokens se reponen al ritmo vigente hasta un máximo de `burst`.
+
+        Atributos
+        ---------
+        max_rate: float
+            \tPeticiones por segundo permitidas de media
+        rate: float
+            \tRitmo vigente. Se reduce con cada 429 y se recupera hasta `max_rate` con las respuestas correctas
+        min_rate: float
+            \tRitmo mínimo al que se puede reducir el limitador
+        burst: int
+            \tPeticiones que se pueden hacer seguidas tras un periodo de inactividad
+        lock_file: str
+            \tOpcional. Fichero en el que se comparte el estado del limitador entre procesos
+        stats: dict
+            \tPeticiones, respuestas 429, segundos esperando al limitador y segundos esperando a la API
+    """
+
+    def __init__(self, rate=1, burst=5, lock_file=None, min_rate=None):
+        if lock_file and fcntl is None:
+            raise RuntimeError("El fichero de bloqueo del limitador sólo está disponible en sistemas POSIX")
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate/16
+        self.burst = burst
+        self.lock_file = lock_file
+        self.tokens = burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "waited": 0.0, "fetching": 0.0}
+
+    def acquire(self):
+        """
+            Espera hasta que haya un token disponible y lo consume
+
+            Salida
+            ------
+            float
+                \tSegundos esperados
+        """
+        waited = 0
+        while True:
+            with self._state():
+                now = time.time()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.stats["requests"] += 1
+                    self.stats["waited"] += waited
+                    return waited
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+            waited += wait
+
+    def throttle(self, retry_after=None):
+        """
+            Registra una respuesta 429: se detienen las peticiones y se reduce el ritmo a la mitad
+
+            Parámetros
+            ----------
+            retry_after: float
+                \tSegundos indicados por la cabecera `Retry-After`. Si no se indican, se espera lo que tardaría en
+                reponerse un token al nuevo ritmo
+        """
+        with self._state():
+            self.rate = max(self.min_rate, self.rate/2)
+            pause = retry_after if retry_after is not None else 1/self.rate
+            self.paused_until = max(self.paused_until, time.time() + pause)
+            self.tokens = min(self.tokens, 0)
+            self.stats["throttled"] += 1
+
+    def success(self):
+        """
+            Registra una respuesta correcta, recuperando el ritmo tras un 429 de forma gradual
+        """
+        if self.rate < self.max_rate:
+            with self._state():
+                self.rate = min(self.max_rate, self.rate + self.max_rate/20)
+
+    def add_fetch_time(self, seconds):
+        """
+            Suma el tiempo de espera de una respuesta de la API
+
+            Parámetros
+            ----------
+            seconds: float
+                \tSegundos
+        """
+        with self.lock:
+            self.stats["fetching"] += seconds
+
+    def summary(self):
+        """
+            Línea de resumen con las peticiones, los 429 y el tiempo esperando al limitador frente a la API
+        """
+        return "[rate limit] %d peticiones, %d respuestas 429 | esperando al limitador %.1fs, esperando a la API %.1fs"%(
+            self.stats["requests"], self.stats["throttled"], self.stats["waited"], self.stats["fetching"])
+
+    def _refill(self, now):
+        """
+            Repone los tokens correspondientes al tiempo transcurrido desde la última actualización
+        """
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = now
+
+    @contextmanager
+    def _state(self):
+        """
+            Contexto con acceso exclusivo al estado del limitador. Con fichero de bloqueo, el estado se lee al entrar
+            y se escribe al salir mientras se mantiene el bloqueo del fichero
+        """
+        with self.lock:
+            if not self.lock_file:
+                yield
+                return
+            with open(self.lock_file, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                content = f.read()
+                if content:
+                    state = json.loads(content)
+                    self.tokens, self.updated = state["tokens"], state["updated"]
+                    self.paused_until, self.rate = state["paused_until"], state["rate"]
+                yield
+                f.seek(0)
+                f.truncate()
+                json.dump({"tokens": self.tokens, "updated": self.updated, "paused_until": self.paused_until,
+                           "rate": self.rate}, f)
@@ -0,0 +1,206 @@
+"""
+    Caché en disco de las respuestas de la API de Pushshift
+    -------------------------------------------------------
+    Cada respuesta se guarda comprimida en un fichero cuyo nombre es el hash del endpoint y los parámetros normalizados,
+    de forma que repetir una ejecución con las mismas consultas no vuelve a llamar a la API.
+
+    * Las consultas sobre ventanas totalmente históricas (con un `before` anterior al margen de asentamiento) no caducan,
+    ya que sus datos no cambian. El resto caducan pasado el TTL.
+    * El tamaño de la caché está limitado: al superarlo se eliminan las respuestas usadas hace más tiempo (LRU).
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+__author__ = "Samuel Cifuentes García"
+
+
+class ResponseCache:
+    """
+        Caché de respuestas de la API direccionada por contenido. Es segura entre hilos.
+
+        Atributos
+        ---------
+        directory: str
+            \tDirectorio de la caché
+        max_bytes: int
+            \tTamaño máximo de la caché en disco
+        ttl: float
+            \tSegundos de validez de las respuestas que no son totalmente históricas
+        settle: float
+            \tSegundos tras los cuales se considera que los datos de Pushshift ya no cambian
+        stats: dict
+            \tAciertos, fallos, respuestas caducadas y respuestas eliminadas por tamaño
+    """
+
+    def __init__(self, directory, max_bytes=2*1024**3, ttl=3600, settle=7*24*3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def get(self, url, params=None):
+        """
+            Busca la respuesta de una consulta
+
+            Parámetros
+            ----------
+            url: str
+                \tDirección del endpoint
+            params: dict
+                \tParámetros de la consulta
+
+            Salida
+            ------
+            dict
+                \tRespuesta guardada, o None si no está en la caché o ha caducado
+        """
+        path = self._path(url, params)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, OSError, ValueError):
+            self._count("misses")
+            return None
+
+        if entry["expires"] is not None and entry["expires"] < time.time():
+            self._count("expired")
+            self._count("misses")
+            return None
+        # La fecha de modificación marca el último uso, para el LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self._count("hits")
+        return entry["response"]
+
+    def put(self, url, params, response):
+        """
+            Guarda la respuesta de una consulta, eliminando las menos usadas si se supera el tamaño máximo
+
+            Parámetros
+            ----------
+            url: str
+                \tDirección del endpoint
+            params: dict
+                \tParámetros de la consulta
+            response: dict
+                \tRespuesta decodificada de la API
+        """
+        path = self._path(url, params)
+        expires = None if self.is_historical(params) else time.time() + self.ttl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Escritura atómica: otro hilo o proceso nunca lee una respuesta a medias
+        temporary = "%s.%d.%d.tmp"%(path, os.getpid(), threading.get_ident())
+        with gzip.open(temporary, "wt", encoding="utf-8") as f:
+            json.dump({"expires": expires, "response": response}, f)
+        size = os.path.getsize(temporary)
+        try:
+            previous = os.path.getsize(path)
+        except FileNotFoundError:
+            previous = 0
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.size += size - previous
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def is_historical(self, params):
+        """
+            Indica si una consulta se refiere sólo a datos que ya no cambian: tiene un `before` anterior al margen
+            de asentamiento
+
+            Parámetros
+            ----------
+            params: dict
+                \tParámetros de la consulta
+
+            Salida
+            ------
+            bool
+                \tTrue si la respuesta no caduca
+        """
+        before = (params or {}).get("before")
+        try:
+            return before is not None and float(before) < time.time() - self.settle
+        except (TypeError, ValueError):
+            return False
+
+    def summary(self):
+        """
+            Línea de resumen con los aciertos y fallos de la caché
+        """
+        total = self.stats["hits"] + self.stats["misses"]
+        return "[cache] %d aciertos, %d fallos (%.1f%%), %d caducadas, %d eliminadas, %.1f MB en disco"%(
+            self.stats["hits"], self.stats["misses"], 100*self.stats["hits"]/max(total, 1), self.stats["expired"],
+            self.stats["evicted"], self.size/1024/1024)
+
+    def _path(self, url, params):
+        """
+            Ruta del fichero de una consulta: hash del endpoint y los parámetros normalizados
+        """
+        key = json.dumps([normalize_endpoint(url), normalize_params(params)], sort_keys=True)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".json.gz")
+
+    def _entries(self):
+        """
+            Ficheros de respuestas guardados en la caché
+        """
+        for subdirectory in os.scandir(self.directory):
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith(".json.gz"):
+                        yield entry
+
+    def _evict(self):
+        """
+            Elimina las respuestas usadas hace más tiempo hasta dejar la caché al 90% de su tamaño máximo
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= 0.9*self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+            self.stats["evicted"] += 1
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+def normalize_endpoint(url):
+    """
+        Normaliza la dirección de un endpoint: sin esquema, en minúsculas y sin barra final
+    """
+    parts = urlsplit(url)
+    return (parts.netloc + parts.path).lower().rstrip("/")
+
+
+def normalize_params(params):
+    """
+        Normaliza los parámetros de una consulta: las listas se unen por comas, que Pushshift interpreta igual que
+        los parámetros repetidos, y todos los valores se convierten en texto
+    """
+    normalized = {}
+    for key, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(item) for item in value)
+        normalized[key] = str(value)
+    return normalized
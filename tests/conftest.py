@@ -0,0 +1,9 @@
+"""
+    Configuración de pytest: los tests importan los módulos como `src.*`, igual que los scripts ejecutados desde
+    la raíz del repositorio
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
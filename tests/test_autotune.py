@@ -0,0 +1,129 @@
+"""
+    Tests del envío bulk adaptativo: división de peticiones, reintentos y ajuste del presupuesto
+"""
+
+import json
+
+from elasticsearch import TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from src.elastic_utils.autotune import BulkAutotuner
+
+
+class FakeTransport:
+    serializer = JSONSerializer()
+
+
+class FakeClient:
+    """
+        Cliente que responde a las peticiones bulk según un guion: `fail` son los errores de petición completa que se
+        lanzan en las primeras llamadas y `reject` el número de veces que se rechaza (429) cada documento
+    """
+    transport = FakeTransport()
+
+    def __init__(self, fail=(), reject=None):
+        self.fail = list(fail)
+        self.reject = dict(reject or {})
+        self.calls = []
+
+    def bulk(self, body, request_timeout=None):
+        lines = [json.loads(line) for line in body.splitlines()]
+        metas = [line["index"] for line in lines[::2]]
+        self.calls.append([meta["_id"] for meta in metas])
+        if self.fail:
+            raise self.fail.pop(0)
+        items = []
+        for meta in metas:
+            status = 201
+            if self.reject.get(meta["_id"]):
+                self.reject[meta["_id"]] -= 1
+                status = 429
+            items.append({"index": {"_index": meta["_index"], "_id": meta["_id"], "status": status}})
+        return {"items": items}
+
+
+def actions(*ids, size=10):
+    return [{"_index": "test", "_type": "post", "_id": id, "_source": {"text": "x"*size}} for id in ids]
+
+
+def tuner(**kwargs):
+    return BulkAutotuner(initial_backoff=0, **kwargs)
+
+
+def test_chunks_respect_byte_budget():
+    autotune = tuner(target_bytes=200)
+    chunks = list(autotune.chunks(FakeClient(), actions(*"abcdef", size=50)))
+    assert len(chunks) > 1
+    assert [action["_id"] for chunk in chunks for _, _, action in chunk] == list("abcdef")
+    for chunk in chunks:
+        assert len(chunk) == 1 or sum(size for size, _, _ in chunk) <= 200
+
+
+def test_oversized_action_gets_its_own_chunk():
+    autotune = tuner(target_bytes=100)
+    chunks = list(autotune.chunks(FakeClient(), actions("a", size=500) + actions("b")))
+    assert [[action["_id"] for _, _, action in chunk] for chunk in chunks] == [["a"], ["b"]]
+
+
+def test_too_large_request_is_split():
+    client = FakeClient(fail=[TransportError(413, "too large")])
+    autotune = tuner()
+    indexed, errors = autotune.send(client, actions(*"abcd"))
+    assert (indexed, errors) == (4, [])
+    assert client.calls == [list("abcd"), list("ab"), list("cd")]
+    assert autotune.stats["split"] == 1
+    assert autotune.stats["requests"] == 3
+
+
+def test_rejected_documents_are_retried():
+    client = FakeClient(reject={"b": 2})
+    autotune = tuner(max_retries=3)
+    indexed, errors = autotune.send(client, actions(*"abc"))
+    assert (indexed, errors) == (3, [])
+    assert client.calls == [list("abc"), ["b"], ["b"]]
+    assert autotune.stats["retried"] == 2
+    assert autotune.stats["requests"] == 3
+
+
+def test_rejections_beyond_max_retries_are_errors():
+    client = FakeClient(reject={"a": 5})
+    indexed, errors = tuner(max_retries=2).send(client, actions("a", "b"))
+    assert indexed == 1
+    assert [error["index"]["_id"] for error in errors] == ["a"]
+    assert errors[0]["index"]["status"] == 429
+
+
+def test_split_halves_keep_their_own_attempts():
+    # La primera mitad agota sus reintentos, pero la segunda conserva los suyos
+    client = FakeClient(fail=[TransportError(413, "too large")], reject={"a": 2, "c": 1})
+    autotune = tuner(max_retries=2)
+    indexed, errors = autotune.send(client, actions(*"abcd"))
+    assert (indexed, errors) == (4, [])
+    assert autotune.stats["requests"] == len(client.calls) == 6
+
+
+def test_request_errors_keep_action_metadata():
+    client = FakeClient(fail=[TransportError(400, "bad request")])
+    indexed, errors = tuner().send(client, actions("a", "b"))
+    assert indexed == 0
+    assert [(error["index"]["_index"], error["index"]["_type"], error["index"]["_id"], error["index"]["status"])
+            for error in errors] == [("test", "post", "a", 400), ("test", "post", "b", 400)]
+    assert all(isinstance(error["index"]["exception"], TransportError) for error in errors)
+
+
+def test_budget_shrinks_on_rejections_and_grows_when_fast():
+    autotune = tuner(target_bytes=1000, min_bytes=100, max_bytes=2000, target_latency=10)
+    # El rechazo reduce el presupuesto a la mitad y el reintento, rápido, lo hace crecer un 25%
+    autotune.send(FakeClient(reject={"a": 1}), actions("a"))
+    assert autotune.target_bytes == 625
+    assert autotune.stats["shrunk"] == 1
+    for _ in range(10):
+        autotune.send(FakeClient(), actions("a"))
+    assert autotune.target_bytes == 2000
+
+
+def test_send_parallel_keeps_order():
+    autotune = tuner(target_bytes=1)
+    results = list(autotune.send_parallel(FakeClient(reject={"c": 1}), actions(*"abcde"), thread_count=3))
+    assert [size for size, _, _ in results] == [1]*5
+    assert sum(indexed for _, indexed, _ in results) == 5
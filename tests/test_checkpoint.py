@@ -0,0 +1,88 @@
+"""
+    Tests del checkpoint de indexado y de la confirmación de bloques en modo streaming
+"""
+
+import json
+
+from src.elastic_utils.filters import DocumentFilter
+from src.index_from_backup import BlockTracker
+from src.utils.checkpoint import Checkpoint
+
+
+class FakeIndexer:
+    def __init__(self, criteria=None):
+        self.stats = {"indexed": 0, "errors": 0, "filtered": 0, "bytes_saved": 0}
+        self.filter = DocumentFilter(criteria) if criteria else None
+
+
+def test_checkpoint_persists_and_resumes(tmp_path):
+    path = str(tmp_path / "index.checkpoint")
+    checkpoint = Checkpoint(path)
+    checkpoint.update("a.ndjson", 100, {"indexed": 10}, dropped={"exclude:subreddit": 2})
+    checkpoint.update("b.ndjson", 50, {"indexed": 5}, completed=True)
+
+    with open(path) as f:
+        assert json.load(f)["a.ndjson"]["offset"] == 100
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.get("a.ndjson") == {"offset": 100, "completed": False, "stats": {"indexed": 10},
+                                       "dropped": {"exclude:subreddit": 2}}
+    assert resumed.get("b.ndjson")["completed"]
+    assert resumed.get("c.ndjson") == {}
+
+
+def test_checkpoint_without_resume_starts_empty(tmp_path):
+    path = str(tmp_path / "index.checkpoint")
+    Checkpoint(path).update("a.ndjson", 100, {"indexed": 10})
+    assert Checkpoint(path).get("a.ndjson") == {}
+
+
+def test_checkpoint_get_returns_a_copy(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "index.checkpoint"))
+    checkpoint.update("a.ndjson", 100, {"indexed": 10})
+    checkpoint.get("a.ndjson")["offset"] = 0
+    assert checkpoint.get("a.ndjson")["offset"] == 100
+
+
+def test_block_tracker_only_acknowledges_complete_blocks(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "index.checkpoint"))
+    indexer = FakeIndexer()
+    tracker = BlockTracker("a.ndjson", indexer, checkpoint)
+    actions = tracker.track([(["a1", "a2"], 10), (["b1", "b2", "b3"], 25)])
+
+    assert [next(actions) for _ in range(3)] == ["a1", "a2", "b1"]
+    # El primer bloque está enviado, pero no confirmado
+    tracker.acknowledge(1)
+    assert checkpoint.get("a.ndjson") == {}
+    tracker.acknowledge(2)
+    assert checkpoint.get("a.ndjson")["offset"] == 10
+
+    list(actions)
+    tracker.acknowledge(4)
+    assert checkpoint.get("a.ndjson")["offset"] == 10
+    tracker.acknowledge(5)
+    assert checkpoint.get("a.ndjson")["offset"] == 25
+
+
+def test_block_tracker_records_stats_at_block_end(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "index.checkpoint"))
+    indexer = FakeIndexer({"subreddit": ["lonely"]})
+
+    def blocks():
+        indexer.filter.drops({"subreddit": "lonely"})
+        indexer.stats["filtered"] += 1
+        yield ["a1"], 10
+        # Lo descartado en el bloque siguiente no debe llegar al checkpoint del primero
+        indexer.filter.drops({"subreddit": "lonely"})
+        indexer.stats["filtered"] += 1
+        yield ["b1"], 20
+
+    tracker = BlockTracker("a.ndjson", indexer, checkpoint)
+    actions = tracker.track(blocks())
+    next(actions)
+    next(actions)
+    tracker.acknowledge(1)
+
+    state = checkpoint.get("a.ndjson")
+    assert state["offset"] == 10
+    assert state["stats"]["filtered"] == 1
+    assert state["dropped"] == {"exclude:subreddit": 1}
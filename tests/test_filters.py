@@ -0,0 +1,77 @@
+"""
+    Tests de los filtros de documentos compilados
+"""
+
+from src.elastic_utils.filters import DocumentFilter
+
+
+def test_classic_format_excludes_values():
+    document_filter = DocumentFilter({"subreddit": ["lonely", "ForeverAlone"], "author": ["pepito"]})
+    assert document_filter.drops({"subreddit": "lonely", "author": "x"}) == "exclude:subreddit"
+    assert document_filter.drops({"subreddit": "AskReddit", "author": "pepito"}) == "exclude:author"
+    assert document_filter.drops({"subreddit": "AskReddit", "author": "x"}) is None
+    assert document_filter.drops({}) is None
+
+
+def test_classic_format_ignores_options():
+    document_filter = DocumentFilter({"subreddit": ["Lonely"], "case_insensitive": True})
+    assert [name for name, _, _ in document_filter.rules] == ["exclude:subreddit"]
+    assert document_filter.drops({"subreddit": "LONELY"}) == "exclude:subreddit"
+
+
+def test_case_sensitive_by_default():
+    document_filter = DocumentFilter({"subreddit": ["Lonely"]})
+    assert document_filter.drops({"subreddit": "lonely"}) is None
+
+
+def test_list_values_match_any_element():
+    document_filter = DocumentFilter({"exclude": {"tags": ["nsfw"]}, "include": {"lang": ["en"]}})
+    assert document_filter.drops({"tags": ["a", "nsfw"], "lang": "en"}) == "exclude:tags"
+    assert document_filter.drops({"tags": ["a"], "lang": ["es", "en"]}) is None
+
+
+def test_include_drops_missing_and_other_values():
+    document_filter = DocumentFilter({"include": {"lang": ["en"]}})
+    assert document_filter.drops({"lang": "en"}) is None
+    assert document_filter.drops({"lang": "es"}) == "include:lang"
+    assert document_filter.drops({}) == "include:lang"
+
+
+def test_range_bounds():
+    document_filter = DocumentFilter({"range": {"created_utc": {"gte": 10, "lt": 20}}})
+    assert document_filter.drops({"created_utc": 10}) is None
+    assert document_filter.drops({"created_utc": "19.5"}) is None
+    assert document_filter.drops({"created_utc": 20}) == "range:created_utc"
+    assert document_filter.drops({"created_utc": 9}) == "range:created_utc"
+    assert document_filter.drops({}) == "range:created_utc"
+
+
+def test_range_drops_non_numeric_values():
+    document_filter = DocumentFilter({"range": {"created_utc": {"gt": 0}}})
+    assert document_filter.drops({"created_utc": "ayer"}) == "range:created_utc"
+    assert document_filter.drops({"created_utc": {"a": 1}}) == "range:created_utc"
+
+
+def test_unhashable_values():
+    document_filter = DocumentFilter({"exclude": {"media": [{"type": "video"}, "gif"]}})
+    assert document_filter.drops({"media": {"type": "video"}}) == "exclude:media"
+    assert document_filter.drops({"media": [{"type": "image"}, "gif"]}) == "exclude:media"
+    assert document_filter.drops({"media": {"type": "image"}}) is None
+    assert document_filter.drops({"media": [[1, 2]]}) is None
+
+
+def test_rules_are_checked_in_order_and_counted():
+    document_filter = DocumentFilter({
+        "exclude": {"subreddit": ["lonely"]},
+        "include": {"lang": ["en"]},
+        "range": {"score": {"gte": 1}}
+    })
+    documents = [
+        {"subreddit": "lonely", "lang": "es", "score": 0},
+        {"subreddit": "x", "lang": "es", "score": 0},
+        {"subreddit": "x", "lang": "en", "score": 0},
+        {"subreddit": "x", "lang": "en", "score": 5},
+    ]
+    assert [document_filter.drops(document) for document in documents] == [
+        "exclude:subreddit", "include:lang", "range:score", None]
+    assert document_filter.dropped == {"exclude:subreddit": 1, "include:lang": 1, "range:score": 1}
@@ -0,0 +1,105 @@
+"""
+    Tests del escritor de volcados: compresión, rotación en segmentos y manifiestos
+"""
+
+import json
+import os
+
+import pytest
+
+from src.utils.file_handler import open_compressed
+from src.utils.pipeline import DumpWriter, read_manifest, zstandard
+
+
+def posts(start, count):
+    return [{"id": str(i), "created_utc": 1000 + i} for i in range(start, start + count)]
+
+
+def read_lines(path):
+    f, raw = open_compressed(path)
+    with raw:
+        return [json.loads(line) for line in f.read().splitlines()]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", pytest.param("zstd", marks=pytest.mark.skipif(
+    zstandard is None, reason="zstandard no instalado"))])
+def test_round_trip(tmp_path, compression):
+    path = str(tmp_path / "dump.ndjson")
+    writer = DumpWriter(path, compression=compression)
+    writer.write(posts(0, 3))
+    writer.write([])
+    writer.close()
+
+    expected = path + DumpWriter.SUFFIXES[compression]
+    assert os.listdir(tmp_path) == [os.path.basename(expected)]
+    assert read_lines(expected) == posts(0, 3)
+
+
+def test_compression_from_extension(tmp_path):
+    writer = DumpWriter(str(tmp_path / "dump.ndjson.gz"))
+    assert writer.compression == "gzip"
+    writer.close()
+    with pytest.raises(ValueError):
+        DumpWriter(str(tmp_path / "dump.ndjson"), compression="lz4")
+
+
+def test_appends_to_existing_dump(tmp_path):
+    path = str(tmp_path / "dump.ndjson.gz")
+    for start in (0, 2):
+        writer = DumpWriter(path)
+        writer.write(posts(start, 2))
+        writer.close()
+    assert read_lines(path) == posts(0, 4)
+
+
+def test_rotation_by_size_writes_manifests(tmp_path):
+    path = str(tmp_path / "dump.ndjson.gz")
+    writer = DumpWriter(path, rotate_bytes=1)
+    for start in range(0, 6, 2):
+        writer.write(posts(start, 2))
+    writer.close()
+
+    segments = sorted(name for name in os.listdir(tmp_path) if not name.endswith(".manifest.json"))
+    assert segments == ["dump-00001.ndjson.gz", "dump-00002.ndjson.gz", "dump-00003.ndjson.gz"]
+    assert [manifest["file"] for manifest in writer.manifests] == segments
+
+    offset = 0
+    for index, segment in enumerate(segments):
+        manifest = read_manifest(str(tmp_path / segment))
+        assert read_lines(str(tmp_path / segment)) == posts(2*index, 2)
+        assert manifest["documents"] == 2
+        assert (manifest["min_created_utc"], manifest["max_created_utc"]) == (1000 + 2*index, 1001 + 2*index)
+        # Los segmentos son consecutivos dentro del volcado sin comprimir
+        assert manifest["start_offset"] == offset
+        offset = manifest["end_offset"]
+        assert manifest["compressed_bytes"] == os.path.getsize(str(tmp_path / segment))
+
+
+def test_rotation_skips_existing_segments(tmp_path):
+    path = str(tmp_path / "dump.ndjson")
+    for _ in range(2):
+        writer = DumpWriter(path, rotate_bytes=1024)
+        writer.write(posts(0, 1))
+        writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["dump-00001.ndjson", "dump-00001.ndjson.manifest.json",
+                                            "dump-00002.ndjson", "dump-00002.ndjson.manifest.json"]
+
+
+def test_rotation_does_not_leave_empty_segments(tmp_path):
+    writer = DumpWriter(str(tmp_path / "dump.ndjson"), rotate_seconds=0.001)
+    writer.write(posts(0, 1))
+    writer.close()
+    assert len(writer.manifests) == 1
+
+
+def test_manifest_ignores_missing_dates(tmp_path):
+    writer = DumpWriter(str(tmp_path / "dump.ndjson"), rotate_bytes=1024)
+    writer.write([{"id": "a"}, {"id": "b", "created_utc": None}])
+    writer.close()
+    manifest = writer.manifests[0]
+    assert manifest["documents"] == 2
+    assert manifest["min_created_utc"] is None and manifest["max_created_utc"] is None
+
+
+def test_read_manifest_missing(tmp_path):
+    assert read_manifest(str(tmp_path / "dump.ndjson")) is None
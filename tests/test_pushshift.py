@@ -0,0 +1,187 @@
+"""
+    Tests del cliente de Pushshift: ventanas de tiempo, paginación, reintentos y consultas concurrentes
+"""
+
+import pytest
+import requests
+
+from src.utils.pushshift import (PushshiftClient, crawl_parallel, crawl_windows, limited_get, pack_by_length,
+                                 split_windows)
+
+
+class FakeClient(PushshiftClient):
+    """
+        Cliente que responde a las búsquedas desde una lista de documentos en memoria, en páginas de `page_size`
+    """
+
+    def __init__(self, documents, page_size=3):
+        super().__init__(limiter=None, page_size=page_size)
+        self.documents = sorted(documents, key=lambda document: -document["created_utc"])
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append(dict(params))
+        data = [document for document in self.documents
+                if params.get("after", float("-inf")) < document["created_utc"] < params.get("before", float("inf"))]
+        return {"data": data[:params["size"]]}
+
+
+OLD = 1400000000
+
+
+def posts(*timestamps):
+    return [{"id": "p%d"%i, "created_utc": timestamp} for i, timestamp in enumerate(timestamps)]
+
+
+def test_split_windows_covers_the_range():
+    windows = split_windows(0, 100, 4)
+    assert windows == [(75, 100), (50, 75), (25, 50), (0, 25)]
+
+
+def test_split_windows_uneven_and_short_ranges():
+    windows = split_windows(0, 10, 3)
+    assert windows[0][1] == 10 and windows[-1][0] == 0
+    assert all(newer[0] == older[1] for newer, older in zip(windows, windows[1:]))
+    # Nunca ventanas de menos de un segundo
+    assert split_windows(0, 2, 10) == [(1, 2), (0, 1)]
+
+
+def test_search_pages_through_shared_seconds():
+    # Cuatro documentos en el mismo segundo con páginas de tres
+    documents = posts(10, 9, 9, 9, 9, 5, 1)
+    client = FakeClient(documents, page_size=3)
+    found = list(client.search_submissions())
+    assert sorted(document["id"] for document in found) == sorted(document["id"] for document in documents)
+    assert len(found) == len(documents)
+
+
+def test_search_limit_counts_only_new_documents():
+    client = FakeClient(posts(10, 9, 9, 9, 9, 5, 1), page_size=3)
+    assert [document["id"] for document in client.search_submissions(limit=5)] == ["p0", "p1", "p2", "p3", "p4"]
+
+
+def test_search_adds_paging_fields():
+    client = FakeClient(posts(1))
+    list(client.search_submissions(fields=["title"]))
+    assert client.requests[0]["fields"] == "created_utc,id,title"
+
+
+def test_crawl_windows_deduplicates_boundaries():
+    documents = posts(0, 25, 25, 30, 50, 75, 99, 100)
+    client = FakeClient(documents)
+    search = lambda after, before: client.search_submissions(after=after, before=before)
+    found = list(crawl_windows(search, split_windows(0, 100, 4), threads=2, batch_size=2))
+    assert sorted(document["id"] for document in found) == sorted(document["id"] for document in documents)
+
+
+def test_crawl_parallel_returns_every_task():
+    found = list(crawl_parallel(lambda task: [{"id": (task, i)} for i in range(task)], [1, 5, 3], threads=2,
+                                batch_size=2, queue_size=1))
+    assert sorted(document["id"] for document in found) == sorted((task, i) for task in (1, 5, 3) for i in range(task))
+
+
+def test_crawl_parallel_propagates_errors():
+    def search(task):
+        if task == 2:
+            raise RuntimeError("falla la tarea")
+        return [{"id": task}]
+
+    with pytest.raises(RuntimeError):
+        list(crawl_parallel(search, [1, 2, 3], threads=2))
+
+
+def test_crawl_parallel_stops_when_abandoned():
+    documents = crawl_parallel(lambda task: ({"id": i} for i in range(10**6)), [1, 2], threads=2, batch_size=1,
+                               queue_size=1)
+    assert next(documents) == {"id": 0}
+    # Al cerrar el generador los hilos dejan de producir y se liberan
+    documents.close()
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.throttled = []
+
+    def acquire(self):
+        return 0
+
+    def add_fetch_time(self, seconds):
+        pass
+
+    def success(self):
+        pass
+
+    def throttle(self, retry_after=None):
+        self.throttled.append(retry_after)
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def json(self):
+        if self.body is None:
+            raise ValueError("JSON inválido")
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.timeouts = []
+
+    def get(self, url, params=None, timeout=None):
+        self.timeouts.append(timeout)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_limited_get_retries_transport_errors():
+    session = FakeSession(requests.Timeout(), requests.exceptions.ChunkedEncodingError(), FakeResponse(200),
+                          FakeResponse(500), FakeResponse(200, {"data": [1]}))
+    assert limited_get(FakeLimiter(), "url", session=session, backoff=0, timeout=5) == {"data": [1]}
+    assert session.timeouts == [5]*5
+
+
+def test_limited_get_throttles_on_429():
+    limiter = FakeLimiter()
+    session = FakeSession(FakeResponse(429, headers={"Retry-After": "3"}), FakeResponse(200, {"data": []}))
+    assert limited_get(limiter, "url", session=session, backoff=0) == {"data": []}
+    assert limiter.throttled == [3]
+
+
+def test_limited_get_gives_up():
+    session = FakeSession(*[requests.ConnectionError()]*3)
+    with pytest.raises(RuntimeError):
+        limited_get(FakeLimiter(), "url", session=session, max_retries=3, backoff=0)
+
+
+def test_pack_by_length_fills_blocks():
+    values = ["a"*10]*7
+    # Cada bloque admite tres valores y sus dos comas codificadas (%2C)
+    blocks = list(pack_by_length(values, 3*10 + 2*3))
+    assert [len(block) for block in blocks] == [3, 3, 1]
+    assert sum(blocks, []) == values
+
+
+def test_pack_by_length_counts_encoded_bytes():
+    # "ñ" ocupa 6 bytes codificada en la URL
+    blocks = list(pack_by_length(["ñ", "ñ", "a"], 6 + 3 + 6))
+    assert blocks == [["ñ", "ñ"], ["a"]]
+
+
+def test_pack_by_length_keeps_oversized_values():
+    assert list(pack_by_length(["a"*20, "b"], 10)) == [["a"*20], ["b"]]
+    assert list(pack_by_length([], 10)) == []
+
+
+def test_url_length_matches_prepared_request():
+    client = PushshiftClient(limiter=None, page_size=100)
+    empty = client.url_length("submission", fields=["title"], author="", before=OLD)
+    full = client.url_length("submission", fields=["title"], author="a,b", before=OLD)
+    # La coma se codifica como %2C
+    assert full - empty == len("a%2Cb")
@@ -0,0 +1,68 @@
+"""
+    Tests del limitador de peticiones compartido
+"""
+
+import json
+import time
+
+import pytest
+
+from src.utils.rate_limit import TokenBucket, fcntl
+
+
+def test_burst_does_not_wait():
+    limiter = TokenBucket(rate=1, burst=3)
+    assert [limiter.acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.stats["requests"] == 3
+
+
+def test_waits_for_refill_after_burst():
+    limiter = TokenBucket(rate=50, burst=1)
+    limiter.acquire()
+    start = time.time()
+    waited = limiter.acquire()
+    assert waited > 0
+    assert time.time() - start >= 0.015
+
+
+def test_throttle_halves_rate_and_pauses():
+    limiter = TokenBucket(rate=8, burst=5)
+    limiter.throttle(retry_after=0.05)
+    assert limiter.rate == 4
+    assert limiter.stats["throttled"] == 1
+    assert limiter.acquire() >= 0.04
+
+
+def test_rate_never_below_minimum_and_recovers():
+    limiter = TokenBucket(rate=16, burst=5, min_rate=2)
+    for _ in range(10):
+        limiter.throttle(retry_after=0)
+    assert limiter.rate == 2
+    for _ in range(100):
+        limiter.success()
+    assert limiter.rate == 16
+
+
+@pytest.mark.skipif(fcntl is None, reason="el fichero de bloqueo necesita fcntl")
+def test_lock_file_shares_tokens_between_limiters(tmp_path):
+    lock_file = str(tmp_path / "pushshift.lock")
+    first = TokenBucket(rate=20, burst=2, lock_file=lock_file)
+    second = TokenBucket(rate=20, burst=2, lock_file=lock_file)
+
+    assert first.acquire() == 0
+    assert first.acquire() == 0
+    # Los tokens los ha gastado el otro limitador
+    assert second.acquire() > 0
+    with open(lock_file) as f:
+        assert set(json.load(f)) == {"tokens", "updated", "paused_until", "rate"}
+
+
+@pytest.mark.skipif(fcntl is None, reason="el fichero de bloqueo necesita fcntl")
+def test_lock_file_shares_throttling(tmp_path):
+    lock_file = str(tmp_path / "pushshift.lock")
+    first = TokenBucket(rate=8, burst=5, lock_file=lock_file)
+    second = TokenBucket(rate=8, burst=5, lock_file=lock_file)
+
+    first.throttle(retry_after=0.05)
+    assert second.acquire() >= 0.04
+    assert second.rate == 4
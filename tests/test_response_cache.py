@@ -0,0 +1,78 @@
+"""
+    Tests de la caché en disco de respuestas de la API
+"""
+
+import os
+import time
+
+from src.utils.response_cache import ResponseCache
+
+URL = "https://api.pushshift.io/reddit/submission/search"
+OLD = 1400000000
+
+
+def test_round_trip_and_normalized_keys(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put(URL, {"author": ["a", "b"], "size": 100}, {"data": [1]})
+    assert cache.get("HTTP://api.pushshift.io/reddit/submission/search/", {"size": "100", "author": "a,b"}) == {"data": [1]}
+    assert cache.get(URL, {"author": "a", "size": 100}) is None
+    assert (cache.stats["hits"], cache.stats["misses"]) == (1, 1)
+
+
+def test_recent_responses_expire(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=-1)
+    cache.put(URL, {"before": int(time.time())}, {"data": []})
+    assert cache.get(URL, {"before": int(time.time())}) is None
+    assert cache.stats["expired"] == 1
+
+
+def test_historical_responses_never_expire(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=-1)
+    cache.put(URL, {"before": OLD}, {"data": []})
+    assert cache.get(URL, {"before": OLD}) == {"data": []}
+
+
+def test_is_historical(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    assert cache.is_historical({"before": OLD})
+    assert cache.is_historical({"before": str(OLD)})
+    assert not cache.is_historical({"before": int(time.time())})
+    assert not cache.is_historical({"after": OLD})
+    # Las fechas en texto no se pueden comparar: se tratan como no históricas
+    assert not cache.is_historical({"before": "2014-05-13"})
+
+
+def test_overwrite_does_not_grow_size(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put(URL, {"before": OLD}, {"data": [1]})
+    size = cache.size
+    cache.put(URL, {"before": OLD}, {"data": [2]})
+    assert cache.size == size
+    assert cache.get(URL, {"before": OLD}) == {"data": [2]}
+
+
+def test_size_is_loaded_from_disk(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put(URL, {"before": OLD}, {"data": [1]})
+    assert ResponseCache(str(tmp_path)).size == cache.size > 0
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    queries = [{"before": OLD + i} for i in range(3)]
+    cache.put(URL, queries[0], {"data": ["a"]})
+    # Caben dos respuestas pero no tres
+    cache.max_bytes = int(2.6*cache.size)
+    cache.put(URL, queries[1], {"data": ["b"]})
+
+    # La primera respuesta es la más antigua, pero se usa después de la segunda
+    os.utime(cache._path(URL, queries[0]), (OLD, OLD))
+    os.utime(cache._path(URL, queries[1]), (OLD + 1, OLD + 1))
+    assert cache.get(URL, queries[0]) is not None
+    cache.put(URL, queries[2], {"data": ["c"]})
+
+    assert cache.stats["evicted"] == 1
+    assert cache.get(URL, queries[1]) is None
+    assert cache.get(URL, queries[0]) == {"data": ["a"]}
+    assert cache.get(URL, queries[2]) == {"data": ["c"]}
+    assert cache.size <= cache.max_bytes